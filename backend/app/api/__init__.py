@@ -10,6 +10,7 @@ from app.processing.router import processing_router  # noqa: F401
 from app.processing_stacks.router import processing_stacks_router  # noqa: F401
 from app.ollama_status.router import ollama_status_router  # noqa: F401
 from app.health.router import health_router  # noqa: F401
+from app.metrics.router import metrics_router  # noqa: F401
 
 
 # Build the api endpoints
@@ -22,3 +23,4 @@ api_router.include_router(processing_router, prefix="/processing", tags=["proces
 api_router.include_router(processing_stacks_router, prefix="/stacks", tags=["stacks"])
 api_router.include_router(ollama_status_router, prefix="/ollama-status", tags=["ollama-status"])
 api_router.include_router(health_router, prefix="/health", tags=["health"])
+api_router.include_router(metrics_router, prefix="/metrics", tags=["metrics"])
@@ -0,0 +1,267 @@
+import os
+import json
+import time
+import tempfile
+import threading
+from typing import Dict, Tuple
+
+import logging
+logger = logging.getLogger("uvicorn")
+
+# Folder where each worker process writes its metrics so that any worker can render the metrics of all the workers of the host
+DEFAULT_METRICS_MULTIPROCESS_DIR_PATH = "/dev/shm/idapt_metrics" if os.path.isdir("/dev/shm") else os.path.join(tempfile.gettempdir(), "idapt_metrics")
+METRICS_MULTIPROCESS_DIR_PATH = os.environ.get("METRICS_MULTIPROCESS_DIR_PATH", DEFAULT_METRICS_MULTIPROCESS_DIR_PATH)
+METRICS_PROCESS_FILE_PATH = METRICS_MULTIPROCESS_DIR_PATH + "/{pid}.json"
+PERIODIC_FLUSH_METRICS_SECONDS = 5
+
+class Counter:
+    """
+    Process local monotonic counter with optional labels
+    """
+    def __init__(self, name: str, description: str, label_names: Tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def _label_values(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels.keys()) != set(self.label_names):
+            raise ValueError(f"Counter {self.name} expects labels {self.label_names}, got {tuple(labels.keys())}")
+        return tuple(str(labels[label_name]) for label_name in self.label_names)
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        """Increment the counter for the given labels"""
+        label_values = self._label_values(labels)
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0.0) + amount
+
+    def get(self, **labels: str) -> float:
+        """Get the current value of the counter for the given labels"""
+        label_values = self._label_values(labels)
+        with self._lock:
+            return self._values.get(label_values, 0.0)
+
+    def collect(self) -> Dict[Tuple[str, ...], float]:
+        """Get a copy of all the values of the counter by label values"""
+        with self._lock:
+            return dict(self._values)
+
+
+# Process level registry of all the metrics so that they can be created from any module and collected in one place
+metrics_registry: Dict[str, "Counter | Histogram"] = {}
+metrics_registry_lock = threading.Lock()
+
+def get_counter(name: str, description: str, label_names: Tuple[str, ...] = ()) -> Counter:
+    """
+    Get or create a counter in the process metrics registry
+    """
+    with metrics_registry_lock:
+        metric = metrics_registry.get(name)
+        if metric is None:
+            metric = Counter(name, description, label_names)
+            metrics_registry[name] = metric
+        elif not isinstance(metric, Counter):
+            raise ValueError(f"Metric {name} is already registered with another type")
+        return metric
+
+
+DEFAULT_HISTOGRAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class Histogram:
+    """
+    Process local histogram with cumulative buckets and optional labels
+    """
+    def __init__(self, name: str, description: str, label_names: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_HISTOGRAM_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.buckets = tuple(sorted(buckets))
+        # Per label values: the count of each bucket (not cumulative), the sum and the count of the observations
+        self._values: Dict[Tuple[str, ...], Tuple[list, float, int]] = {}
+        self._lock = threading.Lock()
+
+    def _label_values(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels.keys()) != set(self.label_names):
+            raise ValueError(f"Histogram {self.name} expects labels {self.label_names}, got {tuple(labels.keys())}")
+        return tuple(str(labels[label_name]) for label_name in self.label_names)
+
+    def observe(self, value: float, **labels: str) -> None:
+        """Record an observation for the given labels"""
+        label_values = self._label_values(labels)
+        with self._lock:
+            bucket_counts, total, count = self._values.get(label_values, ([0] * (len(self.buckets) + 1), 0.0, 0))
+            for bucket_index, bucket in enumerate(self.buckets):
+                if value <= bucket:
+                    break
+            else:
+                bucket_index = len(self.buckets)
+            bucket_counts[bucket_index] += 1
+            self._values[label_values] = (bucket_counts, total + value, count + 1)
+
+    def collect(self) -> Dict[Tuple[str, ...], Tuple[list, float, int]]:
+        """Get a copy of the cumulative bucket counts, sum and count of the histogram by label values"""
+        return {
+            label_values: (_cumulate_bucket_counts(bucket_counts), total, count)
+            for label_values, (bucket_counts, total, count) in self.collect_bucket_counts().items()
+        }
+
+    def collect_bucket_counts(self) -> Dict[Tuple[str, ...], Tuple[list, float, int]]:
+        """Get a copy of the non cumulative bucket counts, sum and count of the histogram by label values, they can be summed across processes"""
+        with self._lock:
+            return {label_values: (list(bucket_counts), total, count) for label_values, (bucket_counts, total, count) in self._values.items()}
+
+def _cumulate_bucket_counts(bucket_counts: list) -> list:
+    cumulative_bucket_counts = []
+    cumulative_count = 0
+    for bucket_count in bucket_counts:
+        cumulative_count += bucket_count
+        cumulative_bucket_counts.append(cumulative_count)
+    return cumulative_bucket_counts
+
+
+def get_histogram(name: str, description: str, label_names: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_HISTOGRAM_BUCKETS) -> Histogram:
+    """
+    Get or create a histogram in the process metrics registry
+    """
+    with metrics_registry_lock:
+        metric = metrics_registry.get(name)
+        if metric is None:
+            metric = Histogram(name, description, label_names, buckets)
+            metrics_registry[name] = metric
+        elif not isinstance(metric, Histogram):
+            raise ValueError(f"Metric {name} is already registered with another type")
+        return metric
+
+
+def _format_labels(label_names: Tuple[str, ...], label_values: Tuple[str, ...], extra_labels: Dict[str, str] | None = None) -> str:
+    labels = list(zip(label_names, label_values)) + list((extra_labels or {}).items())
+    if not labels:
+        return ""
+    escaped_labels = [f'{name}="' + value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') + '"' for name, value in labels]
+    return "{" + ",".join(escaped_labels) + "}"
+
+def _collect_process_metrics() -> Dict[str, dict]:
+    """Get the metrics of this process in a json serializable form"""
+    with metrics_registry_lock:
+        metrics = list(metrics_registry.values())
+    process_metrics = {}
+    for metric in metrics:
+        if isinstance(metric, Counter):
+            process_metrics[metric.name] = {
+                "type": "counter",
+                "description": metric.description,
+                "label_names": list(metric.label_names),
+                "values": [[list(label_values), value] for label_values, value in metric.collect().items()]
+            }
+        elif isinstance(metric, Histogram):
+            process_metrics[metric.name] = {
+                "type": "histogram",
+                "description": metric.description,
+                "label_names": list(metric.label_names),
+                "buckets": list(metric.buckets),
+                "values": [[list(label_values), [bucket_counts, total, count]] for label_values, (bucket_counts, total, count) in metric.collect_bucket_counts().items()]
+            }
+    return process_metrics
+
+def flush_process_metrics() -> None:
+    """Write the metrics of this process to its file in the multiprocess folder, it is renamed over the previous one so that the readers never read a partial one"""
+    os.makedirs(METRICS_MULTIPROCESS_DIR_PATH, exist_ok=True)
+    process_metrics_path = METRICS_PROCESS_FILE_PATH.format(pid=os.getpid())
+    tmp_process_metrics_path = f"{process_metrics_path}.tmp"
+    with open(tmp_process_metrics_path, "w") as f:
+        json.dump(_collect_process_metrics(), f)
+    os.replace(tmp_process_metrics_path, process_metrics_path)
+
+def setup_metrics_flush_loop():
+    """Setup and start the loop writing the metrics of this worker for the other workers in a background thread"""
+    def metrics_flush_loop():
+        while True:
+            try:
+                flush_process_metrics()
+            except Exception as e:
+                logger.error(f"Error writing the metrics of process {os.getpid()}: {e}")
+            time.sleep(PERIODIC_FLUSH_METRICS_SECONDS)
+
+    logger.info("Setting up metrics flush loop")
+    metrics_flush_thread = threading.Thread(
+        target=metrics_flush_loop,
+        daemon=True,  # Terminate when main thread exits
+        name="metrics-flush"
+    )
+    metrics_flush_thread.start()
+
+def _is_process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def _collect_host_metrics() -> Dict[str, dict]:
+    """
+    Get the metrics of this process merged with the last written metrics of the other live worker processes of the host
+    The files of the dead processes are removed, their counters are reset like after a restart
+    """
+    processes_metrics = [_collect_process_metrics()]
+    try:
+        process_metrics_file_names = os.listdir(METRICS_MULTIPROCESS_DIR_PATH)
+    except FileNotFoundError:
+        process_metrics_file_names = []
+    for process_metrics_file_name in process_metrics_file_names:
+        pid_str, extension = os.path.splitext(process_metrics_file_name)
+        if extension != ".json" or not pid_str.isdigit() or int(pid_str) == os.getpid():
+            continue
+        process_metrics_path = os.path.join(METRICS_MULTIPROCESS_DIR_PATH, process_metrics_file_name)
+        try:
+            if not _is_process_alive(int(pid_str)):
+                os.unlink(process_metrics_path)
+                continue
+            with open(process_metrics_path, "r") as f:
+                processes_metrics.append(json.load(f))
+        except Exception as e:
+            logger.error(f"Error reading the metrics file {process_metrics_path}: {e}")
+
+    host_metrics: Dict[str, dict] = {}
+    for process_metrics in processes_metrics:
+        for name, metric in process_metrics.items():
+            host_metric = host_metrics.get(name)
+            if host_metric is None:
+                host_metric = {key: value for key, value in metric.items() if key != "values"}
+                host_metric["values"] = {}
+                host_metrics[name] = host_metric
+            elif host_metric["type"] != metric["type"] or host_metric.get("buckets") != metric.get("buckets"):
+                # Written by a process of another version of the app
+                continue
+            for label_values, value in metric["values"]:
+                label_values = tuple(label_values)
+                if metric["type"] == "counter":
+                    host_metric["values"][label_values] = host_metric["values"].get(label_values, 0.0) + value
+                else:
+                    bucket_counts, total, count = value
+                    host_bucket_counts, host_total, host_count = host_metric["values"].get(label_values, ([0] * len(bucket_counts), 0.0, 0))
+                    host_metric["values"][label_values] = ([a + b for a, b in zip(host_bucket_counts, bucket_counts)], host_total + total, host_count + count)
+    return host_metrics
+
+def render_metrics_prometheus() -> str:
+    """
+    Render the metrics of all the worker processes of the host in the Prometheus text exposition format
+    """
+    lines = []
+    for name, metric in sorted(_collect_host_metrics().items()):
+        label_names = tuple(metric["label_names"])
+        lines.append(f"# HELP {name} {metric['description']}")
+        if metric["type"] == "counter":
+            lines.append(f"# TYPE {name} counter")
+            for label_values, value in metric["values"].items():
+                lines.append(f"{name}{_format_labels(label_names, label_values)} {value}")
+        elif metric["type"] == "histogram":
+            lines.append(f"# TYPE {name} histogram")
+            for label_values, (bucket_counts, total, count) in metric["values"].items():
+                for bucket, cumulative_bucket_count in zip(list(metric["buckets"]) + ["+Inf"], _cumulate_bucket_counts(bucket_counts)):
+                    lines.append(f"{name}_bucket{_format_labels(label_names, label_values, {'le': str(bucket)})} {cumulative_bucket_count}")
+                lines.append(f"{name}_sum{_format_labels(label_names, label_values)} {total}")
+                lines.append(f"{name}_count{_format_labels(label_names, label_values)} {count}")
+    return "\n".join(lines) + "\n"
@@ -1,130 +1,343 @@
 import os
-from contextlib import contextmanager
-from datetime import datetime, timedelta
+import time
+import heapq
+import tempfile
+from typing import Callable, Dict, List, Set, Tuple
+from contextlib import asynccontextmanager
 from kubernetes import client, config
 from kubernetes.client.rest import ApiException
-from filelock import FileLock
 import asyncio
 import threading
 
+from app.api.user_data_locks import LockMode, UserDataLock, UserDataLockTimeout, user_data_lock, user_data_lock_sync, get_user_data_lock_path
+from app.api.metrics import get_histogram
+
 import logging
 logger = logging.getLogger("uvicorn")
 
 DATA_FOLDER_PATH = "/data"
 USER_DATA_FOLDER_PATH = "/data/{user_uuid}"
-USER_DATA_DIR_LOCK_PATH = USER_DATA_FOLDER_PATH + ".lock"
-USER_DATA_DIR_LAST_USE_TIMESTAMP_PATH = USER_DATA_FOLDER_PATH + ".timestamp"
+# The last use of the user data directories is tracked in memory by each worker and periodically flushed to shared memory
+# as the modification time of one file per user so that the workers of this host see the requests handled by the others
+DEFAULT_USER_DATA_DIR_LAST_USE_DIR_PATH = "/dev/shm/idapt_user_data_last_use" if os.path.isdir("/dev/shm") else os.path.join(tempfile.gettempdir(), "idapt_user_data_last_use")
+USER_DATA_DIR_LAST_USE_DIR_PATH = os.environ.get("USER_DATA_DIR_LAST_USE_DIR_PATH", DEFAULT_USER_DATA_DIR_LAST_USE_DIR_PATH)
+USER_DATA_DIR_LAST_USE_PATH = USER_DATA_DIR_LAST_USE_DIR_PATH + "/{user_uuid}"
 
+# The idle timeout of a user data directory adapts to the access history of the user between these bounds
 MOUNTED_USER_DATA_DIR_CACHE_TIME_SECONDS = 15
-PERIODIC_CHECK_MOUNTED_USER_DATA_DIR_SECONDS = 10
+MAX_MOUNTED_USER_DATA_DIR_CACHE_TIME_SECONDS = int(os.environ.get("MAX_MOUNTED_USER_DATA_DIR_CACHE_TIME_SECONDS", 300))
+# Keep the user data directory mounted for this many typical gaps between the requests of the user
+USER_DATA_DIR_IDLE_TIMEOUT_ACCESS_GAPS = 3
+USER_DATA_DIR_ACCESS_GAP_EWMA_ALPHA = 0.3
+# Gaps shorter than this are requests of the same burst and are not part of the access history
+MIN_USER_DATA_DIR_ACCESS_GAP_SECONDS = 1
+# Must stay well below MOUNTED_USER_DATA_DIR_CACHE_TIME_SECONDS so that the other workers never see a stale last use
+PERIODIC_FLUSH_USER_DATA_DIR_LAST_USE_SECONDS = 2
+
+# Set to the url of a kubernetes API server to use it instead of the in cluster configuration, eg. a local fake API server for testing
+KUBERNETES_API_HOST = os.environ.get("KUBERNETES_API_HOST", None)
+
+# Last use unix time of the user data directories by this worker and the users not flushed yet since their last use
+users_data_dir_last_use: Dict[str, float] = {}
+users_data_dir_last_use_dirty: Set[str] = set()
+# Exponentially weighted moving average of the gaps between the request bursts of each user, kept across unmounts
+users_data_dir_access_gap_ewma: Dict[str, float] = {}
+# Heap of (idle deadline, user_uuid) with at most one entry per user, the deadline of an entry is checked against the last use when it is popped
+users_data_dir_idle_deadlines_heap: List[Tuple[float, str]] = []
+users_data_dir_idle_deadlines_scheduled: Set[str] = set()
+# Guards the tables above and wakes the lifecycle thread up when an earlier deadline is scheduled
+users_data_dir_last_use_lock = threading.Condition()
+
+# Kubernetes API client shared by all the mounts and unmounts of this worker
+kubernetes_core_v1_api: client.CoreV1Api | None = None
+kubernetes_core_v1_api_lock = threading.Lock()
+
+# Called with the user uuid before the user data directory is unmounted so that the modules can close what they keep open in it
+user_data_dir_unmount_callbacks: List[Callable[[str], None]] = []
+
+# Mounts in progress in this worker so that concurrent first requests of a user wait on the same mount, only used from the server event loop
+users_data_dir_mounts_in_flight: Dict[str, asyncio.Task] = {}
 
-def setup_mounted_user_data_dir_cleanup_loop():
-    """Setup and start the cleanup loop in a background thread"""
-    def run_async_in_thread(logger: logging.Logger):
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
+user_data_dir_mount_duration_histogram = get_histogram(
+    "idapt_user_data_dir_mount_duration_seconds",
+    "Duration of the user data directory mounts by trigger",
+    ("trigger",),
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0)
+)
+
+def register_user_data_dir_unmount_callback(callback: Callable[[str], None]) -> None:
+    """Register a function closing the resources of a user kept open in its data directory by this worker"""
+    user_data_dir_unmount_callbacks.append(callback)
+
+def _run_user_data_dir_unmount_callbacks(user_uuid: str) -> None:
+    for callback in user_data_dir_unmount_callbacks:
         try:
-            loop.run_until_complete(cleanup_mounted_user_data_dir_loop(logger))
+            callback(user_uuid)
         except Exception as e:
-            logger.error(f"User data cleanup loop failed: {e}")
-        finally:
-            loop.close()
+            logger.error(f"Error closing resources of user {user_uuid} before unmounting its data directory: {e}")
+
+def touch_user_data_dir(user_uuid: str) -> None:
+    """
+    Record the use of the user data directory, this only updates the in memory table and is cheap enough to be called on every request
+    """
+    with users_data_dir_last_use_lock:
+        last_use = time.time()
+        previous_last_use = users_data_dir_last_use.get(user_uuid)
+        if previous_last_use is not None and last_use - previous_last_use >= MIN_USER_DATA_DIR_ACCESS_GAP_SECONDS:
+            # Cap the gap so that a long absence does not keep the directory mounted for hours after the next visit
+            access_gap = min(last_use - previous_last_use, MAX_MOUNTED_USER_DATA_DIR_CACHE_TIME_SECONDS)
+            access_gap_ewma = users_data_dir_access_gap_ewma.get(user_uuid)
+            users_data_dir_access_gap_ewma[user_uuid] = access_gap if access_gap_ewma is None else USER_DATA_DIR_ACCESS_GAP_EWMA_ALPHA * access_gap + (1 - USER_DATA_DIR_ACCESS_GAP_EWMA_ALPHA) * access_gap_ewma
+        users_data_dir_last_use[user_uuid] = last_use
+        users_data_dir_last_use_dirty.add(user_uuid)
+        # Users already scheduled are rescheduled from their last use when their entry is popped, so a request costs no heap operation
+        if user_uuid not in users_data_dir_idle_deadlines_scheduled:
+            _schedule_user_data_dir_idle_deadline(user_uuid, last_use + _get_user_data_dir_idle_timeout(user_uuid))
 
-    logger.info("Setting up unmounted user data directory cleanup loop")
-    cleanup_thread = threading.Thread(
-        target=run_async_in_thread,
+def _get_user_data_dir_idle_timeout(user_uuid: str) -> float:
+    """Get the idle timeout of the user data directory from the access history of the user, users_data_dir_last_use_lock must be held"""
+    access_gap_ewma = users_data_dir_access_gap_ewma.get(user_uuid)
+    if access_gap_ewma is None:
+        return MOUNTED_USER_DATA_DIR_CACHE_TIME_SECONDS
+    return min(max(USER_DATA_DIR_IDLE_TIMEOUT_ACCESS_GAPS * access_gap_ewma, MOUNTED_USER_DATA_DIR_CACHE_TIME_SECONDS), MAX_MOUNTED_USER_DATA_DIR_CACHE_TIME_SECONDS)
+
+def get_user_data_dir_idle_timeout(user_uuid: str) -> float:
+    """Get the number of seconds without use after which the user data directory is unmounted"""
+    with users_data_dir_last_use_lock:
+        return _get_user_data_dir_idle_timeout(user_uuid)
+
+def _schedule_user_data_dir_idle_deadline(user_uuid: str, idle_deadline: float) -> None:
+    """Push the idle deadline of a user in the heap, users_data_dir_last_use_lock must be held"""
+    heapq.heappush(users_data_dir_idle_deadlines_heap, (idle_deadline, user_uuid))
+    users_data_dir_idle_deadlines_scheduled.add(user_uuid)
+    # Wake the lifecycle thread up if this is now the earliest deadline
+    if users_data_dir_idle_deadlines_heap[0][1] == user_uuid:
+        users_data_dir_last_use_lock.notify()
+
+def _reschedule_user_data_dir_idle_deadline(user_uuid: str, idle_deadline: float) -> None:
+    """Schedule again the idle deadline of a user popped from the heap, unless a request already did it"""
+    with users_data_dir_last_use_lock:
+        if user_uuid not in users_data_dir_idle_deadlines_scheduled:
+            _schedule_user_data_dir_idle_deadline(user_uuid, idle_deadline)
+
+def flush_users_data_dir_last_use() -> None:
+    """
+    Write the last use of the users used since the previous flush to shared memory
+    """
+    with users_data_dir_last_use_lock:
+        dirty_users_last_use = {user_uuid: users_data_dir_last_use[user_uuid] for user_uuid in users_data_dir_last_use_dirty if user_uuid in users_data_dir_last_use}
+        users_data_dir_last_use_dirty.clear()
+    if not dirty_users_last_use:
+        return
+    os.makedirs(USER_DATA_DIR_LAST_USE_DIR_PATH, mode=0o700, exist_ok=True)
+    for user_uuid, last_use in dirty_users_last_use.items():
+        try:
+            last_use_path = USER_DATA_DIR_LAST_USE_PATH.format(user_uuid=user_uuid)
+            if not os.path.exists(last_use_path):
+                open(last_use_path, "a").close()
+            os.utime(last_use_path, (last_use, last_use))
+        except Exception as e:
+            logger.error(f"Error flushing last use of user data directory {user_uuid}: {e}")
+            # Retry on the next flush
+            with users_data_dir_last_use_lock:
+                users_data_dir_last_use_dirty.add(user_uuid)
+
+def get_user_data_dir_last_use(user_uuid: str) -> float | None:
+    """
+    Get the last use unix time of the user data directory by any worker of this host, None if it has never been used
+    """
+    with users_data_dir_last_use_lock:
+        last_use = users_data_dir_last_use.get(user_uuid)
+    try:
+        shared_last_use = os.path.getmtime(USER_DATA_DIR_LAST_USE_PATH.format(user_uuid=user_uuid))
+        last_use = shared_last_use if last_use is None else max(last_use, shared_last_use)
+    except FileNotFoundError:
+        pass
+    return last_use
+
+def forget_user_data_dir_last_use(user_uuid: str) -> None:
+    """Drop the last use of an unmounted user data directory"""
+    with users_data_dir_last_use_lock:
+        users_data_dir_last_use.pop(user_uuid, None)
+        users_data_dir_last_use_dirty.discard(user_uuid)
+    try:
+        os.remove(USER_DATA_DIR_LAST_USE_PATH.format(user_uuid=user_uuid))
+    except FileNotFoundError:
+        pass
+
+def is_user_data_dir_idle(user_uuid: str) -> bool:
+    """Check if the user data directory has not been used for more than its idle timeout"""
+    last_use = get_user_data_dir_last_use(user_uuid)
+    return last_use is None or last_use < time.time() - get_user_data_dir_idle_timeout(user_uuid)
+
+def setup_user_data_dir_lifecycle_manager():
+    """Setup and start the user data directories lifecycle manager in a background thread"""
+    # If the deployment type is self-hosted, the user data directories are never unmounted
+    if os.environ.get("DEPLOYMENT_TYPE", "self-hosted") == "self-hosted":
+        return
+
+    logger.info("Setting up user data directories lifecycle manager")
+    # Schedule the user data directories mounted before this worker started, this is the only listing of the data folder
+    try:
+        user_data_dirs = [d for d in os.listdir(DATA_FOLDER_PATH) if not d.startswith(".") and os.path.isdir(os.path.join(DATA_FOLDER_PATH, d))]
+        with users_data_dir_last_use_lock:
+            for user_data_dir in user_data_dirs:
+                # Extract the user_uuid from the user data directory name
+                user_uuid = user_data_dir.split("-")[-1]
+                if user_uuid not in users_data_dir_idle_deadlines_scheduled:
+                    _schedule_user_data_dir_idle_deadline(user_uuid, time.time() + MOUNTED_USER_DATA_DIR_CACHE_TIME_SECONDS)
+    except Exception as e:
+        logger.error(f"Error scheduling the already mounted user data directories: {e}")
+
+    lifecycle_thread = threading.Thread(
+        target=user_data_dir_lifecycle_loop,
         daemon=True,  # Terminate when main thread exits
-        name="user-data-cleanup",
+        name="user-data-lifecycle",
         args=(logger,)
     )
-    cleanup_thread.start()
+    lifecycle_thread.start()
 
 
-async def cleanup_mounted_user_data_dir_loop(logger: logging.Logger):
+def user_data_dir_lifecycle_loop(logger: logging.Logger):
     """
-    Cleanup mounted user data directories
+    Sleep until the next idle deadline or last use flush and unmount the user data directories whose idle deadline has passed
     """
-    try:
-        while True:
-            # If the deployment type is self-hosted, we do not need to cleanup the mounted user data directories
-            if os.environ.get("DEPLOYMENT_TYPE", "self-hosted") == "self-hosted":
-                return
+    next_flush = time.time() + PERIODIC_FLUSH_USER_DATA_DIR_LAST_USE_SECONDS
+    while True:
+        try:
+            due_users: List[str] = []
+            with users_data_dir_last_use_lock:
+                next_wake_up = next_flush
+                if users_data_dir_idle_deadlines_heap:
+                    next_wake_up = min(next_wake_up, users_data_dir_idle_deadlines_heap[0][0])
+                wait_seconds = next_wake_up - time.time()
+                if wait_seconds > 0:
+                    users_data_dir_last_use_lock.wait(timeout=wait_seconds)
+                now = time.time()
+                while users_data_dir_idle_deadlines_heap and users_data_dir_idle_deadlines_heap[0][0] <= now:
+                    _, user_uuid = heapq.heappop(users_data_dir_idle_deadlines_heap)
+                    users_data_dir_idle_deadlines_scheduled.discard(user_uuid)
+                    due_users.append(user_uuid)
 
-            # Wait the PERIODIC_CHECK_UNMOUNTED_USER_DATA_DIR_SECONDS
-            await asyncio.sleep(PERIODIC_CHECK_MOUNTED_USER_DATA_DIR_SECONDS)
+            if time.time() >= next_flush:
+                flush_users_data_dir_last_use()
+                next_flush = time.time() + PERIODIC_FLUSH_USER_DATA_DIR_LAST_USE_SECONDS
 
-            # Get all the user data directories filtering for only the directories
-            user_data_dirs = [d for d in os.listdir(DATA_FOLDER_PATH) if os.path.isdir(os.path.join(DATA_FOLDER_PATH, d))]
-            # For each mounted user data directory
-            for user_data_dir in user_data_dirs:
-                logger.debug(f"Checking user data directory {user_data_dir}")
+            for user_uuid in due_users:
                 try:
-                    # Extract the user_uuid from the user data directory name
-                    user_uuid = user_data_dir.split("-")[-1]
-                    # Take the lock on the user data directory
-                    user_data_dir_lock = FileLock(USER_DATA_DIR_LOCK_PATH.format(user_uuid=user_uuid), timeout=MOUNTED_USER_DATA_DIR_CACHE_TIME_SECONDS) # Wait at most MOUNTED_USER_DATA_DIR_CACHE_TIME_SECONDS for the lock to be released otherwise 
-                    with user_data_dir_lock:
-                        # Get the last use timestamp
-                        last_use_file_content = None
-                        try:
-                            with open(USER_DATA_DIR_LAST_USE_TIMESTAMP_PATH.format(user_uuid=user_uuid), "r") as f:
-                                last_use_file_content = f.read()
-                        except Exception as e:
-                            logger.error(f"Error getting last use timestamp for user data directory {user_uuid}: {e}")
-                            continue
-                        if last_use_file_content is None:
-                            raise Exception(f"Last use timestamp for user data directory {user_uuid} is not set, this should not happen")
-                        last_use_timestamp = datetime.fromisoformat(last_use_file_content)
-                        # Check if the last use timestamp is more than MOUNTED_USER_DATA_DIR_CACHE_TIME_SECONDS ago
-                        if last_use_timestamp < datetime.now() - timedelta(seconds=MOUNTED_USER_DATA_DIR_CACHE_TIME_SECONDS):
-                            logger.info(f"Unmounting user data directory {user_uuid} because it has not been used for more than {MOUNTED_USER_DATA_DIR_CACHE_TIME_SECONDS} seconds")
-                            # Unmount the user data directory
-                            unmount_user_data_dir(user_uuid)
+                    _unmount_user_data_dir_if_idle(user_uuid)
                 except Exception as e:
-                    logger.error(f"Error cleaning up unmounted user data for user {user_uuid}, continuing the the next user data directory: {e}")
-    except Exception as e:
-        logger.error(f"Error cleaning up unmounted user data directories, restarting the loop any way: {e}")
-        # Restart the loop
-        # Get the current asyncio event loop
-        loop = asyncio.get_event_loop()
-        if loop.is_running():
-            loop.create_task(cleanup_mounted_user_data_dir_loop(logger))
-        else:
-            asyncio.run(cleanup_mounted_user_data_dir_loop(logger))
+                    logger.error(f"Error unmounting idle user data directory for user {user_uuid}, continuing with the next user: {e}")
+                    # Try again after another idle period
+                    _reschedule_user_data_dir_idle_deadline(user_uuid, time.time() + MOUNTED_USER_DATA_DIR_CACHE_TIME_SECONDS)
+        except Exception as e:
+            logger.error(f"Error in the user data directories lifecycle loop, continuing anyway: {e}")
+            time.sleep(1)
 
+def _unmount_user_data_dir_if_idle(user_uuid: str) -> None:
+    """
+    Unmount the user data directory if it has not been used since its idle deadline, otherwise reschedule it from its last use
+    """
+    last_use = get_user_data_dir_last_use(user_uuid)
+    if last_use is not None and not is_user_data_dir_idle(user_uuid):
+        # Used since the deadline was scheduled by this worker or another one
+        _reschedule_user_data_dir_idle_deadline(user_uuid, last_use + get_user_data_dir_idle_timeout(user_uuid))
+        return
+
+    try:
+        # Take the exclusive lock on the user data directory so that no request is using it while unmounting
+        # Wait at most MOUNTED_USER_DATA_DIR_CACHE_TIME_SECONDS for the requests in progress to release it
+        with user_data_lock_sync(user_uuid, mode=LockMode.EXCLUSIVE, timeout=MOUNTED_USER_DATA_DIR_CACHE_TIME_SECONDS):
+            # Check again as a request may have used it while we were waiting for the lock
+            if not is_user_data_dir_idle(user_uuid):
+                _reschedule_user_data_dir_idle_deadline(user_uuid, get_user_data_dir_last_use(user_uuid) + get_user_data_dir_idle_timeout(user_uuid))
+                return
+            # Close what this worker keeps open in the directory, even if another worker already unmounted it
+            _run_user_data_dir_unmount_callbacks(user_uuid)
+            # Another worker may have already unmounted it
+            if os.path.exists(USER_DATA_FOLDER_PATH.format(user_uuid=user_uuid)):
+                logger.info(f"Unmounting user data directory {user_uuid} because it has not been used for more than {get_user_data_dir_idle_timeout(user_uuid):.0f} seconds")
+                unmount_user_data_dir(user_uuid)
+            forget_user_data_dir_last_use(user_uuid)
+    except UserDataLockTimeout:
+        # Still used by a long request, check again after another idle period
+        logger.debug(f"User data directory {user_uuid} is still in use, postponing its unmount")
+        _reschedule_user_data_dir_idle_deadline(user_uuid, time.time() + MOUNTED_USER_DATA_DIR_CACHE_TIME_SECONDS)
 
 
-@contextmanager
-def mount_user_data_dir_dependency(user_uuid: str):
+@asynccontextmanager
+async def mount_user_data_dir_dependency(user_uuid: str):
     """
-    Mount the user data directory
+    Mount the user data directory if needed and keep it mounted until the end of the request
+    A shared lock is held for the whole request so that the requests of a user run concurrently,
+    mounting and unmounting take the exclusive lock and wait for the requests in progress
     """
-    current_timestamp_iso_str = None
+    user_data_dir_lock = UserDataLock(get_user_data_lock_path(user_uuid))
     try:
-        # Add a lock to the user data directory and maintain it until this request is finished to avoid race conditions
-        # TODO Add a per file lock instead for more granularity and efficiency
-        user_data_dir_lock = FileLock(USER_DATA_DIR_LOCK_PATH.format(user_uuid=user_uuid), timeout=15) # ?
-        with user_data_dir_lock:
-
-            # Check if the user data directory is already mounted
-            if not os.path.exists(USER_DATA_FOLDER_PATH.format(user_uuid=user_uuid)):
-                mount_user_data_dir(user_uuid)
-            else:
-                logger.debug(f"User data directory for user {user_uuid} is already mounted, skipping the mount")
-
-            yield
+        await user_data_dir_lock.aacquire(LockMode.SHARED)
+
+        # Check if the user data directory is already mounted
+        if os.path.exists(USER_DATA_FOLDER_PATH.format(user_uuid=user_uuid)):
+            logger.debug(f"User data directory for user {user_uuid} is already mounted, skipping the mount")
+        while not os.path.exists(USER_DATA_FOLDER_PATH.format(user_uuid=user_uuid)):
+            # Mounting needs the exclusive lock, release the shared one so that we don't wait for ourselves
+            user_data_dir_lock.release()
+            await ensure_user_data_dir_mounted(user_uuid)
+            await user_data_dir_lock.aacquire(LockMode.SHARED)
+
+        yield
     
     except Exception as e:
         logger.error(f"Error mounting user data directory for user {user_uuid}: {e}")
         raise e
     finally:
-        # Write the current timestamp to the lock timestamp file so that we know when the last use of it was to unmount it if needed by the cleanup_unmounted_user_data_dir_loop
-        current_timestamp_iso_str = datetime.now().isoformat()
-        # Overwrite the lock timestamp file with the current timestamp
-        with open(USER_DATA_DIR_LAST_USE_TIMESTAMP_PATH.format(user_uuid=user_uuid), "w") as f:
-            f.write(current_timestamp_iso_str)
+        # Record the last use so that the cleanup loop knows when to unmount the user data directory
+        touch_user_data_dir(user_uuid)
+        user_data_dir_lock.release()
     
 
+async def ensure_user_data_dir_mounted(user_uuid: str, trigger: str = "request") -> None:
+    """
+    Mount the user data directory if needed, the concurrent callers of this worker wait on the same mount
+    """
+    if os.path.exists(USER_DATA_FOLDER_PATH.format(user_uuid=user_uuid)):
+        return
+    # Shield the mount so that a cancelled request does not cancel it for the other waiters
+    await asyncio.shield(_get_or_start_user_data_dir_mount(user_uuid, trigger))
+
+def schedule_user_data_dir_premount(user_uuid: str) -> None:
+    """
+    Start mounting the user data directory in the background if it is not mounted, eg. on login before the first requests arrive
+    """
+    if os.path.exists(USER_DATA_FOLDER_PATH.format(user_uuid=user_uuid)):
+        return
+    _get_or_start_user_data_dir_mount(user_uuid, "premount")
+
+def _get_or_start_user_data_dir_mount(user_uuid: str, trigger: str) -> asyncio.Task:
+    """Get the mount in progress for this user or start a new one"""
+    mount_task = users_data_dir_mounts_in_flight.get(user_uuid)
+    if mount_task is None:
+        mount_task = asyncio.create_task(_mount_user_data_dir_exclusively(user_uuid, trigger))
+        users_data_dir_mounts_in_flight[user_uuid] = mount_task
+        def _on_mount_done(done_mount_task: asyncio.Task):
+            if users_data_dir_mounts_in_flight.get(user_uuid) is done_mount_task:
+                users_data_dir_mounts_in_flight.pop(user_uuid, None)
+            # Retrieve the error so that it is not reported as unhandled when nobody waits for a pre-mount
+            if not done_mount_task.cancelled() and done_mount_task.exception() is not None:
+                logger.error(f"Error mounting user data directory for user {user_uuid} ({trigger}): {done_mount_task.exception()}")
+        mount_task.add_done_callback(_on_mount_done)
+    return mount_task
+
+async def _mount_user_data_dir_exclusively(user_uuid: str, trigger: str) -> None:
+    """Mount the user data directory under the exclusive lock, other workers may have mounted it while we were waiting for it"""
+    async with user_data_lock(user_uuid, mode=LockMode.EXCLUSIVE):
+        if not os.path.exists(USER_DATA_FOLDER_PATH.format(user_uuid=user_uuid)):
+            mount_start = time.perf_counter()
+            await asyncio.to_thread(mount_user_data_dir, user_uuid)
+            user_data_dir_mount_duration_histogram.observe(time.perf_counter() - mount_start, trigger=trigger)
+        # Mark it as used so that it is not unmounted before the request waiting for it gets the shared lock
+        touch_user_data_dir(user_uuid)
+
 def mount_user_data_dir(user_uuid: str):
     """
     Mount the user data directory
@@ -162,84 +375,82 @@ def mount_user_data_dir_hosted(user_uuid: str) -> bool:
     Mount the user data directory for the hosted deployment type
     """
     try:
-        # Load the kubernetes config
-        config.load_incluster_config()
-        # Enter a context with an instance of the API kubernetes.client
-        with client.CoreV1Api() as api_instance:
-            pvc_exists = None
-            read_pvc_api_response = api_instance.read_namespaced_persistent_volume_claim(
-                name=f"user-data-{user_uuid}",
+        # Get the kubernetes API client shared by this worker
+        api_instance = get_kubernetes_core_v1_api()
+        pvc_exists = None
+        read_pvc_api_response = api_instance.read_namespaced_persistent_volume_claim(
+            name=f"user-data-{user_uuid}",
+            namespace="idapt"
+        )
+        logger.debug(f" read_namespaced_persistent_volume_claim api_response: {read_pvc_api_response}")
+        #TODO Check if the pvc is already mounted
+        if read_pvc_api_response is not None and read_pvc_api_response.status == 200 and read_pvc_api_response.metadata.name == f"user-data-{user_uuid}":
+            pvc_exists = True
+        elif read_pvc_api_response is not None and read_pvc_api_response.status == 404:
+            # If the pvc do not exist, create it
+            pvc_exists = False
+        else:
+            raise Exception(f"Error mounting user data directory for user {user_uuid}: {read_pvc_api_response}")
+        if not pvc_exists:
+            # TODO maybe add the user_uuid to the pv metadata ?
+            # If the pvc do not exist, create it
+            create_pvc_api_response = api_instance.create_namespaced_persistent_volume_claim(
+                body=client.V1PersistentVolumeClaim(
+                    api_version="v1",
+                    metadata=client.V1ObjectMeta(
+                        name=f"user-data-{user_uuid}",
+                        labels={"app": "idapt", "user_uuid": user_uuid}
+                    ),
+                    spec=client.V1PersistentVolumeClaimSpec(
+                        storage_class_name="user-data-sc",
+                        access_modes=["ReadWriteOnce"],
+                        resources=client.V1ResourceRequirements(
+                            requests={"storage": "1Gi"}
+                        )
+                    )
+                ),
                 namespace="idapt"
             )
-            logger.debug(f" read_namespaced_persistent_volume_claim api_response: {read_pvc_api_response}")
-            #TODO Check if the pvc is already mounted
-            if read_pvc_api_response is not None and read_pvc_api_response.status == 200 and read_pvc_api_response.metadata.name == f"user-data-{user_uuid}":
-                pvc_exists = True
-            elif read_pvc_api_response is not None and read_pvc_api_response.status == 404:
-                # If the pvc do not exist, create it
-                pvc_exists = False
-            else:
-                raise Exception(f"Error mounting user data directory for user {user_uuid}: {read_pvc_api_response}")
-            if not pvc_exists:
-                # TODO maybe add the user_uuid to the pv metadata ?
-                # If the pvc do not exist, create it
-                create_pvc_api_response = api_instance.create_namespaced_persistent_volume_claim(
-                    body=client.V1PersistentVolumeClaim(
-                        api_version="v1",
-                        metadata=client.V1ObjectMeta(
+            logger.debug(f" create_namespaced_persistent_volume_claim api_response: {create_pvc_api_response}")
+            if create_pvc_api_response is None or create_pvc_api_response.status != 201:
+                raise Exception(f"Error creating user data directory for user {user_uuid}: {create_pvc_api_response}")
+            
+        # Get the current pod name
+        current_pod_name = os.environ.get("POD_NAME", None)
+        if current_pod_name is None:
+            raise Exception("POD_NAME is not set, this is not running a kubernetes pod")
+        
+        # Bind the pvc to the pod and mount it to the /data/{user_uuid} folder
+        mount_pvc_api_response = api_instance.patch_namespaced_pod(
+            name=current_pod_name,
+            namespace="idapt",
+            body=client.V1Pod(
+                spec=client.V1PodSpec(
+                    volumes=[
+                        client.V1Volume(
                             name=f"user-data-{user_uuid}",
-                            labels={"app": "idapt", "user_uuid": user_uuid}
-                        ),
-                        spec=client.V1PersistentVolumeClaimSpec(
-                            storage_class_name="user-data-sc",
-                            access_modes=["ReadWriteOnce"],
-                            resources=client.V1ResourceRequirements(
-                                requests={"storage": "1Gi"}
-                            )
+                            persistent_volume_claim=client.V1PersistentVolumeClaimVolumeSource(claim_name=f"user-data-{user_uuid}")
                         )
-                    ),
-                    namespace="idapt"
-                )
-                logger.debug(f" create_namespaced_persistent_volume_claim api_response: {create_pvc_api_response}")
-                if create_pvc_api_response is None or create_pvc_api_response.status != 201:
-                    raise Exception(f"Error creating user data directory for user {user_uuid}: {create_pvc_api_response}")
-                
-            # Get the current pod name
-            current_pod_name = os.environ.get("POD_NAME", None)
-            if current_pod_name is None:
-                raise Exception("POD_NAME is not set, this is not running a kubernetes pod")
-            
-            # Bind the pvc to the pod and mount it to the /data/{user_uuid} folder
-            mount_pvc_api_response = api_instance.patch_namespaced_pod(
-                name=current_pod_name,
-                namespace="idapt",
-                body=client.V1Pod(
-                    spec=client.V1PodSpec(
-                        volumes=[
-                            client.V1Volume(
-                                name=f"user-data-{user_uuid}",
-                                persistent_volume_claim=client.V1PersistentVolumeClaimVolumeSource(claim_name=f"user-data-{user_uuid}")
-                            )
-                        ],
-                        containers=[
-                            client.V1Container(
-                                name=f"idapt-backend",
-                                volume_mounts=[
-                                    client.V1VolumeMount(
-                                        name=f"user-data-{user_uuid}", 
-                                        mount_path=USER_DATA_FOLDER_PATH.format(user_uuid=user_uuid)
-                                    )
-                                ]
-                            )
-                        ]
-                    )
+                    ],
+                    containers=[
+                        client.V1Container(
+                            name=f"idapt-backend",
+                            volume_mounts=[
+                                client.V1VolumeMount(
+                                    name=f"user-data-{user_uuid}", 
+                                    mount_path=USER_DATA_FOLDER_PATH.format(user_uuid=user_uuid)
+                                )
+                            ]
+                        )
+                    ]
                 )
             )
+        )
 
-            if mount_pvc_api_response is not None and mount_pvc_api_response.status == 200:
-                return True
-            else:
-                raise Exception(f"Error mounting user data directory for user {user_uuid}: {mount_pvc_api_response}")
+        if mount_pvc_api_response is not None and mount_pvc_api_response.status == 200:
+            return True
+        else:
+            raise Exception(f"Error mounting user data directory for user {user_uuid}: {mount_pvc_api_response}")
     except ApiException as e:
         logger.error(f"Error mounting user data directory for user {user_uuid}: {e}")
         raise e
@@ -266,50 +477,48 @@ def unmount_user_data_dir_hosted(user_uuid: str):
     Unmount the user data directory for the hosted deployment type
     """
     try:
-        # Load the kubernetes config
-        config.load_incluster_config()
-        # Enter a context with an instance of the API kubernetes.client
-        with client.CoreV1Api() as api_instance:
-            # Get the current pod name
-            current_pod_name = os.environ.get("POD_NAME", None)
-            if current_pod_name is None:
-                raise Exception("POD_NAME is not set, this is not running a kubernetes pod")
-            
-            # Get the current pod
-            current_pod = api_instance.read_namespaced_pod(
-                name=current_pod_name,
-                namespace="idapt"
-            )
-            logger.debug(f" current_pod: {current_pod}")
-            # Get the list of current volumes mounted in the pod
-            current_volumes = current_pod.spec.volumes
-            logger.debug(f" current_volumes: {current_volumes}")
-            # Get the list of current volume mounts in the pod
-            current_volume_mounts = current_pod.spec.containers[0].volume_mounts
-            logger.debug(f" current_volume_mounts: {current_volume_mounts}")
-            # Remove the volume mount for this user from the list of current volume mounts
-            current_volume_mounts_without_this_user = [volume_mount for volume_mount in current_volume_mounts if volume_mount.name != f"user-data-{user_uuid}"]
-            logger.debug(f" current_volume_mounts after removing the user data directory volume mount: {current_volume_mounts_without_this_user}")
-            # Remove the volume for this user from the list of current volumes
-            current_volumes_without_this_user = [volume for volume in current_volumes if volume.name != f"user-data-{user_uuid}"]
-            logger.debug(f" current_volumes after removing the user data directory volume: {current_volumes_without_this_user}")
-
-            # Unbind the pvc from the pod, only include the fields that are needed to be patched
-            api_instance.patch_namespaced_pod(
-                name=f"{current_pod_name}",
-                namespace="idapt",
-                body=client.V1Pod(
-                    spec=client.V1PodSpec(
-                        volumes=current_volumes_without_this_user,
-                        containers=[
-                            client.V1Container(
-                                name=f"idapt-backend",
-                                volume_mounts=current_volume_mounts_without_this_user # Keep the volume_mounts
-                            )
-                        ]
-                    )
+        # Get the kubernetes API client shared by this worker
+        api_instance = get_kubernetes_core_v1_api()
+        # Get the current pod name
+        current_pod_name = os.environ.get("POD_NAME", None)
+        if current_pod_name is None:
+            raise Exception("POD_NAME is not set, this is not running a kubernetes pod")
+        
+        # Get the current pod
+        current_pod = api_instance.read_namespaced_pod(
+            name=current_pod_name,
+            namespace="idapt"
+        )
+        logger.debug(f" current_pod: {current_pod}")
+        # Get the list of current volumes mounted in the pod
+        current_volumes = current_pod.spec.volumes
+        logger.debug(f" current_volumes: {current_volumes}")
+        # Get the list of current volume mounts in the pod
+        current_volume_mounts = current_pod.spec.containers[0].volume_mounts
+        logger.debug(f" current_volume_mounts: {current_volume_mounts}")
+        # Remove the volume mount for this user from the list of current volume mounts
+        current_volume_mounts_without_this_user = [volume_mount for volume_mount in current_volume_mounts if volume_mount.name != f"user-data-{user_uuid}"]
+        logger.debug(f" current_volume_mounts after removing the user data directory volume mount: {current_volume_mounts_without_this_user}")
+        # Remove the volume for this user from the list of current volumes
+        current_volumes_without_this_user = [volume for volume in current_volumes if volume.name != f"user-data-{user_uuid}"]
+        logger.debug(f" current_volumes after removing the user data directory volume: {current_volumes_without_this_user}")
+
+        # Unbind the pvc from the pod, only include the fields that are needed to be patched
+        api_instance.patch_namespaced_pod(
+            name=f"{current_pod_name}",
+            namespace="idapt",
+            body=client.V1Pod(
+                spec=client.V1PodSpec(
+                    volumes=current_volumes_without_this_user,
+                    containers=[
+                        client.V1Container(
+                            name=f"idapt-backend",
+                            volume_mounts=current_volume_mounts_without_this_user # Keep the volume_mounts
+                        )
+                    ]
                 )
             )
+        )
     except Exception as e:
         logger.error(f"Error unmounting user data directory for user {user_uuid}: {e}")
         raise e
@@ -327,22 +536,40 @@ def unmount_user_data_dir_self_hosted(user_uuid: str):
             
 def get_kubernetes_config():
     """
-    Get the kubernetes config
+    Get the kubernetes config to use the API server at KUBERNETES_API_HOST
     """
     try:
         configuration = client.Configuration()
-        # Configure API key authorization: BearerToken
+        # Configure API key authorization: BearerToken, a local fake API server does not need it
         kubernetes_pod_service_account_token = os.environ.get("KUBERNETES_POD_SERVICE_ACCOUNT_TOKEN", None)
-        if kubernetes_pod_service_account_token is None:
-            raise Exception("KUBERNETES_POD_SERVICE_ACCOUNT_TOKEN is not set, it is needed when using the hosted deployment type")
-        configuration.api_key['authorization'] = kubernetes_pod_service_account_token
-        # Uncomment below to setup prefix (e.g. Bearer) for API key, if needed
-        # configuration.api_key_prefix['authorization'] = 'Bearer'
+        if kubernetes_pod_service_account_token is not None:
+            configuration.api_key['authorization'] = kubernetes_pod_service_account_token
+            configuration.api_key_prefix['authorization'] = 'Bearer'
 
         # Defining host is optional and default to http://localhost
-        configuration.host = "http://localhost"
+        configuration.host = KUBERNETES_API_HOST or "http://localhost"
         
         return configuration
     except Exception as e:
         logger.error(f"Error getting kubernetes config: {e}")
         raise e
+
+def get_kubernetes_core_v1_api() -> client.CoreV1Api:
+    """
+    Get the kubernetes API client of this worker, the configuration is loaded and the client created only once
+    """
+    global kubernetes_core_v1_api
+    with kubernetes_core_v1_api_lock:
+        if kubernetes_core_v1_api is None:
+            try:
+                if KUBERNETES_API_HOST is not None:
+                    configuration = get_kubernetes_config()
+                else:
+                    # Load the in cluster service account config
+                    config.load_incluster_config()
+                    configuration = client.Configuration.get_default_copy()
+                kubernetes_core_v1_api = client.CoreV1Api(client.ApiClient(configuration))
+            except Exception as e:
+                logger.error(f"Error creating kubernetes API client: {e}")
+                raise e
+        return kubernetes_core_v1_api
@@ -0,0 +1,157 @@
+import os
+import time
+import fcntl
+import asyncio
+import hashlib
+from enum import Enum
+from contextlib import contextmanager, asynccontextmanager
+
+import logging
+logger = logging.getLogger("uvicorn")
+
+DATA_FOLDER_PATH = "/data"
+# The user scope lock is outside of the user data directory so that it can be taken before the directory is mounted
+USER_DATA_DIR_LOCK_PATH = "/data/{user_uuid}.lock"
+# The finer grained scopes locks are in a hidden directory so that they are not listed as user data directories
+USER_DATA_SCOPE_LOCKS_DIR_PATH = "/data/.locks/{user_uuid}"
+USER_DATA_SCOPE_LOCK_PATH = USER_DATA_SCOPE_LOCKS_DIR_PATH + "/{scope_id}.lock"
+
+DEFAULT_LOCK_TIMEOUT_SECONDS = 15
+# Polling interval bounds while waiting for a lock held by another request or worker
+LOCK_POLL_MIN_INTERVAL_SECONDS = 0.005
+LOCK_POLL_MAX_INTERVAL_SECONDS = 0.1
+
+class LockMode(str, Enum):
+    SHARED = "shared"
+    EXCLUSIVE = "exclusive"
+
+class UserDataLockTimeout(Exception):
+    pass
+
+class UserDataLock:
+    """
+    Interprocess shared / exclusive lock on a lock file based on flock.
+    Each instance opens its own file descriptor so that locks taken by different requests of the same worker also exclude each other.
+    """
+    def __init__(self, lock_path: str):
+        self.lock_path = lock_path
+        self._fd: int | None = None
+
+    def _open(self) -> int:
+        os.makedirs(os.path.dirname(self.lock_path), exist_ok=True)
+        return os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+
+    def _try_lock(self, mode: LockMode) -> bool:
+        operation = fcntl.LOCK_EX if mode == LockMode.EXCLUSIVE else fcntl.LOCK_SH
+        try:
+            fcntl.flock(self._fd, operation | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
+
+    def acquire(self, mode: LockMode = LockMode.SHARED, timeout: float = DEFAULT_LOCK_TIMEOUT_SECONDS) -> None:
+        """Acquire the lock blocking the current thread, to be used outside of an event loop"""
+        if self._fd is not None:
+            raise Exception(f"Lock {self.lock_path} is already acquired")
+        self._fd = self._open()
+        deadline = time.monotonic() + timeout
+        poll_interval = LOCK_POLL_MIN_INTERVAL_SECONDS
+        while not self._try_lock(mode):
+            if time.monotonic() >= deadline:
+                self._close()
+                raise UserDataLockTimeout(f"Timeout acquiring {mode.value} lock {self.lock_path}")
+            time.sleep(poll_interval)
+            poll_interval = min(poll_interval * 2, LOCK_POLL_MAX_INTERVAL_SECONDS)
+
+    async def aacquire(self, mode: LockMode = LockMode.SHARED, timeout: float = DEFAULT_LOCK_TIMEOUT_SECONDS) -> None:
+        """Acquire the lock without blocking the event loop while waiting for it"""
+        if self._fd is not None:
+            raise Exception(f"Lock {self.lock_path} is already acquired")
+        self._fd = self._open()
+        deadline = time.monotonic() + timeout
+        poll_interval = LOCK_POLL_MIN_INTERVAL_SECONDS
+        try:
+            while not self._try_lock(mode):
+                if time.monotonic() >= deadline:
+                    raise UserDataLockTimeout(f"Timeout acquiring {mode.value} lock {self.lock_path}")
+                await asyncio.sleep(poll_interval)
+                poll_interval = min(poll_interval * 2, LOCK_POLL_MAX_INTERVAL_SECONDS)
+        except BaseException:
+            # Also release the file descriptor if the request is cancelled while waiting
+            self._close()
+            raise
+
+    def release(self) -> None:
+        """Release the lock, closing the file descriptor releases the flock"""
+        if self._fd is None:
+            return
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        finally:
+            self._close()
+
+    def _close(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+def get_user_data_lock_path(user_uuid: str, scope: str | None = None) -> str:
+    """Get the lock file path of the user scope or of a finer grained scope of the user data"""
+    if scope is None:
+        return USER_DATA_DIR_LOCK_PATH.format(user_uuid=user_uuid)
+    scope_id = hashlib.sha256(scope.encode()).hexdigest()
+    return USER_DATA_SCOPE_LOCK_PATH.format(user_uuid=user_uuid, scope_id=scope_id)
+
+def get_datasource_lock_scope(datasource_identifier: str) -> str:
+    """Get the lock scope of a whole datasource"""
+    return f"datasource:{datasource_identifier}"
+
+def get_file_lock_scope(datasource_identifier: str, original_path: str) -> str:
+    """Get the lock scope of a single file or folder of a datasource"""
+    return f"file:{datasource_identifier}:{original_path.rstrip('/')}"
+
+def get_keys_lock_scope() -> str:
+    """Get the lock scope of the key chain of the user, held exclusively while the kek_p is created or rotated"""
+    return "keys"
+
+
+@asynccontextmanager
+async def user_data_lock(user_uuid: str, scope: str | None = None, mode: LockMode = LockMode.SHARED, timeout: float = DEFAULT_LOCK_TIMEOUT_SECONDS):
+    """
+    Hold a lock on the user data or on a scope of it for the duration of the context.
+    A scope lock is always taken under a shared user lock so that the user data directory can't be unmounted while it is held.
+    Shared locks are held concurrently, an exclusive lock waits for all the other holders of the same scope.
+    """
+    locks: list[UserDataLock] = []
+    try:
+        if scope is not None:
+            user_lock = UserDataLock(get_user_data_lock_path(user_uuid))
+            await user_lock.aacquire(LockMode.SHARED, timeout)
+            locks.append(user_lock)
+        lock = UserDataLock(get_user_data_lock_path(user_uuid, scope))
+        await lock.aacquire(mode, timeout)
+        locks.append(lock)
+        yield
+    finally:
+        for lock in reversed(locks):
+            lock.release()
+
+@contextmanager
+def user_data_lock_sync(user_uuid: str, scope: str | None = None, mode: LockMode = LockMode.SHARED, timeout: float = DEFAULT_LOCK_TIMEOUT_SECONDS):
+    """
+    Same as user_data_lock for the code running outside of an event loop
+    """
+    locks: list[UserDataLock] = []
+    try:
+        if scope is not None:
+            user_lock = UserDataLock(get_user_data_lock_path(user_uuid))
+            user_lock.acquire(LockMode.SHARED, timeout)
+            locks.append(user_lock)
+        lock = UserDataLock(get_user_data_lock_path(user_uuid, scope))
+        lock.acquire(mode, timeout)
+        locks.append(lock)
+        yield
+    finally:
+        for lock in reversed(locks):
+            lock.release()
@@ -12,11 +12,14 @@ class StatusWebSocket:
         self,
         websocket: WebSocket,
         status_getter: Union[Callable[[], Any], Callable[[], Awaitable[Any]]],
-        interval: float = 2.0
+        interval: float = 2.0,
+        wait_for_change: Callable[[], Awaitable[None]] | None = None
     ):
         self.websocket = websocket
         self.status_getter = status_getter
         self.interval = interval
+        # Waits until the status changes instead of getting it at every interval when the status is pushed
+        self.wait_for_change = wait_for_change
         self._task = None
         self._closing = False
         self._is_async = inspect.iscoroutinefunction(status_getter)
@@ -52,7 +55,10 @@ class StatusWebSocket:
                     if current_status != prev_status:
                         await self.websocket.send_json(current_status)
                         prev_status = current_status
-                    await asyncio.sleep(self.interval)
+                    if self.wait_for_change:
+                        await self.wait_for_change()
+                    else:
+                        await asyncio.sleep(self.interval)
                 except WebSocketDisconnect:
                     break
         except asyncio.CancelledError:
@@ -1,8 +1,9 @@
 from app.auth.service import oauth2_scheme, get_keyring_with_access_sk_token
 from app.auth.schemas import Keyring
 from app.api.mount_user_data_dir import mount_user_data_dir_dependency
-from typing import Annotated, Generator
+from typing import Annotated, AsyncGenerator
 from fastapi import Depends, HTTPException
+from fastapi.concurrency import run_in_threadpool
 import jwt
 
 from app.auth.service import SECRET_KEY, ALGORITHM
@@ -26,18 +27,19 @@ def get_user_uuid_from_token(token: Annotated[str, Depends(oauth2_scheme)]) -> s
         raise HTTPException(status_code=500, detail="Error getting user UUID from token")
 
 
-def get_keyring_with_user_data_mounting_dependency(
+async def get_keyring_with_user_data_mounting_dependency(
     token: Annotated[str, Depends(oauth2_scheme)],
     user_uuid: Annotated[str, Depends(get_user_uuid_from_token)]
-) -> Generator[Keyring, None, None]:
+) -> AsyncGenerator[Keyring, None]:
     """
     Get the keyring with the token from the auth header
+    The user data directory is kept mounted with a shared lock so that the requests of a user run concurrently
     """
     try:
         # Mount the user data directory
-        with mount_user_data_dir_dependency(user_uuid):
-            # Get the keyring
-            keyring = get_keyring_with_access_sk_token(token)
+        async with mount_user_data_dir_dependency(user_uuid):
+            # Get the keyring, reading the key files is blocking
+            keyring = await run_in_threadpool(get_keyring_with_access_sk_token, token)
             yield keyring
     except Exception as e:
         logger.error(f"Error getting keyring with user data mounting dependency: {e}")
@@ -0,0 +1,53 @@
+import os
+import asyncio
+import base64
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+
+import logging
+logger = logging.getLogger("uvicorn")
+
+# Maximum number of key derivations running at the same time in this worker, the others wait in the executor queue
+KEY_DERIVATION_MAX_CONCURRENCY = int(os.environ.get("KEY_DERIVATION_MAX_CONCURRENCY", 2))
+PBKDF2_ITERATIONS = 100000
+
+# Created on first use so that importing this module does not spawn processes
+key_derivation_executor: ProcessPoolExecutor | None = None
+
+def derive_mk_from_password(user_uuid: str, password: str) -> bytes:
+    """
+    Derive the master key from the password with PBKDF2, it is a pure cpu bound function that can run in another process
+    """
+    # Use PBKDF2 to derive a 32-byte key from the password
+    user_specific_salt = user_uuid.encode() + 'static_salt_part'.encode()
+    kdf = PBKDF2HMAC(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=user_specific_salt,
+        iterations=PBKDF2_ITERATIONS,
+    )
+    # Derive the key and encode it properly for Fernet usage
+    key = kdf.derive(password.encode())
+    return base64.urlsafe_b64encode(key)
+
+def get_key_derivation_executor() -> ProcessPoolExecutor:
+    """
+    Get the process pool dedicated to key derivation
+    """
+    global key_derivation_executor
+    if key_derivation_executor is None:
+        # Spawn instead of fork as the uvicorn workers are multi threaded
+        key_derivation_executor = ProcessPoolExecutor(
+            max_workers=KEY_DERIVATION_MAX_CONCURRENCY,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+    return key_derivation_executor
+
+async def aderive_mk_from_password(user_uuid: str, password: str) -> bytes:
+    """
+    Derive the master key from the password in the key derivation process pool without blocking the event loop
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_key_derivation_executor(), derive_mk_from_password, user_uuid, password)
@@ -0,0 +1,126 @@
+import os
+import base64
+import hashlib
+import shutil
+import tempfile
+from cryptography.fernet import Fernet, InvalidToken
+
+from app.auth.schemas import Keyring
+from app.api.metrics import get_counter
+
+import logging
+logger = logging.getLogger("uvicorn")
+
+# The cache is stored in shared memory so that all the uvicorn workers of this host can reuse the keyrings unwrapped by the others
+# Each entry is encrypted with a key derived from the access token itself so that the cache is useless without the token held by the client
+DEFAULT_KEYRING_CACHE_DIR_PATH = "/dev/shm/idapt_keyring_cache" if os.path.isdir("/dev/shm") else os.path.join(tempfile.gettempdir(), "idapt_keyring_cache")
+KEYRING_CACHE_DIR_PATH = os.environ.get("KEYRING_CACHE_DIR_PATH", DEFAULT_KEYRING_CACHE_DIR_PATH)
+KEYRING_CACHE_USER_DIR_PATH = KEYRING_CACHE_DIR_PATH + "/{user_uuid}"
+KEYRING_CACHE_ENTRY_PATH = KEYRING_CACHE_USER_DIR_PATH + "/{entry_id}"
+KEYRING_CACHE_TTL_SECONDS = int(os.environ.get("KEYRING_CACHE_TTL_SECONDS", 30))
+
+keyring_cache_requests_counter = get_counter(
+    "idapt_keyring_cache_requests_total",
+    "Keyring cache lookups by result",
+    ("result",)
+)
+keyring_cache_invalidations_counter = get_counter(
+    "idapt_keyring_cache_invalidations_total",
+    "Keyring cache invalidations by reason",
+    ("reason",)
+)
+
+def _get_entry_id(token: str) -> str:
+    """Get the file name of the cache entry for this token, it is not usable to decrypt the entry"""
+    return hashlib.sha256(b"idapt_keyring_cache_entry_id:" + token.encode()).hexdigest()
+
+def _get_entry_fernet(token: str) -> Fernet:
+    """Get the fernet used to encrypt the cache entry of this token"""
+    entry_key = hashlib.sha256(b"idapt_keyring_cache_entry_key:" + token.encode()).digest()
+    return Fernet(base64.urlsafe_b64encode(entry_key))
+
+def get_cached_keyring(token: str, user_uuid: str) -> Keyring | None:
+    """
+    Get the keyring cached by any worker of this host for this token.
+    Returns None if there is no valid entry for this token.
+    """
+    entry_path = KEYRING_CACHE_ENTRY_PATH.format(user_uuid=user_uuid, entry_id=_get_entry_id(token))
+    try:
+        with open(entry_path, "rb") as f:
+            encrypted_entry = f.read()
+    except FileNotFoundError:
+        keyring_cache_requests_counter.inc(result="miss")
+        return None
+    except Exception as e:
+        logger.error(f"Error reading keyring cache entry for user {user_uuid}: {e}")
+        keyring_cache_requests_counter.inc(result="miss")
+        return None
+
+    try:
+        # The fernet token timestamp is used to expire the entry
+        keyring_json = _get_entry_fernet(token).decrypt(encrypted_entry, ttl=KEYRING_CACHE_TTL_SECONDS)
+        keyring = Keyring.model_validate_json(keyring_json)
+        if keyring.user_uuid != user_uuid:
+            raise InvalidToken()
+        keyring_cache_requests_counter.inc(result="hit")
+        return keyring
+    except InvalidToken:
+        # Expired or unreadable entry, remove it so that it is recreated by the caller
+        keyring_cache_requests_counter.inc(result="expired")
+        try:
+            os.remove(entry_path)
+        except FileNotFoundError:
+            pass
+        return None
+
+def set_cached_keyring(token: str, keyring: Keyring) -> None:
+    """
+    Store the keyring unwrapped with this token in the host shared cache
+    """
+    try:
+        user_dir_path = KEYRING_CACHE_USER_DIR_PATH.format(user_uuid=keyring.user_uuid)
+        os.makedirs(user_dir_path, mode=0o700, exist_ok=True)
+        encrypted_entry = _get_entry_fernet(token).encrypt(keyring.model_dump_json().encode())
+        # Write to a temporary file and swap it so that other workers never read a partial entry
+        fd, tmp_entry_path = tempfile.mkstemp(dir=user_dir_path, prefix=".tmp_")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(encrypted_entry)
+            os.replace(tmp_entry_path, KEYRING_CACHE_ENTRY_PATH.format(user_uuid=keyring.user_uuid, entry_id=_get_entry_id(token)))
+        except Exception:
+            if os.path.exists(tmp_entry_path):
+                os.remove(tmp_entry_path)
+            raise
+    except Exception as e:
+        # The cache is only an optimization, never fail the request because of it
+        logger.error(f"Error storing keyring cache entry for user {keyring.user_uuid}: {e}")
+
+def invalidate_cached_keyring(token: str, user_uuid: str, reason: str = "logout") -> None:
+    """
+    Remove the cached keyring of this token for all the workers of this host
+    """
+    try:
+        os.remove(KEYRING_CACHE_ENTRY_PATH.format(user_uuid=user_uuid, entry_id=_get_entry_id(token)))
+        keyring_cache_invalidations_counter.inc(reason=reason)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.error(f"Error invalidating keyring cache entry for user {user_uuid}: {e}")
+
+def invalidate_user_cached_keyrings(user_uuid: str, reason: str = "kek_p_rotation") -> None:
+    """
+    Remove all the cached keyrings of this user for all the workers of this host
+    """
+    try:
+        shutil.rmtree(KEYRING_CACHE_USER_DIR_PATH.format(user_uuid=user_uuid), ignore_errors=False)
+        keyring_cache_invalidations_counter.inc(reason=reason)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.error(f"Error invalidating keyring cache entries for user {user_uuid}: {e}")
+
+def get_keyring_cache_hit_rate() -> float:
+    """Get the hit rate of the keyring cache lookups done by this worker"""
+    hits = keyring_cache_requests_counter.get(result="hit")
+    total = hits + keyring_cache_requests_counter.get(result="miss") + keyring_cache_requests_counter.get(result="expired")
+    return hits / total if total else 0.0
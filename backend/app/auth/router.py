@@ -3,11 +3,14 @@ from datetime import timedelta
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi.routing import APIRouter
 from fastapi import Depends, HTTPException, status
+from fastapi.concurrency import run_in_threadpool
 import re
 
-from app.auth.service import register_new_user, get_new_access_sk_token_with_password, create_jwt_access_token, ACCESS_TOKEN_EXPIRE_MINUTES, delete_user
+from app.auth.service import register_new_user, get_new_access_sk_token_with_mk, aget_mk_from_password, create_jwt_access_token, ACCESS_TOKEN_EXPIRE_MINUTES, delete_user, revoke_access_sk_token, oauth2_scheme
 from app.auth.schemas import Token, Keyring, RegisterRequest
 from app.auth.dependencies import get_keyring_with_user_data_mounting_dependency, mount_user_data_dir_dependency
+from app.api.mount_user_data_dir import schedule_user_data_dir_premount
+from app.api.user_data_locks import LockMode, user_data_lock, get_keys_lock_scope
 
 auth_router = r = APIRouter()
 
@@ -53,10 +56,16 @@ async def login_for_access_sk_token_route(
             headers={"WWW-Authenticate": "Bearer"},
         )
     
-    # Mount the user data directory only for the login attempt, it will be unmounted after the login and remounted as a dependency for subsequent requests
-    with mount_user_data_dir_dependency(user_uuid):
-        # Get the token data
-        token_data = get_new_access_sk_token_with_password(user_uuid, hashed_password)
+    # Start mounting the user data directory in the background while the master key is derived from the password
+    schedule_user_data_dir_premount(user_uuid)
+    mk = await aget_mk_from_password(user_uuid, hashed_password)
+
+    # Wait for the mount in progress, the user data directory then stays mounted for the requests following the login
+    async with mount_user_data_dir_dependency(user_uuid):
+        # Get the token data, the kek_p rotation file operations run in the threadpool
+        # The concurrent logins of the user from other tabs or workers rotate the kek_p one after the other
+        async with user_data_lock(user_uuid, scope=get_keys_lock_scope(), mode=LockMode.EXCLUSIVE):
+            token_data = await run_in_threadpool(get_new_access_sk_token_with_mk, user_uuid, mk)
         if not token_data:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
@@ -82,7 +91,11 @@ async def register_route(
     """
     Register a new user
     """
-    token_data = register_new_user(register_request.user_uuid, register_request.hashed_password)
+    # Derive the master key off the event loop and register the user in the threadpool
+    mk = await aget_mk_from_password(register_request.user_uuid, register_request.hashed_password)
+    # A concurrent registration or login of the same user waits for the key chain to be created
+    async with user_data_lock(register_request.user_uuid, scope=get_keys_lock_scope(), mode=LockMode.EXCLUSIVE):
+        token_data = await run_in_threadpool(register_new_user, register_request.user_uuid, register_request.hashed_password, mk)
     if not token_data:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -100,6 +113,16 @@ async def register_route(
     )
     return Token(access_token=access_token, token_type="bearer")
     
+@r.post("/logout", status_code=status.HTTP_204_NO_CONTENT)
+async def logout_route(
+    token: Annotated[str, Depends(oauth2_scheme)],
+    keyring: Annotated[Keyring, Depends(get_keyring_with_user_data_mounting_dependency)],
+):
+    """
+    Logout the current session, the token can't be used anymore after this
+    """
+    await run_in_threadpool(revoke_access_sk_token, token)
+
 @r.delete("/delete", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_user_route(
     user_uuid: str,
@@ -6,15 +6,15 @@ from jwt.exceptions import InvalidTokenError
 from cryptography.fernet import Fernet
 import logging
 import os
-import base64
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from fastapi.concurrency import run_in_threadpool
 import uuid
 import shutil
-from cachetools.func import ttl_cache
 
 from app.api.fernet_stored_encryption_key import FernetStoredEncryptionKey
 from app.auth.schemas import AccessSKTokenData, Keyring
+from app.auth.key_derivation import derive_mk_from_password, aderive_mk_from_password
+from app.auth.keyring_cache import get_cached_keyring, set_cached_keyring, invalidate_cached_keyring, invalidate_user_cached_keyrings
+from app.auth.session_keys import get_session_index_lock, load_session_index, save_session_index, get_session_entry, add_session_entry, remove_session_entry, session_exists
 
 logger = logging.getLogger("uvicorn")
 
@@ -40,10 +40,6 @@ DATA_FOLDER_PATH = "/data"
 USER_DATA_FOLDER_PATH = "/data/{user_uuid}"
 USER_UUID_TEST_FILE_PATH = "/data/{user_uuid}/keys/user_uuid_test.txt"
 KEK_P_MK_PATH = "/data/{user_uuid}/keys/kek_p_mk.txt"
-SK_DIR_PATH = "/data/{user_uuid}/keys/session_keys"
-SK_KEK_P_PATH_TEMPLATE = "/data/{user_uuid}/keys/session_keys/sk_kek_p_{sk_uuid}.txt"
-KEK_S_PATH_TEMPLATE = "/data/{user_uuid}/keys/session_keys/kek_s_{sk_uuid}.txt"
-KEK_P_KEK_S_PATH_TEMPLATE = "/data/{user_uuid}/keys/session_keys/kek_p_kek_s_{sk_uuid}.txt"
 
 
 KEK_DATASOURCES_KEK_P_PATH = "/data/{user_uuid}/keys/kek_datasources.txt"
@@ -62,9 +58,10 @@ def create_jwt_access_token(data: dict, expires_delta: timedelta):
         logger.error(f"Error creating JWT access token: {e}")
         raise HTTPException(status_code=500, detail="Error creating JWT access token")
 
-def register_new_user(user_uuid: str, hashed_password: str) -> AccessSKTokenData:
+def register_new_user(user_uuid: str, hashed_password: str, mk: bytes | None = None) -> AccessSKTokenData:
     """
     Register a new user
+    The mk can be given if it has already been derived from the password off the event loop
     """
     try:
         # TODO Implement a register flow with admin token for the hosted version so that we can control user registration
@@ -80,7 +77,8 @@ def register_new_user(user_uuid: str, hashed_password: str) -> AccessSKTokenData
         logger.info(f"Creating new kek_p for user {user_uuid}")
 
         # Get the master key from the password
-        mk = get_mk_from_password(user_uuid, hashed_password)  
+        if mk is None:
+            mk = get_mk_from_password(user_uuid, hashed_password)
 
         # Create the user data folder
         os.makedirs(USER_DATA_FOLDER_PATH.format(user_uuid=user_uuid), exist_ok=True)
@@ -98,8 +96,8 @@ def register_new_user(user_uuid: str, hashed_password: str) -> AccessSKTokenData
             overwrite_safely=True
         )
 
-        # Get a new session key with the password
-        token_data = get_new_access_sk_token_with_password(user_uuid, hashed_password)
+        # Get a new session key with the already derived master key
+        token_data = get_new_access_sk_token_with_mk(user_uuid, mk)
 
         # Return the token data
         return token_data
@@ -119,11 +117,26 @@ def get_new_access_sk_token_with_password(user_uuid: str, hashed_password: str)
     Get a new session key with the password.
     Each time this is called the kek_p is rotated with all other keys encrypted with it (sk_*, keyring_json) and that decrypt it (kek_p_mk, kek_p_kek_s_*)
     """
-    try:
-        logger.info(f"Getting new access sk token with password for user {user_uuid}")
-        # Get the master key from the password
-        mk = get_mk_from_password(user_uuid, hashed_password)  
+    logger.info(f"Getting new access sk token with password for user {user_uuid}")
+    # Get the master key from the password
+    mk = get_mk_from_password(user_uuid, hashed_password)
+    return get_new_access_sk_token_with_mk(user_uuid, mk)
 
+async def aget_new_access_sk_token_with_password(user_uuid: str, hashed_password: str) -> AccessSKTokenData:
+    """
+    Get a new session key with the password without blocking the event loop.
+    The master key is derived in the key derivation process pool and the kek_p rotation file operations run in the threadpool
+    """
+    logger.info(f"Getting new access sk token with password for user {user_uuid}")
+    mk = await aget_mk_from_password(user_uuid, hashed_password)
+    return await run_in_threadpool(get_new_access_sk_token_with_mk, user_uuid, mk)
+
+def get_new_access_sk_token_with_mk(user_uuid: str, mk: bytes) -> AccessSKTokenData:
+    """
+    Get a new session key with the master key derived from the password.
+    Each time this is called the kek_p is rotated with all other keys encrypted with it (sk_*, keyring_json) and that decrypt it (kek_p_mk, kek_p_kek_s_*)
+    """
+    try:
         # Check if the kek_p_mk file exists
         kek_p_mk_path = KEK_P_MK_PATH.format(user_uuid=user_uuid)
         if not os.path.exists(kek_p_mk_path):
@@ -161,12 +174,11 @@ def get_new_access_sk_token_with_password(user_uuid: str, hashed_password: str)
         else:
             raise HTTPException(status_code=500, detail="Error getting new access sk token with password")
 
-@ttl_cache(maxsize=512, ttl=30)
 def get_keyring_with_access_sk_token(token: str) -> Keyring:
     """
     Get the keyring with the token
-    The keyring is cached for 30 seconds to avoid re-reading and decrypting the keyring from the disk and reuse the same keyring
-    Only in the case of a keyring dek rotation we need to invalidate the cache TODO
+    The keyring is cached in the host shared keyring cache so that the unwrap chain is done once per session for all the workers
+    The cache is invalidated on kek_p rotation and logout
     """
     try:
 
@@ -184,6 +196,11 @@ def get_keyring_with_access_sk_token(token: str) -> Keyring:
             sk_str=sk_str
         )
 
+        # Reuse the keyring already unwrapped by any worker of this host for this token
+        cached_keyring = get_cached_keyring(token=token, user_uuid=user_uuid)
+        if cached_keyring is not None:
+            return cached_keyring
+
         # Check if the user exists
         if not os.path.exists(USER_DATA_FOLDER_PATH.format(user_uuid=user_uuid)) or not os.path.exists(USER_UUID_TEST_FILE_PATH.format(user_uuid=user_uuid)):
             raise Exception("Invalid token")
@@ -200,6 +217,9 @@ def get_keyring_with_access_sk_token(token: str) -> Keyring:
         # Decrypt the keyring with the kek_p
         keyring = get_keyring_with_kek_p(user_uuid=user_uuid, kek_p=kek_p)
 
+        # Share the unwrapped keyring with the other workers
+        set_cached_keyring(token=token, keyring=keyring)
+
         # Return the keyring
         return keyring
 
@@ -217,18 +237,15 @@ def get_keyring_with_access_sk_token(token: str) -> Keyring:
 def get_mk_from_password(user_uuid: str, password: str) -> bytes:
     """Convert a password into a master key that can be used as a Fernet key"""
     try:
-        # Use PBKDF2 to derive a 32-byte key from the password
-        user_specific_salt = user_uuid.encode() + 'static_salt_part'.encode()
-        kdf = PBKDF2HMAC(
-            algorithm=hashes.SHA256(),
-            length=32,
-            salt=user_specific_salt,
-            iterations=100000,
-        )
-        # Derive the key and encode it properly for Fernet usage
-        key = kdf.derive(password.encode())
-        mk = base64.urlsafe_b64encode(key)
-        return mk
+        return derive_mk_from_password(user_uuid, password)
+    except Exception as e:
+        logger.error(f"Error getting mk from password: {e}")
+        raise HTTPException(status_code=500, detail="Error getting mk from password")
+
+async def aget_mk_from_password(user_uuid: str, password: str) -> bytes:
+    """Convert a password into a master key in the key derivation process pool to not block the event loop"""
+    try:
+        return await aderive_mk_from_password(user_uuid, password)
     except Exception as e:
         logger.error(f"Error getting mk from password: {e}")
         raise HTTPException(status_code=500, detail="Error getting mk from password")
@@ -236,49 +253,36 @@ def get_mk_from_password(user_uuid: str, password: str) -> bytes:
 
 def create_new_sk_with_kek_p(user_uuid: str, kek_p: bytes) -> tuple[str, bytes]:
     """
-    Creates a new session key and store it with the kek_p.
+    Creates a new session key and store it with the kek_p in the session index.
     Returns the sk uuid and the sk.
     """
     try:
         logger.info(f"Creating new sk with kek_p for user {user_uuid}")
         # Generate a new session key uuid that does not already exist
         sk_uuid = None
-        while sk_uuid is None or os.path.exists(SK_KEK_P_PATH_TEMPLATE.format(user_uuid=user_uuid, sk_uuid=sk_uuid)):
+        while sk_uuid is None or session_exists(user_uuid=user_uuid, sk_uuid=sk_uuid):
             sk_uuid = str(uuid.uuid4())
 
-        # Generate a random new session key and store it with the kek_p into sk_kek_p_{sk_uuid}
-        sk = FernetStoredEncryptionKey.create_new_random_key_and_store_it(
-            stored_key_path=SK_KEK_P_PATH_TEMPLATE.format(user_uuid=user_uuid, sk_uuid=sk_uuid),
-            kek=kek_p
-        )
-
-        # Create a new kek_s for this session key and store it encrypted with the session key into kek_s_{sk_uuid}
-        kek_s = FernetStoredEncryptionKey.create_new_random_key_and_store_it(
-            stored_key_path=KEK_S_PATH_TEMPLATE.format(user_uuid=user_uuid, sk_uuid=sk_uuid),
-            kek=sk
-        )
-        # Encrypt the kek_p in a new kek_p_kek_s for this sk so that we can access the kek_p using the sk into kek_p_kek_s_{sk_uuid}
-        kek_p_kek_s = FernetStoredEncryptionKey.store_encrypted_key_at_path(
-            key=kek_p,
-            kek=kek_s,
-            stored_key_path=KEK_P_KEK_S_PATH_TEMPLATE.format(user_uuid=user_uuid, sk_uuid=sk_uuid),
-            overwrite_safely=True
-        )
+        # Generate a random new session key, a kek_s for it and wrap them
+        # sk_kek_p is the sk encrypted with the kek_p, kek_s_sk the kek_s encrypted with the sk and kek_p_kek_s the kek_p encrypted with the kek_s
+        sk = Fernet.generate_key()
+        kek_s = Fernet.generate_key()
+        session_entry = {
+            "sk_kek_p": Fernet(kek_p).encrypt(sk).decode(),
+            "kek_s_sk": Fernet(sk).encrypt(kek_s).decode(),
+            "kek_p_kek_s": Fernet(kek_s).encrypt(kek_p).decode(),
+            "expires_at": (datetime.now() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)).isoformat()
+        }
+        # Test the sk flow to get the kek_p in memory before storing it
+        if _get_kek_p_from_session_entry(session_entry=session_entry, sk=sk) != kek_p:
+            raise Exception("Invalid new session key")
+
+        add_session_entry(user_uuid=user_uuid, sk_uuid=sk_uuid, session_entry=session_entry)
         # Return the sk uuid and the sk
         return sk_uuid, sk
     
     except Exception as e:
         logger.error(f"Error creating new session key: {e}")
-        # Cleanup potentially created files
-        try:
-            if sk_uuid is not None and os.path.exists(SK_KEK_P_PATH_TEMPLATE.format(user_uuid=user_uuid, sk_uuid=sk_uuid)):
-                os.remove(SK_KEK_P_PATH_TEMPLATE.format(user_uuid=user_uuid, sk_uuid=sk_uuid))
-            if kek_s is not None and os.path.exists(KEK_S_PATH_TEMPLATE.format(user_uuid=user_uuid, sk_uuid=sk_uuid)):
-                os.remove(KEK_S_PATH_TEMPLATE.format(user_uuid=user_uuid, sk_uuid=sk_uuid))
-            if kek_p_kek_s is not None and os.path.exists(KEK_P_KEK_S_PATH_TEMPLATE.format(user_uuid=user_uuid, sk_uuid=sk_uuid)):
-                os.remove(KEK_P_KEK_S_PATH_TEMPLATE.format(user_uuid=user_uuid, sk_uuid=sk_uuid))
-        except Exception as e:
-            logger.error(f"Error cleaning up potentially created files: {e}")
         raise HTTPException(status_code=500, detail="Error creating new session key")
 
 def rotate_kek_p(user_uuid: str, old_kek_p: bytes, mk: bytes) -> bytes:
@@ -315,77 +319,16 @@ def rotate_kek_p(user_uuid: str, old_kek_p: bytes, mk: bytes) -> bytes:
         # Test the new kek_p with the user_uuid_test_file
         test_kek_p_with_user_uuid_test_file(user_uuid=user_uuid, kek_p=new_kek_p)
         
-        # For each existing sk, decrypt it and its corresponding kek_s using the old kek_p and encrypt it using the new kek_p
-        # For each file in the session_keys directory, decrypt it using the old kek_p and encrypt it using the new kek_p
-        if os.path.exists(SK_DIR_PATH.format(user_uuid=user_uuid)):
-            for sk_file in os.listdir(SK_DIR_PATH.format(user_uuid=user_uuid)):
-                try:
-                    # If this is a session key file
-                    if sk_file.startswith("sk_kek_p_"):
-                        # Get the sk_uuid from the file name
-                        sk_uuid = sk_file.split("_")[3].split(".")[0]
-                        logger.info(f"Rotating session key {sk_uuid}")
-                        
-                        # Get the required sk info for rotation
-                        # Decrypt the stored sk from sk_kek_p using the old kek_p
-                        # sk is never rotated
-                        sk = FernetStoredEncryptionKey.load_decrypted_stored_key(
-                            stored_key_path=SK_KEK_P_PATH_TEMPLATE.format(user_uuid=user_uuid, sk_uuid=sk_uuid),
-                            kek=old_kek_p
-                        )
-                        # Decrypt the corresponding kek_s using the sk
-                        old_kek_s = FernetStoredEncryptionKey.load_decrypted_stored_key(
-                            stored_key_path=KEK_S_PATH_TEMPLATE.format(user_uuid=user_uuid, sk_uuid=sk_uuid),
-                            kek=sk
-                        )
-                        # Remove the old sk_kek_p
-                        os.remove(SK_KEK_P_PATH_TEMPLATE.format(user_uuid=user_uuid, sk_uuid=sk_uuid))
-                        # Remove the old kek_s
-                        os.remove(KEK_S_PATH_TEMPLATE.format(user_uuid=user_uuid, sk_uuid=sk_uuid))
-                        # Remove the old kek_p_kek_s
-                        os.remove(KEK_P_KEK_S_PATH_TEMPLATE.format(user_uuid=user_uuid, sk_uuid=sk_uuid))
-
-                        # Store the sk using the new kek_p as the encryption key
-                        FernetStoredEncryptionKey.store_encrypted_key_at_path(
-                            key=sk,
-                            kek=new_kek_p,
-                            stored_key_path=SK_KEK_P_PATH_TEMPLATE.format(user_uuid=user_uuid, sk_uuid=sk_uuid),
-                            overwrite_safely=True
-                        )
-                        # Rotate the kek_s using the sk while we are at it
-                        new_kek_s = FernetStoredEncryptionKey.create_new_random_key_and_store_it(
-                            stored_key_path=KEK_S_PATH_TEMPLATE.format(user_uuid=user_uuid, sk_uuid=sk_uuid),
-                            kek=sk,
-                            overwrite_safely=True # Overwrite safely the old kek_s file
-                        )
-
-                        # Create the new kek_p_kek_s file by storing the new_kek_p encrypted with new_kek_s
-                        new_kek_p_kek_s = FernetStoredEncryptionKey.store_encrypted_key_at_path(
-                            key=new_kek_p,
-                            kek=new_kek_s,
-                            stored_key_path=KEK_P_KEK_S_PATH_TEMPLATE.format(user_uuid=user_uuid, sk_uuid=sk_uuid),
-                            overwrite_safely=True
-                        )
-                        # Test the new sk flow to get the kek p and check that it is correct
-                        new_kek_p_got_from_sk = get_kek_p_with_sk(user_uuid=user_uuid, sk_uuid=sk_uuid, sk=sk)
-                        test_kek_p_with_user_uuid_test_file(user_uuid=user_uuid, kek_p=new_kek_p_got_from_sk)
-
-                except Exception as e:
-                    logger.error(f"Error rotating session key {sk_file}: {e}")
-                    # If there is an error, delete this session key
-                    # It should not happen often
-                    if os.path.exists(SK_KEK_P_PATH_TEMPLATE.format(user_uuid=user_uuid, sk_uuid=sk_uuid)):
-                        os.remove(SK_KEK_P_PATH_TEMPLATE.format(user_uuid=user_uuid, sk_uuid=sk_uuid))
-                    if os.path.exists(KEK_S_PATH_TEMPLATE.format(user_uuid=user_uuid, sk_uuid=sk_uuid)):
-                        os.remove(KEK_S_PATH_TEMPLATE.format(user_uuid=user_uuid, sk_uuid=sk_uuid))
-                    if os.path.exists(KEK_P_KEK_S_PATH_TEMPLATE.format(user_uuid=user_uuid, sk_uuid=sk_uuid)):
-                        os.remove(KEK_P_KEK_S_PATH_TEMPLATE.format(user_uuid=user_uuid, sk_uuid=sk_uuid))
-                    raise HTTPException(status_code=500, detail="Error rotating session key")
+        # Re-wrap all the existing sessions with the new kek_p in one batch swapped atomically with the current session index
+        rotate_session_keys_with_kek_p(user_uuid=user_uuid, old_kek_p=old_kek_p, new_kek_p=new_kek_p)
 
         # Everything went well delete the .backup files
         os.remove(KEK_P_MK_PATH.format(user_uuid=user_uuid) + ".backup")
         os.remove(USER_UUID_TEST_FILE_PATH.format(user_uuid=user_uuid) + ".backup")
 
+        # Drop the keyrings cached with the previous kek_p chain
+        invalidate_user_cached_keyrings(user_uuid=user_uuid, reason="kek_p_rotation")
+
         # Return the new kek_p
         return new_kek_p
     
@@ -399,6 +342,60 @@ def rotate_kek_p(user_uuid: str, old_kek_p: bytes, mk: bytes) -> bytes:
         logger.error(f"Error rotating kek_p: {e}")
         raise HTTPException(status_code=500, detail="Error rotating kek_p")
 
+def rotate_session_keys_with_kek_p(user_uuid: str, old_kek_p: bytes, new_kek_p: bytes) -> None:
+    """
+    Re-wrap every session key with the new kek_p and rotate their kek_s.
+    All the sessions are re-wrapped in memory and written in one atomically swapped session index,
+    so the current session keys stay untouched until the whole batch is written.
+    Expired sessions are dropped while we are at it.
+    """
+    try:
+        with get_session_index_lock(user_uuid):
+            sessions = load_session_index(user_uuid)
+            if not sessions:
+                return
+
+            old_kek_p_fernet = Fernet(old_kek_p)
+            new_kek_p_fernet = Fernet(new_kek_p)
+            now = datetime.now()
+            rotated_sessions = {}
+            for sk_uuid, session_entry in sessions.items():
+                try:
+                    if datetime.fromisoformat(session_entry["expires_at"]) < now:
+                        logger.info(f"Dropping expired session key {sk_uuid}")
+                        continue
+                    logger.debug(f"Rotating session key {sk_uuid}")
+                    # Decrypt the stored sk from sk_kek_p using the old kek_p
+                    # sk is never rotated
+                    sk = old_kek_p_fernet.decrypt(session_entry["sk_kek_p"].encode())
+                    # Check that the corresponding kek_s can be decrypted with the sk so that we don't keep broken sessions
+                    Fernet(sk).decrypt(session_entry["kek_s_sk"].encode())
+
+                    # Rotate the kek_s using the sk while we are at it and wrap the new kek_p with it
+                    new_kek_s = Fernet.generate_key()
+                    rotated_session_entry = {
+                        "sk_kek_p": new_kek_p_fernet.encrypt(sk).decode(),
+                        "kek_s_sk": Fernet(sk).encrypt(new_kek_s).decode(),
+                        "kek_p_kek_s": Fernet(new_kek_s).encrypt(new_kek_p).decode(),
+                        "expires_at": session_entry["expires_at"]
+                    }
+                    # Test the new sk flow to get the kek p in memory before writing it
+                    if _get_kek_p_from_session_entry(session_entry=rotated_session_entry, sk=sk) != new_kek_p:
+                        raise Exception("Invalid rotated session key")
+                    rotated_sessions[sk_uuid] = rotated_session_entry
+
+                except Exception as e:
+                    # If there is an error, drop this session key by not writing it in the rotated batch
+                    # It should not happen often
+                    logger.error(f"Error rotating session key {sk_uuid}, dropping it: {e}")
+
+            # Swap the rotated batch with the current session index
+            save_session_index(user_uuid=user_uuid, sessions=rotated_sessions)
+
+    except Exception as e:
+        logger.error(f"Error rotating session keys: {e}")
+        raise HTTPException(status_code=500, detail="Error rotating session keys")
+
 def init_new_keyring_service_keks_if_needed(user_uuid: str, kek_p: bytes) -> None:
     """
     Initializes a new keyring for a user using the master key.
@@ -440,26 +437,28 @@ def init_new_keyring_service_keks_if_needed(user_uuid: str, kek_p: bytes) -> Non
 
 def get_kek_p_with_sk(user_uuid: str, sk_uuid: str, sk: bytes) -> bytes:
     """
-    Decrypts the keyring from the keyring file using the session key provided.
+    Decrypts the kek_p from the session index using the session key provided.
     """
     try:
-        # Decrypt the kek_s with the sk
-        kek_s = FernetStoredEncryptionKey.load_decrypted_stored_key(
-            stored_key_path=KEK_S_PATH_TEMPLATE.format(user_uuid=user_uuid, sk_uuid=sk_uuid),
-            kek=sk
-        )
-
-        # Decrypt the corresponding kek_p_kek_s with the kek_s to get the kek_p
-        kek_p = FernetStoredEncryptionKey.load_decrypted_stored_key(
-            stored_key_path=KEK_P_KEK_S_PATH_TEMPLATE.format(user_uuid=user_uuid, sk_uuid=sk_uuid),
-            kek=kek_s
-        )
+        session_entry = get_session_entry(user_uuid=user_uuid, sk_uuid=sk_uuid)
+        if session_entry is None:
+            # The session has been revoked, pruned or has expired
+            raise HTTPException(status_code=401, detail="Invalid token")
 
-        return kek_p
+        return _get_kek_p_from_session_entry(session_entry=session_entry, sk=sk)
     
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error decrypting keyring with sk: {e}")
         raise HTTPException(status_code=500, detail="Error decrypting keyring with sk")
+
+def _get_kek_p_from_session_entry(session_entry: dict, sk: bytes) -> bytes:
+    """Unwrap the kek_p of a session entry with its sk"""
+    # Decrypt the kek_s with the sk
+    kek_s = Fernet(sk).decrypt(session_entry["kek_s_sk"].encode())
+    # Decrypt the corresponding kek_p_kek_s with the kek_s to get the kek_p
+    return Fernet(kek_s).decrypt(session_entry["kek_p_kek_s"].encode())
     
 def get_keyring_with_kek_p(user_uuid: str, kek_p: bytes) -> Keyring:
     """
@@ -568,9 +567,28 @@ def delete_user(user_uuid: str) -> None:
         # The keyring is valid and user is authenticated so we can delete the user data
         if os.path.exists(USER_DATA_FOLDER_PATH.format(user_uuid=user_uuid)):
             shutil.rmtree(USER_DATA_FOLDER_PATH.format(user_uuid=user_uuid))
+        invalidate_user_cached_keyrings(user_uuid=user_uuid, reason="user_deletion")
     except Exception as e:
         logger.error(f"Error deleting user: {e}")
         raise HTTPException(status_code=500, detail="Error deleting user, user is probably partially deleted")
 
+def revoke_access_sk_token(token: str) -> None:
+    """
+    Revoke the session of the token by removing it from the session index and deleting its cached keyring.
+    """
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        user_uuid: str = payload.get("user_uuid")
+        sk_uuid: str = payload.get("sk_uuid")
+
+        # Invalidate the cached keyring first so that no worker can use the session anymore
+        invalidate_cached_keyring(token=token, user_uuid=user_uuid, reason="logout")
 
+        # Remove the session from the session index so that the sk can't be used to get the kek_p anymore
+        remove_session_entry(user_uuid=user_uuid, sk_uuid=sk_uuid)
 
+    except InvalidTokenError:
+        raise HTTPException(status_code=401, detail="Invalid token", headers={"WWW-Authenticate": "Bearer"})
+    except Exception as e:
+        logger.error(f"Error revoking access sk token: {e}")
+        raise HTTPException(status_code=500, detail="Error revoking access sk token")
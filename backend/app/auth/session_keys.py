@@ -0,0 +1,214 @@
+import os
+import json
+import shutil
+import tempfile
+import asyncio
+import threading
+from datetime import datetime
+from typing import Dict
+from filelock import FileLock
+
+import logging
+logger = logging.getLogger("uvicorn")
+
+DATA_FOLDER_PATH = "/data"
+SESSION_INDEX_PATH = "/data/{user_uuid}/keys/session_keys.json"
+SESSION_INDEX_LOCK_PATH = SESSION_INDEX_PATH + ".lock"
+SESSION_INDEX_VERSION = 1
+
+# Legacy layout with three files per session, migrated to the session index on first use
+LEGACY_SK_DIR_PATH = "/data/{user_uuid}/keys/session_keys"
+
+PERIODIC_PRUNE_EXPIRED_SESSIONS_SECONDS = int(os.environ.get("PERIODIC_PRUNE_EXPIRED_SESSIONS_SECONDS", 60 * 60))
+
+# A session entry holds the wrapped keys of one session, each value is a fernet token:
+# - sk_kek_p: the sk encrypted with the kek_p
+# - kek_s_sk: the kek_s encrypted with the sk
+# - kek_p_kek_s: the kek_p encrypted with the kek_s
+# - expires_at: iso datetime after which the session is pruned
+SessionEntry = Dict[str, str]
+
+# One lock instance per user as a new FileLock instance on the same path does not re-enter,
+# the thread holding the lock can take it again, eg. when the legacy files are migrated while the index is being updated
+session_index_locks: Dict[str, FileLock] = {}
+session_index_locks_lock = threading.Lock()
+
+def get_session_index_lock(user_uuid: str) -> FileLock:
+    """
+    Get the interprocess lock of the session index of a user, it must be held while reading and writing the index to update it
+    The lock is reentrant in the thread holding it and exclusive between the threads and the processes
+    """
+    session_index_lock_path = SESSION_INDEX_LOCK_PATH.format(user_uuid=user_uuid)
+    with session_index_locks_lock:
+        session_index_lock = session_index_locks.get(session_index_lock_path)
+        if session_index_lock is None:
+            session_index_lock = FileLock(session_index_lock_path, timeout=15, thread_local=True)
+            session_index_locks[session_index_lock_path] = session_index_lock
+        return session_index_lock
+
+def load_session_index(user_uuid: str) -> Dict[str, SessionEntry]:
+    """
+    Load the session index of a user, migrating the legacy session key files if needed
+    """
+    session_index_path = SESSION_INDEX_PATH.format(user_uuid=user_uuid)
+    if not os.path.exists(session_index_path):
+        if os.path.exists(LEGACY_SK_DIR_PATH.format(user_uuid=user_uuid)):
+            return _migrate_legacy_session_key_files(user_uuid)
+        return {}
+    with open(session_index_path, "r") as f:
+        session_index_content = json.load(f)
+    if session_index_content.get("version") != SESSION_INDEX_VERSION:
+        raise Exception(f"Unsupported session index version {session_index_content.get('version')}")
+    return session_index_content["sessions"]
+
+def save_session_index(user_uuid: str, sessions: Dict[str, SessionEntry]) -> None:
+    """
+    Write the session index of a user in one atomically swapped file
+    """
+    session_index_path = SESSION_INDEX_PATH.format(user_uuid=user_uuid)
+    os.makedirs(os.path.dirname(session_index_path), exist_ok=True)
+    fd, tmp_session_index_path = tempfile.mkstemp(dir=os.path.dirname(session_index_path), prefix=".session_keys_")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump({"version": SESSION_INDEX_VERSION, "sessions": sessions}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_session_index_path, session_index_path)
+    except Exception:
+        if os.path.exists(tmp_session_index_path):
+            os.remove(tmp_session_index_path)
+        raise
+
+def get_session_entry(user_uuid: str, sk_uuid: str) -> SessionEntry | None:
+    """
+    Get the session entry of a session if it exists and is not expired
+    """
+    # Reads do not need the lock as the index is swapped atomically
+    session_entry = load_session_index(user_uuid).get(sk_uuid)
+    if session_entry is None or _is_session_entry_expired(session_entry, datetime.now()):
+        return None
+    return session_entry
+
+def add_session_entry(user_uuid: str, sk_uuid: str, session_entry: SessionEntry) -> None:
+    """
+    Add a new session to the session index of a user
+    """
+    with get_session_index_lock(user_uuid):
+        sessions = load_session_index(user_uuid)
+        if sk_uuid in sessions:
+            raise Exception(f"Session {sk_uuid} already exists")
+        sessions[sk_uuid] = session_entry
+        save_session_index(user_uuid, sessions)
+
+def remove_session_entry(user_uuid: str, sk_uuid: str) -> None:
+    """
+    Remove a session from the session index of a user
+    """
+    with get_session_index_lock(user_uuid):
+        sessions = load_session_index(user_uuid)
+        if sessions.pop(sk_uuid, None) is not None:
+            save_session_index(user_uuid, sessions)
+
+def session_exists(user_uuid: str, sk_uuid: str) -> bool:
+    """Check if a session uuid is already used"""
+    return sk_uuid in load_session_index(user_uuid)
+
+def prune_expired_session_entries(user_uuid: str) -> int:
+    """
+    Drop the sessions of a user that are past their expiry, returns the number of dropped sessions
+    """
+    with get_session_index_lock(user_uuid):
+        sessions = load_session_index(user_uuid)
+        now = datetime.now()
+        unexpired_sessions = {sk_uuid: session_entry for sk_uuid, session_entry in sessions.items() if not _is_session_entry_expired(session_entry, now)}
+        pruned_sessions_count = len(sessions) - len(unexpired_sessions)
+        if pruned_sessions_count:
+            save_session_index(user_uuid, unexpired_sessions)
+            logger.info(f"Pruned {pruned_sessions_count} expired sessions for user {user_uuid}")
+        return pruned_sessions_count
+
+def _is_session_entry_expired(session_entry: SessionEntry, now: datetime) -> bool:
+    return datetime.fromisoformat(session_entry["expires_at"]) < now
+
+def _migrate_legacy_session_key_files(user_uuid: str) -> Dict[str, SessionEntry]:
+    """
+    Move the legacy sk_kek_p_*, kek_s_* and kek_p_kek_s_* files of a user into the session index
+    The files content is already encrypted so the migration does not need any key
+    """
+    from app.auth.service import ACCESS_TOKEN_EXPIRE_MINUTES
+    from datetime import timedelta
+
+    with get_session_index_lock(user_uuid):
+        # Another worker may have migrated the files while we were waiting for the lock
+        if os.path.exists(SESSION_INDEX_PATH.format(user_uuid=user_uuid)):
+            return load_session_index(user_uuid)
+
+        legacy_sk_dir_path = LEGACY_SK_DIR_PATH.format(user_uuid=user_uuid)
+        logger.info(f"Migrating legacy session key files for user {user_uuid}")
+        sessions: Dict[str, SessionEntry] = {}
+        for sk_file in os.listdir(legacy_sk_dir_path):
+            if not sk_file.startswith("sk_kek_p_"):
+                continue
+            sk_uuid = sk_file.split("_")[3].split(".")[0]
+            try:
+                sk_kek_p_path = os.path.join(legacy_sk_dir_path, f"sk_kek_p_{sk_uuid}.txt")
+                with open(sk_kek_p_path, "rb") as f:
+                    sk_kek_p = f.read().decode()
+                with open(os.path.join(legacy_sk_dir_path, f"kek_s_{sk_uuid}.txt"), "rb") as f:
+                    kek_s_sk = f.read().decode()
+                with open(os.path.join(legacy_sk_dir_path, f"kek_p_kek_s_{sk_uuid}.txt"), "rb") as f:
+                    kek_p_kek_s = f.read().decode()
+                # The legacy files are rewritten on each login so their modification time is at least the session creation time
+                expires_at = datetime.fromtimestamp(os.path.getmtime(sk_kek_p_path)) + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+                sessions[sk_uuid] = {
+                    "sk_kek_p": sk_kek_p,
+                    "kek_s_sk": kek_s_sk,
+                    "kek_p_kek_s": kek_p_kek_s,
+                    "expires_at": expires_at.isoformat()
+                }
+            except Exception as e:
+                logger.error(f"Error migrating legacy session key {sk_uuid}, dropping it: {e}")
+
+        save_session_index(user_uuid, sessions)
+        shutil.rmtree(legacy_sk_dir_path, ignore_errors=True)
+        return sessions
+
+
+def setup_expired_sessions_pruning_loop():
+    """Setup and start the expired sessions pruning loop in a background thread"""
+    def run_async_in_thread(logger: logging.Logger):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(prune_expired_sessions_loop(logger))
+        except Exception as e:
+            logger.error(f"Expired sessions pruning loop failed: {e}")
+        finally:
+            loop.close()
+
+    logger.info("Setting up expired sessions pruning loop")
+    pruning_thread = threading.Thread(
+        target=run_async_in_thread,
+        daemon=True,  # Terminate when main thread exits
+        name="expired-sessions-pruning",
+        args=(logger,)
+    )
+    pruning_thread.start()
+
+async def prune_expired_sessions_loop(logger: logging.Logger):
+    """
+    Periodically drop the expired sessions of all the users whose data directory is available on this host
+    """
+    while True:
+        await asyncio.sleep(PERIODIC_PRUNE_EXPIRED_SESSIONS_SECONDS)
+        try:
+            user_data_dirs = [d for d in os.listdir(DATA_FOLDER_PATH) if not d.startswith(".") and os.path.isdir(os.path.join(DATA_FOLDER_PATH, d))]
+        except Exception as e:
+            logger.error(f"Error listing user data directories to prune expired sessions: {e}")
+            continue
+        for user_uuid in user_data_dirs:
+            try:
+                if os.path.exists(SESSION_INDEX_PATH.format(user_uuid=user_uuid)):
+                    prune_expired_session_entries(user_uuid)
+            except Exception as e:
+                logger.error(f"Error pruning expired sessions for user {user_uuid}, continuing with the next user: {e}")
@@ -22,6 +22,7 @@ from fastapi import HTTPException
 from fastapi import Request
 from fastapi import BackgroundTasks
 import logging
+from contextlib import ExitStack
 from datetime import datetime
 import uuid
 
@@ -39,6 +40,8 @@ def chat_streaming_response(
   """
   Get the chat streaming response for a given chat id.
   """
+  # The stores of the datasources are held until the response is streamed, they are released by the background tasks run after it
+  stores_exit_stack = ExitStack()
   try:
     logger.info(f"Chat route called")    
     last_message_content = data.get_last_message_content()
@@ -79,6 +82,7 @@ def chat_streaming_response(
         datasources_db_session=datasources_db_session,
         settings_db_session=settings_db_session,
         user_uuid=user_uuid,
+        stores_exit_stack=stores_exit_stack,
         llm=llm,
         max_iterations=app_setting.max_iterations,
         system_prompt=app_setting.system_prompt,
@@ -89,6 +93,7 @@ def chat_streaming_response(
 
     # Send the streaming query to the agent
     response = agent_runner.astream_chat(last_message_content, llama_index_messages)
+    background_tasks.add_task(stores_exit_stack.close)
 
     return VercelStreamResponse(
         request=request, 
@@ -100,6 +105,7 @@ def chat_streaming_response(
         background_tasks=background_tasks,
     )
   except Exception as e:
+      stores_exit_stack.close()
       logger.error(f"Error in chat streaming route: {str(e)}")
       raise HTTPException(
           status_code=500,
@@ -127,16 +133,18 @@ async def chat_request_response(
     filters = generate_filters(doc_ids)
     # Get the params for the chat engine
     params = data.chat_engine_params or {}
-    # Create the chat engine
-    chat_engine = get_chat_engine(
-        datasources_db_session=datasources_db_session,
-        settings_db_session=settings_db_session,
-        user_uuid=user_uuid,
-        filters=filters,
-        params=params
-    )
-    # Send the query to the agent
-    response = await chat_engine.achat(last_message_content, llama_index_messages)
+    # Create the chat engine, the stores of the datasources are held until the agent answered
+    with ExitStack() as stores_exit_stack:
+        chat_engine = get_chat_engine(
+            datasources_db_session=datasources_db_session,
+            settings_db_session=settings_db_session,
+            user_uuid=user_uuid,
+            stores_exit_stack=stores_exit_stack,
+            filters=filters,
+            params=params
+        )
+        # Send the query to the agent
+        response = await chat_engine.achat(last_message_content, llama_index_messages)
     # Update the chat with the new assistant message
     assistant_message = MessageData(
       id=str(uuid.uuid4()),
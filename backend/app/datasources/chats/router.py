@@ -7,6 +7,8 @@ from app.datasources.chats.service import get_all_chats, get_chat, add_message_t
 from app.datasources.chats.database.session import get_datasources_chats_db_session
 from app.datasources.chats.dependencies import validate_datasource_is_of_type_chats
 from app.datasources.chats.schemas import ChatResponse, MessageResponse, MessageCreate
+from app.settings.database.session import get_settings_db_session
+from app.ollama_status.warmup import schedule_ollama_models_prewarm
 
 import logging
 logger = logging.getLogger("uvicorn")
@@ -41,12 +43,16 @@ async def get_chat_route(
     chat_uuid: str,
     _: Annotated[str, Depends(validate_datasource_is_of_type_chats)],
     chats_session: Annotated[Session, Depends(get_datasources_chats_db_session)],
+    settings_db_session: Annotated[Session, Depends(get_settings_db_session)],
     include_messages: bool = False,
     create_if_not_found: bool = False,
     update_last_opened_at: bool = False,
 ) -> ChatResponse:
     try:
         logger.info(f"Getting chat {chat_uuid}")
+        if update_last_opened_at:
+            # The chat is opened by the user, load the models before the first message
+            schedule_ollama_models_prewarm(settings_db_session)
         return get_chat(
             chats_session=chats_session,
             chat_uuid=chat_uuid,
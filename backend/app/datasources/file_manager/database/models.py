@@ -47,6 +47,8 @@ class File(Base):
     processed_stacks = Column(JSON, nullable=True)  # List of already processed stacks
     stacks_to_process = Column(JSON, nullable=True)  # List of stacks queued for processing
     processing_started_at = Column(DateTime, nullable=True)
+    # Duration and counts of each stage of the last processing of the file, to investigate the slow files
+    processing_trace = Column(JSON, nullable=True)
     
     # Original metadata
     file_created_at = Column(DateTime, nullable=False)
@@ -1,4 +1,5 @@
 from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
 from fastapi.responses import Response
 #from fastapi.responses import FileResponse
@@ -12,6 +13,14 @@ from app.datasources.database.session import get_datasources_db_session
 from app.datasources.file_manager.utils import decode_path_safe
 from app.datasources.file_manager.service.llama_index import delete_item_from_llama_index
 from app.datasources.file_manager.dependencies import validate_datasource_is_of_type_files
+from app.api.user_data_locks import LockMode, user_data_lock, get_datasource_lock_scope, get_file_lock_scope
+from app.processing.database.session import get_processing_db_session
+from app.processing.jobs import enqueue_processing_jobs_for_queued_files
+from app.processing.database.models import ProcessingJobPriority
+from app.processing.scheduler import schedule_user_processing
+from app.processing.status_hub import publish_files_processing_status, publish_removed_items_processing_status
+from app.settings.database.session import get_settings_db_session
+from app.ollama_status.warmup import schedule_ollama_models_prewarm
 import logging
 
 logger = logging.getLogger("uvicorn")
@@ -28,13 +37,26 @@ async def upload_file_route(
     datasource_name: str,
     item: FileUploadItem,
     user_uuid: Annotated[str, Depends(get_user_uuid_from_token)],
-    _: Annotated[str, Depends(validate_datasource_is_of_type_files)],
+    datasource_identifier: Annotated[str, Depends(validate_datasource_is_of_type_files)],
     file_manager_session: Annotated[Session, Depends(get_datasources_file_manager_db_session)],
+    processing_db_session: Annotated[Session, Depends(get_processing_db_session)],
+    settings_db_session: Annotated[Session, Depends(get_settings_db_session)],
 ):
     try:
         logger.info(f"Uploading file {item.name} and datasource {datasource_name}")
 
-        file_info = await upload_file(item=item, file_manager_session=file_manager_session, user_uuid=user_uuid)
+        # Uploads of different files of the datasource run concurrently, only the same file is serialized
+        async with user_data_lock(user_uuid, scope=get_datasource_lock_scope(datasource_identifier), mode=LockMode.SHARED), \
+                user_data_lock(user_uuid, scope=get_file_lock_scope(datasource_identifier, item.original_path), mode=LockMode.EXCLUSIVE):
+            file_info = await upload_file(item=item, file_manager_session=file_manager_session, user_uuid=user_uuid)
+
+        # An overwritten file is queued again with its stacks, only its changed chunks will be embedded
+        # The user is waiting for the uploaded file, it goes before the files queued in the background
+        if enqueue_processing_jobs_for_queued_files(processing_db_session, {datasource_name: file_manager_session}, {datasource_name: [file_info.id]}, ProcessingJobPriority.INTERACTIVE):
+            schedule_user_processing(user_uuid)
+            schedule_ollama_models_prewarm(settings_db_session)
+        # The status hub can read the snapshot from the user data directory, off the event loop
+        await run_in_threadpool(publish_files_processing_status, user_uuid, [file_info])
     
         return file_info
     
@@ -45,14 +67,17 @@ async def upload_file_route(
 @r.delete("/{encoded_original_path}")
 async def delete_route(
     user_uuid: Annotated[str, Depends(get_user_uuid_from_token)],
-    _: Annotated[str, Depends(validate_datasource_is_of_type_files)],
+    datasource_identifier: Annotated[str, Depends(validate_datasource_is_of_type_files)],
     file_manager_session: Annotated[Session, Depends(get_datasources_file_manager_db_session)],
     original_path: Annotated[str, Depends(decode_path_safe)],
 ):
     try:
         logger.info(f"Deleting item {original_path}")
 
-        await delete_item(file_manager_session=file_manager_session, user_uuid=user_uuid, original_path=original_path)
+        # The item can be a folder so wait for all the other writes on the datasource
+        async with user_data_lock(user_uuid, scope=get_datasource_lock_scope(datasource_identifier), mode=LockMode.EXCLUSIVE):
+            await delete_item(file_manager_session=file_manager_session, user_uuid=user_uuid, original_path=original_path)
+        await run_in_threadpool(publish_removed_items_processing_status, user_uuid, original_path)
 
         return {"success": True}
         
@@ -166,14 +191,15 @@ async def download_folder_route(
 @r.delete("/processed-data/{encoded_original_path}")
 async def delete_processed_data_route(
     user_uuid: Annotated[str, Depends(get_user_uuid_from_token)],
-    _: Annotated[str, Depends(validate_datasource_is_of_type_files)],
+    datasource_identifier: Annotated[str, Depends(validate_datasource_is_of_type_files)],
     file_manager_session: Annotated[Session, Depends(get_datasources_file_manager_db_session)],
     original_path: Annotated[str, Depends(decode_path_safe)],
 ):
     try:
         logger.info(f"Deleting processed data and path {original_path}")
 
-        await delete_item_from_llama_index(file_manager_session=file_manager_session, user_uuid=user_uuid, original_path=original_path)
+        async with user_data_lock(user_uuid, scope=get_datasource_lock_scope(datasource_identifier), mode=LockMode.EXCLUSIVE):
+            await delete_item_from_llama_index(file_manager_session=file_manager_session, user_uuid=user_uuid, original_path=original_path)
 
         return {"success": True}
         
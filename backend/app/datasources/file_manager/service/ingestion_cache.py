@@ -0,0 +1,194 @@
+from app.api.metrics import get_counter
+
+from llama_index.core.storage.kvstore.types import BaseKVStore, DEFAULT_BATCH_SIZE, DEFAULT_COLLECTION
+
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+import os
+import json
+import time
+import sqlite3
+import threading
+
+import logging
+logger = logging.getLogger("uvicorn")
+
+# Byte budget of the ingestion cache of each datasource, the least recently used entries are evicted above it
+PROCESSING_CACHE_MAX_BYTES = int(os.environ.get("PROCESSING_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+# Evict down to this share of the budget so that the eviction does not run on every put once the cache is full
+PROCESSING_CACHE_EVICTION_TARGET_RATIO = 0.9
+# Wait for the writes of the other processes instead of failing with "database is locked"
+PROCESSING_CACHE_BUSY_TIMEOUT_SECONDS = 30
+# SQLite limit of the variables of a statement is 999 on old versions
+PROCESSING_CACHE_MAX_KEYS_PER_QUERY = 500
+
+processing_cache_lookups_counter = get_counter(
+    "idapt_processing_cache_lookups_total",
+    "Number of ingestion cache lookups by result",
+    ("result",)
+)
+processing_cache_evicted_bytes_counter = get_counter(
+    "idapt_processing_cache_evicted_bytes_total",
+    "Bytes evicted from the ingestion caches"
+)
+
+class SqliteLRUCacheKVStore(BaseKVStore):
+    """
+    Key value store of the ingestion cache of a datasource in a SQLite database with a byte budget
+    The entries are evicted from the least recently used once the values take more than the budget
+    The hits, misses and evictions are counted in the database so that the stats cover all the processes
+    """
+    def __init__(self, db_path: str, max_bytes: int = PROCESSING_CACHE_MAX_BYTES):
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # Autocommit mode, the writes open their own transaction
+        self._connection = sqlite3.connect(db_path, timeout=PROCESSING_CACHE_BUSY_TIMEOUT_SECONDS, isolation_level=None, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "collection TEXT NOT NULL, "
+            "key TEXT NOT NULL, "
+            "value TEXT NOT NULL, "
+            "size INTEGER NOT NULL, "
+            "last_used REAL NOT NULL, "
+            "PRIMARY KEY (collection, key)"
+            ") WITHOUT ROWID"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS cache_last_used ON cache (last_used)")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS cache_stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        # Size of the values, counted again from the database before each eviction as the other processes write too
+        self._size_bytes = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+
+    def _increment_stats(self, stats: Dict[str, int]) -> None:
+        """Increment stats counters, the caller must be in a transaction"""
+        self._connection.executemany(
+            "INSERT INTO cache_stats (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+            [(name, value) for name, value in stats.items() if value]
+        )
+
+    def put(self, key: str, val: dict, collection: str = DEFAULT_COLLECTION) -> None:
+        self.put_all([(key, val)], collection=collection)
+
+    async def aput(self, key: str, val: dict, collection: str = DEFAULT_COLLECTION) -> None:
+        self.put(key, val, collection=collection)
+
+    def put_all(self, kv_pairs: List[Tuple[str, dict]], collection: str = DEFAULT_COLLECTION, batch_size: int = DEFAULT_BATCH_SIZE) -> None:
+        """Write all the pairs in a single transaction and evict the least recently used entries if the cache is over its budget"""
+        if not kv_pairs:
+            return
+        now = time.time()
+        rows = []
+        for key, val in kv_pairs:
+            value = json.dumps(val)
+            rows.append((collection, key, value, len(value), now))
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                self._connection.executemany("INSERT OR REPLACE INTO cache (collection, key, value, size, last_used) VALUES (?, ?, ?, ?, ?)", rows)
+                self._size_bytes += sum(row[3] for row in rows)
+                if self._size_bytes > self.max_bytes:
+                    self._evict_least_recently_used()
+                self._connection.execute("COMMIT")
+            except Exception:
+                self._connection.execute("ROLLBACK")
+                raise
+
+    def _evict_least_recently_used(self) -> None:
+        """Evict down to the eviction target of the budget, the caller must hold the lock and be in a transaction"""
+        self._size_bytes = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+        bytes_to_evict = self._size_bytes - int(self.max_bytes * PROCESSING_CACHE_EVICTION_TARGET_RATIO)
+        if bytes_to_evict <= 0:
+            return
+        # Find the last used time under which the oldest entries free enough bytes
+        freed_bytes, last_used_limit = 0, None
+        for last_used, size in self._connection.execute("SELECT last_used, size FROM cache ORDER BY last_used ASC"):
+            freed_bytes += size
+            last_used_limit = last_used
+            if freed_bytes >= bytes_to_evict:
+                break
+        if last_used_limit is None:
+            return
+        # The entries written together share their last used time, they are evicted together
+        cursor = self._connection.execute("DELETE FROM cache WHERE last_used <= ?", (last_used_limit,))
+        size_bytes = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+        evicted_bytes = self._size_bytes - size_bytes
+        self._size_bytes = size_bytes
+        self._increment_stats({"evictions": cursor.rowcount, "evicted_bytes": evicted_bytes})
+        processing_cache_evicted_bytes_counter.inc(evicted_bytes)
+        logger.info(f"Evicted {cursor.rowcount} entries ({evicted_bytes} bytes) from the ingestion cache {self.db_path}")
+
+    async def aput_all(self, kv_pairs: List[Tuple[str, dict]], collection: str = DEFAULT_COLLECTION, batch_size: int = DEFAULT_BATCH_SIZE) -> None:
+        self.put_all(kv_pairs, collection=collection, batch_size=batch_size)
+
+    def get(self, key: str, collection: str = DEFAULT_COLLECTION) -> Optional[dict]:
+        return self.get_many([key], collection=collection).get(key)
+
+    async def aget(self, key: str, collection: str = DEFAULT_COLLECTION) -> Optional[dict]:
+        return self.get(key, collection=collection)
+
+    def get_many(self, keys: List[str], collection: str = DEFAULT_COLLECTION) -> Dict[str, dict]:
+        """Get the cached values of several keys, the hits are marked as used in a single transaction"""
+        unique_keys = list(dict.fromkeys(keys))
+        values: Dict[str, dict] = {}
+        with self._lock:
+            for position in range(0, len(unique_keys), PROCESSING_CACHE_MAX_KEYS_PER_QUERY):
+                keys_chunk = unique_keys[position:position + PROCESSING_CACHE_MAX_KEYS_PER_QUERY]
+                rows = self._connection.execute(
+                    f"SELECT key, value FROM cache WHERE collection = ? AND key IN ({', '.join('?' * len(keys_chunk))})",
+                    (collection, *keys_chunk)
+                ).fetchall()
+                values.update({key: json.loads(value) for key, value in rows})
+            now = time.time()
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                self._connection.executemany("UPDATE cache SET last_used = ? WHERE collection = ? AND key = ?", [(now, collection, key) for key in values])
+                self._increment_stats({"hits": len(values), "misses": len(unique_keys) - len(values)})
+                self._connection.execute("COMMIT")
+            except Exception:
+                self._connection.execute("ROLLBACK")
+                raise
+        processing_cache_lookups_counter.inc(len(values), result="hit")
+        processing_cache_lookups_counter.inc(len(unique_keys) - len(values), result="miss")
+        return values
+
+    def get_all(self, collection: str = DEFAULT_COLLECTION) -> Dict[str, dict]:
+        with self._lock:
+            rows = self._connection.execute("SELECT key, value FROM cache WHERE collection = ?", (collection,)).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    async def aget_all(self, collection: str = DEFAULT_COLLECTION) -> Dict[str, dict]:
+        return self.get_all(collection=collection)
+
+    def delete(self, key: str, collection: str = DEFAULT_COLLECTION) -> bool:
+        with self._lock:
+            cursor = self._connection.execute("DELETE FROM cache WHERE collection = ? AND key = ?", (collection, key))
+        return cursor.rowcount > 0
+
+    async def adelete(self, key: str, collection: str = DEFAULT_COLLECTION) -> bool:
+        return self.delete(key, collection=collection)
+
+    def get_stats(self) -> Dict[str, int]:
+        """Get the entries count, the size and the counters of the cache"""
+        with self._lock:
+            entries_count, size_bytes = self._connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache").fetchone()
+            stats = dict(self._connection.execute("SELECT name, value FROM cache_stats").fetchall())
+        return {
+            "entries_count": entries_count,
+            "size_bytes": size_bytes,
+            "max_size_bytes": self.max_bytes,
+            "hits": stats.get("hits", 0),
+            "misses": stats.get("misses", 0),
+            "evictions": stats.get("evictions", 0),
+            "evicted_bytes": stats.get("evicted_bytes", 0),
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+def open_ingestion_cache_store(db_path: str) -> SqliteLRUCacheKVStore:
+    Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+    return SqliteLRUCacheKVStore(db_path)
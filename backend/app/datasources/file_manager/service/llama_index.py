@@ -1,10 +1,15 @@
 import os
+import time
 import chromadb
 import logging
 from pathlib import Path
 import json
 from fastapi import HTTPException
 import shutil
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Generator, List, Tuple
 
 from sqlalchemy.orm import Session
 from app.datasources.file_manager.database.models import File, FileStatus, Folder
@@ -13,6 +18,7 @@ from app.datasources.file_manager.service.db_operations import get_db_folder_fil
 from app.settings.schemas import AppSettings, SettingResponse
 from app.settings.service import get_setting
 from app.api.user_path import get_user_app_data_dir
+from app.api.mount_user_data_dir import register_user_data_dir_unmount_callback
 from app.datasources.file_manager.utils import validate_path
 
 from llama_index.core.storage import StorageContext
@@ -23,7 +29,8 @@ from llama_index.core.retrievers import VectorIndexRetriever#, AutoMergingRetrie
 from llama_index.core.response_synthesizers import get_response_synthesizer
 from llama_index.core.query_engine import RetrieverQueryEngine
 from llama_index.vector_stores.chroma import ChromaVectorStore
-from llama_index.core.storage.docstore import SimpleDocumentStore
+from app.datasources.file_manager.service.sqlite_docstore import SqliteDocumentStore
+from app.datasources.file_manager.service.ingestion_cache import SqliteLRUCacheKVStore, open_ingestion_cache_store
 from llama_index.core.llms import LLM
 from llama_index.core.base.embeddings.base import BaseEmbedding
 
@@ -59,36 +66,210 @@ def create_vector_store(datasource_identifier: str, user_uuid: str) -> ChromaVec
         logger.error(f"Error creating vector store: {str(e)}")
         raise
 
+def get_vector_store_ref_doc_node_ids(vector_store: ChromaVectorStore, ref_doc_id: str) -> set[str]:
+    """Get the ids of the nodes of a document in the vector store, the docstore only keeps the documents"""
+    try:
+        return set(vector_store._collection.get(where={"ref_doc_id": ref_doc_id}, include=[])["ids"])
+    except Exception as e:
+        logger.error(f"Error getting the nodes of document {ref_doc_id} from the vector store: {str(e)}")
+        raise
+
 def get_llama_index_datasource_folder_path(datasource_identifier: str, user_uuid: str) -> str:
     return f"{get_user_app_data_dir(user_uuid)}/processed/{datasource_identifier}"
 
-def create_doc_store(datasource_identifier: str, user_uuid: str) -> SimpleDocumentStore:
+def create_doc_store(datasource_identifier: str, user_uuid: str) -> SqliteDocumentStore:
     try:
-        # Create the docstore directory if it doesn't exist
-        docstore_file = Path(get_llama_index_datasource_folder_path(datasource_identifier, user_uuid)) / "docstores" / f"docstore.json"
-        docstore_file.parent.mkdir(parents=True, exist_ok=True)
-
-        docstore = None
-        # If the file doesn't exist, create a new docstore and persist it
-        if not docstore_file.exists():
-            docstore = SimpleDocumentStore()
-            docstore.persist(persist_path=str(docstore_file))
-        else:
-            docstore = SimpleDocumentStore.from_persist_path(
-                str(docstore_file)
-            )
-
-        return docstore
+        # The docstore writes its changes directly in its database, the json file of the SimpleDocumentStore used before is imported once
+        return SqliteDocumentStore.from_db_path(
+            str(get_doc_store_db_path(datasource_identifier, user_uuid)),
+            simple_doc_store_json_path=str(get_doc_store_file_path(datasource_identifier, user_uuid))
+        )
     except Exception as e:
         logger.error(f"Error creating doc store: {str(e)}")
         raise
 
+def get_doc_store_db_path(datasource_identifier: str, user_uuid: str) -> Path:
+    return Path(get_llama_index_datasource_folder_path(datasource_identifier, user_uuid)) / "docstores" / f"docstore.db"
+
+def get_ingestion_cache_db_path(datasource_identifier: str, user_uuid: str) -> Path:
+    return Path(get_llama_index_datasource_folder_path(datasource_identifier, user_uuid)) / "cache" / f"ingestion_cache.db"
+
+def get_doc_store_file_path(datasource_identifier: str, user_uuid: str) -> Path:
+    """Path of the json file of the SimpleDocumentStore used before the SQLite docstore"""
+    return Path(get_llama_index_datasource_folder_path(datasource_identifier, user_uuid)) / "docstores" / f"docstore.json"
+
+
+# Maximum number of datasources stores kept open in this process, the least recently used ones are closed first
+DATASOURCE_STORES_MAX_OPEN = int(os.environ.get("DATASOURCE_STORES_MAX_OPEN", 32))
+
+class DatasourceStores:
+    """
+    Vector store and docstore of a datasource shared by the processing threads and the request handlers of the process
+    The writers hold the lock while modifying the docstore so that the documents of a file are upserted or deleted together
+    """
+    def __init__(self, datasource_identifier: str, user_uuid: str):
+        self.datasource_identifier = datasource_identifier
+        self.user_uuid = user_uuid
+        self.vector_store = create_vector_store(datasource_identifier, user_uuid)
+        self.doc_store = create_doc_store(datasource_identifier, user_uuid)
+        # Opened on first use as only the processing uses it
+        self._ingestion_cache_store: SqliteLRUCacheKVStore | None = None
+        # Number of users of the stores, they are only closed once unused
+        self.references = 0
+        # Set when the stores are closed while still used, the last user closes them on release
+        self.close_on_release = False
+        self.close_chroma_client_on_release = False
+        self.last_used = time.time()
+        self.lock = threading.RLock()
+
+    @property
+    def ingestion_cache_store(self) -> SqliteLRUCacheKVStore:
+        """Cache of the transformations outputs and of the embeddings of the datasource"""
+        with self.lock:
+            if self._ingestion_cache_store is None:
+                self._ingestion_cache_store = open_ingestion_cache_store(str(get_ingestion_cache_db_path(self.datasource_identifier, self.user_uuid)))
+            return self._ingestion_cache_store
+
+    def close(self):
+        self.doc_store.close()
+        with self.lock:
+            if self._ingestion_cache_store is not None:
+                self._ingestion_cache_store.close()
+                self._ingestion_cache_store = None
+
+# Open stores by (user uuid, datasource identifier), ordered from the least to the most recently used
+datasources_stores: "OrderedDict[Tuple[str, str], DatasourceStores]" = OrderedDict()
+datasources_stores_lock = threading.Lock()
+
+def acquire_datasource_stores(datasource_identifier: str, user_uuid: str) -> DatasourceStores:
+    """
+    Get the open stores of a datasource, opening them if needed, they must be released with release_datasource_stores
+    The stores are kept open until released, their handles must not be used after the release
+    """
+    key = (user_uuid, datasource_identifier)
+    with datasources_stores_lock:
+        stores = datasources_stores.get(key)
+        if stores is not None:
+            stores.references += 1
+            stores.last_used = time.time()
+            datasources_stores.move_to_end(key)
+    if stores is not None:
+        return stores
+
+    # Open the stores outside of the lock as opening the chroma client takes time
+    new_stores = DatasourceStores(datasource_identifier, user_uuid)
+    with datasources_stores_lock:
+        # Another thread may have opened them in the meantime
+        stores = datasources_stores.setdefault(key, new_stores)
+        if stores is not new_stores:
+            new_stores.close()
+        stores.references += 1
+        stores.last_used = time.time()
+        datasources_stores.move_to_end(key)
+        evicted_stores = _evict_least_recently_used_datasources_stores()
+    # Close the evicted stores outside of the lock as closing them waits for their files
+    for evicted in evicted_stores:
+        evicted.close()
+    return stores
+
+def release_datasource_stores(stores: DatasourceStores):
+    with datasources_stores_lock:
+        stores.references -= 1
+        close_stores = stores.references <= 0 and stores.close_on_release
+    # The stores were closed while used, close them now that the last user released them
+    if close_stores:
+        _close_removed_datasource_stores(stores, stores.close_chroma_client_on_release)
+
+@contextmanager
+def datasource_stores(datasource_identifier: str, user_uuid: str) -> Generator[DatasourceStores, None, None]:
+    """
+    Use the open stores of a datasource for the duration of the context
+    The vector store and docstore handles must not be used after the context, they can be closed once released
+    """
+    stores = acquire_datasource_stores(datasource_identifier, user_uuid)
+    try:
+        yield stores
+    finally:
+        release_datasource_stores(stores)
+
+def _evict_least_recently_used_datasources_stores() -> List[DatasourceStores]:
+    """
+    Remove the least recently used unused stores above the limit, the caller must hold datasources_stores_lock and close the returned stores
+    The chroma clients are shared per path by chroma and stay open until the unmount
+    """
+    evicted_stores: List[DatasourceStores] = []
+    for key in list(datasources_stores.keys()):
+        if len(datasources_stores) <= DATASOURCE_STORES_MAX_OPEN:
+            break
+        if datasources_stores[key].references <= 0:
+            evicted_stores.append(datasources_stores.pop(key))
+            logger.debug(f"Closing least recently used stores of datasource {key[1]} for user {key[0]}")
+    return evicted_stores
+
+def _remove_datasources_stores(keys: List[Tuple[str, str]]) -> List[DatasourceStores]:
+    """
+    Remove stores from the open stores, the unused ones are returned to be closed by the caller
+    The used ones are closed by their last user on release
+    """
+    unused_stores: List[DatasourceStores] = []
+    with datasources_stores_lock:
+        for key in keys:
+            stores = datasources_stores.pop(key, None)
+            if stores is None:
+                continue
+            if stores.references > 0:
+                logger.info(f"Stores of datasource {stores.datasource_identifier} for user {stores.user_uuid} still used {stores.references} times, closing them on release")
+                stores.close_on_release = True
+                stores.close_chroma_client_on_release = True
+            else:
+                unused_stores.append(stores)
+    return unused_stores
+
+def _close_removed_datasource_stores(stores: DatasourceStores, close_chroma_client: bool):
+    stores.close()
+    if close_chroma_client:
+        _close_chroma_client(stores.datasource_identifier, stores.user_uuid)
+
+def close_datasource_stores(datasource_identifier: str, user_uuid: str):
+    """Close the stores of a datasource, used when the datasource is deleted"""
+    key = (user_uuid, datasource_identifier)
+    with datasources_stores_lock:
+        is_open = key in datasources_stores
+    for stores in _remove_datasources_stores([key]):
+        _close_removed_datasource_stores(stores, close_chroma_client=True)
+    # The chroma client stays open after its stores are evicted
+    if not is_open:
+        _close_chroma_client(datasource_identifier, user_uuid)
+
+def close_user_datasources_stores(user_uuid: str):
+    """Close the stores of all the datasources of a user, called before its data directory is unmounted"""
+    with datasources_stores_lock:
+        user_stores_keys = [key for key in datasources_stores.keys() if key[0] == user_uuid]
+    for stores in _remove_datasources_stores(user_stores_keys):
+        _close_removed_datasource_stores(stores, close_chroma_client=True)
+
+register_user_data_dir_unmount_callback(close_user_datasources_stores)
+
+def _close_chroma_client(datasource_identifier: str, user_uuid: str):
+    """
+    Stop the chroma system of the datasource embeddings directory
+    Chroma keeps a system per path for the whole process life otherwise, holding its files and its in memory index
+    """
+    datasource_embeddings_dir = str(Path(get_llama_index_datasource_folder_path(datasource_identifier, user_uuid)) / "embeddings")
+    try:
+        from chromadb.api.client import SharedSystemClient
+        system = SharedSystemClient._identifier_to_system.pop(datasource_embeddings_dir, None)
+        if system is not None:
+            system.stop()
+    except Exception as e:
+        logger.warning(f"Error closing ChromaDB client of {datasource_embeddings_dir}: {str(e)}")
+
 def create_query_tool(
     settings_db_session: Session, 
     datasources_db_session: Session,
     datasource_identifier: str,
     vector_store: ChromaVectorStore,
-    doc_store: SimpleDocumentStore, 
+    doc_store: SqliteDocumentStore, 
     embed_model: BaseEmbedding, 
     llm: LLM
 ) -> BaseTool:
@@ -217,6 +398,8 @@ def delete_datasource_llama_index_components(datasource_identifier: str, user_uu
             client.reset()
         except Exception as e:
             logger.warning(f"Error closing ChromaDB connection: {str(e)}")
+        # Forget the open stores so that a datasource recreated with the same identifier does not reuse them
+        close_datasource_stores(datasource_identifier, user_uuid)
 
         # Delete the datasource llama index directory
         #llama_index_datasource_folder_path = Path(get_llama_index_datasource_folder_path(datasource_identifier, user_uuid))
@@ -239,15 +422,19 @@ def delete_datasource_llama_index_components(datasource_identifier: str, user_uu
         #        raise
 
 
-        docstore_file = Path(get_llama_index_datasource_folder_path(datasource_identifier, user_uuid)) / "docstores" / f"docstore.json"
-        # Delete the docstore file
-        if os.path.exists(docstore_file):
-            try:
-                os.remove(docstore_file)
-                logger.info(f"Deleted docstore file: {docstore_file}")
-            except Exception as e:
-                logger.error(f"Error deleting docstore file: {str(e)}")
-                raise
+        # Delete the docstore database with its WAL files and the json file of the docstore used before it if not migrated yet
+        doc_store_db_path = str(get_doc_store_db_path(datasource_identifier, user_uuid))
+        doc_store_json_path = str(get_doc_store_file_path(datasource_identifier, user_uuid))
+        # Delete the ingestion cache database too as the cached embeddings are only reused within the datasource
+        ingestion_cache_db_path = str(get_ingestion_cache_db_path(datasource_identifier, user_uuid))
+        for store_file in (doc_store_db_path, f"{doc_store_db_path}-wal", f"{doc_store_db_path}-shm", doc_store_json_path, f"{doc_store_json_path}.migrated", ingestion_cache_db_path, f"{ingestion_cache_db_path}-wal", f"{ingestion_cache_db_path}-shm"):
+            if os.path.exists(store_file):
+                try:
+                    os.remove(store_file)
+                    logger.info(f"Deleted store file: {store_file}")
+                except Exception as e:
+                    logger.error(f"Error deleting store file: {str(e)}")
+                    raise
             
     except Exception as e:
         logger.error(f"Error deleting datasource llama index components: {str(e)}")
@@ -261,46 +448,43 @@ def delete_file_llama_index(file_manager_session: Session, user_uuid: str, file:
         from app.datasources.utils import get_datasource_identifier_from_path
         # Get the datasource vector store and docstore
         datasource_identifier = get_datasource_identifier_from_path(file.path)
-        vector_store = create_vector_store(datasource_identifier, user_uuid)
-        doc_store = create_doc_store(datasource_identifier, user_uuid)
-
-        # Delete each ref_doc_id from the vector store and docstore
-        # Parse the json ref_doc_ids as a list
-        ref_doc_ids = json.loads(file.ref_doc_ids) if file.ref_doc_ids else []
-        for ref_doc_id in ref_doc_ids:
-            # Get the processing stack identifier from last part after the _ in the ref_doc_id
-            processing_stack_identifier = ref_doc_id.split("_")[-1]
-            try:
-                # Delete the ref_doc_id from the vector store
-                vector_store.delete(ref_doc_id)
-                # Delete the ref_doc_id from the docstore
-                doc_store.delete_document(ref_doc_id)
-            except Exception as e:
-                logger.warning(f"Failed to delete {ref_doc_id} from vector store and docstore probably because it was already deleted or does not exist in them : {str(e)}")
-            # In any case delete the ref_doc_id from the file
-            finally:
-                logger.info(f"Deleting {ref_doc_id} relation from file {file.path}")
-                # Delete the ref_doc_id from the file
-                file.ref_doc_ids = [ref_doc_id for ref_doc_id in file.ref_doc_ids if ref_doc_id != ref_doc_id]
-                # Delete the processing stack identifier from the processed_stacks list after having it converted to json and reconverting it to a string
-                processed_stacks = json.loads(file.processed_stacks) if file.processed_stacks else []
-                processed_stacks = [stack_id for stack_id in processed_stacks if stack_id != processing_stack_identifier]
-                file.processed_stacks = json.dumps(processed_stacks)
-                # Commit the changes to the file the database
-                file_manager_session.flush() # Commit ?
-
-        # Mark the file statuis as pending
-        file.status = FileStatus.PENDING
-        # Remove already processed stacks from the file
-        file.processed_stacks = json.dumps([])
-        # Remove all pending stacks from the file # ?
-        file.stacks_to_process = json.dumps([])
-        # Commit the changes to the file the database
-        file_manager_session.commit()
-
-        # Needed for now as SimpleDocumentStore is not persistent
-        docstore_file = Path(get_llama_index_datasource_folder_path(datasource_identifier, user_uuid)) / "docstores" / f"docstore.json"
-        doc_store.persist(persist_path= str(docstore_file))
+        with datasource_stores(datasource_identifier, user_uuid) as stores, stores.lock:
+            vector_store = stores.vector_store
+            doc_store = stores.doc_store
+
+            # Delete each ref_doc_id from the vector store and docstore
+            # Parse the json ref_doc_ids as a list
+            ref_doc_ids = json.loads(file.ref_doc_ids) if file.ref_doc_ids else []
+            for ref_doc_id in ref_doc_ids:
+                # Get the processing stack identifier from last part after the _ in the ref_doc_id
+                processing_stack_identifier = ref_doc_id.split("_")[-1]
+                try:
+                    # Delete the ref_doc_id from the vector store
+                    vector_store.delete(ref_doc_id)
+                    # Delete the ref_doc_id from the docstore
+                    doc_store.delete_document(ref_doc_id)
+                except Exception as e:
+                    logger.warning(f"Failed to delete {ref_doc_id} from vector store and docstore probably because it was already deleted or does not exist in them : {str(e)}")
+                # In any case delete the ref_doc_id from the file
+                finally:
+                    logger.info(f"Deleting {ref_doc_id} relation from file {file.path}")
+                    # Delete the ref_doc_id from the file
+                    file.ref_doc_ids = [ref_doc_id for ref_doc_id in file.ref_doc_ids if ref_doc_id != ref_doc_id]
+                    # Delete the processing stack identifier from the processed_stacks list after having it converted to json and reconverting it to a string
+                    processed_stacks = json.loads(file.processed_stacks) if file.processed_stacks else []
+                    processed_stacks = [stack_id for stack_id in processed_stacks if stack_id != processing_stack_identifier]
+                    file.processed_stacks = json.dumps(processed_stacks)
+                    # Commit the changes to the file the database
+                    file_manager_session.flush() # Commit ?
+
+            # Mark the file statuis as pending
+            file.status = FileStatus.PENDING
+            # Remove already processed stacks from the file
+            file.processed_stacks = json.dumps([])
+            # Remove all pending stacks from the file # ?
+            file.stacks_to_process = json.dumps([])
+            # Commit the changes to the file the database
+            file_manager_session.commit()
 
     except Exception as e:
         file_manager_session.rollback()
@@ -321,40 +505,37 @@ def delete_file_processing_stack_from_llama_index(file_manager_session: Session,
 
 
         # Get the datasource vector store and docstore
-        vector_store = create_vector_store(datasource_identifier, user_uuid)
-        doc_store = create_doc_store(datasource_identifier, user_uuid)
-
-        # Delete each ref_doc_id from the vector store and docstore
-        # Parse the json ref_doc_ids as a list
-        ref_doc_ids = json.loads(file.ref_doc_ids) if file.ref_doc_ids else []
+        with datasource_stores(datasource_identifier, user_uuid) as stores, stores.lock:
+            vector_store = stores.vector_store
+            doc_store = stores.doc_store
+
+            # Delete each ref_doc_id from the vector store and docstore
+            # Parse the json ref_doc_ids as a list
+            ref_doc_ids = json.loads(file.ref_doc_ids) if file.ref_doc_ids else []
+
+            # Keep only the ref_doc_ids that are with the processing stack identifier
+            ref_doc_ids = [ref_doc_id for ref_doc_id in ref_doc_ids if processing_stack_identifier in ref_doc_id]
+
+            for ref_doc_id in ref_doc_ids:
+                try:
+                    # Delete the ref_doc_id from the vector store
+                    vector_store.delete(ref_doc_id)
+                    # Delete the ref_doc_id from the docstore
+                    doc_store.delete_document(ref_doc_id)
+                except Exception as e:
+                    logger.warning(f"Failed to delete {ref_doc_id} from vector store and docstore probably because it was already deleted or does not exist in them : {str(e)}")
+                # In any case delete the ref_doc_id from the file
+                finally:
+                    logger.info(f"Deleting {ref_doc_id} relation from file {file.path}")
+                    # Delete the ref_doc_id from the file
+                    file.ref_doc_ids = [ref_doc_id for ref_doc_id in file.ref_doc_ids if ref_doc_id != ref_doc_id]
+                    # Delete the processing stack identifier from the processed_stacks list after having it converted to json and reconverting it to a string
+                    processed_stacks = json.loads(file.processed_stacks) if file.processed_stacks else []
+                    processed_stacks = [stack_id for stack_id in processed_stacks if stack_id != processing_stack_identifier]
+                    file.processed_stacks = json.dumps(processed_stacks)
+                    # Commit the changes to the file the database
+                    file_manager_session.commit()
 
-        # Keep only the ref_doc_ids that are with the processing stack identifier
-        ref_doc_ids = [ref_doc_id for ref_doc_id in ref_doc_ids if processing_stack_identifier in ref_doc_id]
-
-        for ref_doc_id in ref_doc_ids:
-            try:
-                # Delete the ref_doc_id from the vector store
-                vector_store.delete(ref_doc_id)
-                # Delete the ref_doc_id from the docstore
-                doc_store.delete_document(ref_doc_id)
-            except Exception as e:
-                logger.warning(f"Failed to delete {ref_doc_id} from vector store and docstore probably because it was already deleted or does not exist in them : {str(e)}")
-            # In any case delete the ref_doc_id from the file
-            finally:
-                logger.info(f"Deleting {ref_doc_id} relation from file {file.path}")
-                # Delete the ref_doc_id from the file
-                file.ref_doc_ids = [ref_doc_id for ref_doc_id in file.ref_doc_ids if ref_doc_id != ref_doc_id]
-                # Delete the processing stack identifier from the processed_stacks list after having it converted to json and reconverting it to a string
-                processed_stacks = json.loads(file.processed_stacks) if file.processed_stacks else []
-                processed_stacks = [stack_id for stack_id in processed_stacks if stack_id != processing_stack_identifier]
-                file.processed_stacks = json.dumps(processed_stacks)
-                # Commit the changes to the file the database
-                file_manager_session.commit()
-
-        # Needed for now as SimpleDocumentStore is not persistent
-        docstore_file = Path(get_llama_index_datasource_folder_path(datasource_identifier, user_uuid)) / "docstores" / f"docstore.json"
-        doc_store.persist(persist_path=str(docstore_file))
-        
     except Exception as e:
         logger.error(f"Error deleting file processing stack from LlamaIndex: {str(e)}")
         raise
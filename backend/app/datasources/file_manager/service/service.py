@@ -102,9 +102,9 @@ async def upload_file(file_manager_session: Session, item: FileUploadItem, user_
                     status_code=409,
                     detail="Cannot overwrite file that is currently being processed"
                 )
-            # Delete existing file
-            await delete_file(file_manager_session, user_uuid, existing_file.path)
-            
+            # Keep the existing file so that its ingested documents and nodes are diffed with the new content when it is processed again
+            fs_path = existing_file.path
+
         # Process file content and write to filesystem
         decoded_file_data, mime_type = preprocess_base64_file(item.base64_content)       
 
@@ -127,20 +127,37 @@ async def upload_file(file_manager_session: Session, item: FileUploadItem, user_
             if not parent_folder:
                 raise ValueError(f"Parent folder {parent_folder_path} not found")
             
-            # Create file
-            file = File(
-                name=item.name,
-                path=fs_path,
-                original_path=item.original_path,
-                size=len(decoded_file_data),
-                mime_type=mime_type,
-                folder_id=parent_folder.id,
-                file_created_at=datetime.fromtimestamp(item.file_created_at) if item.file_created_at else datetime.now(),
-                file_modified_at=datetime.fromtimestamp(item.file_modified_at) if item.file_modified_at else datetime.now(),
-                dek=dek
-            )
-            file_manager_session.add(file)
-            file_manager_session.commit()
+            if existing_file:
+                # Overwrite the file and queue again all its stacks, only its changed chunks will be embedded
+                existing_file_stacks = (json.loads(existing_file.processed_stacks) if existing_file.processed_stacks else []) + (json.loads(existing_file.stacks_to_process) if existing_file.stacks_to_process else [])
+                existing_file.name = item.name
+                existing_file.size = len(decoded_file_data)
+                existing_file.mime_type = mime_type
+                existing_file.file_created_at = datetime.fromtimestamp(item.file_created_at) if item.file_created_at else datetime.now()
+                existing_file.file_modified_at = datetime.fromtimestamp(item.file_modified_at) if item.file_modified_at else datetime.now()
+                existing_file.dek = dek
+                existing_file.processed_stacks = json.dumps([])
+                existing_file.stacks_to_process = json.dumps(list(dict.fromkeys(existing_file_stacks)))
+                existing_file.status = FileStatus.QUEUED if existing_file_stacks else FileStatus.PENDING
+                existing_file.error_message = None
+                existing_file.processing_started_at = None
+                file_manager_session.commit()
+                file = existing_file
+            else:
+                # Create file
+                file = File(
+                    name=item.name,
+                    path=fs_path,
+                    original_path=item.original_path,
+                    size=len(decoded_file_data),
+                    mime_type=mime_type,
+                    folder_id=parent_folder.id,
+                    file_created_at=datetime.fromtimestamp(item.file_created_at) if item.file_created_at else datetime.now(),
+                    file_modified_at=datetime.fromtimestamp(item.file_modified_at) if item.file_modified_at else datetime.now(),
+                    dek=dek
+                )
+                file_manager_session.add(file)
+                file_manager_session.commit()
         except Exception as e:
             # Clean up filesystem file if database insert fails
             await delete_file_filesystem(fs_path)
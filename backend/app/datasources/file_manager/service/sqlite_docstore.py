@@ -0,0 +1,142 @@
+from llama_index.core.storage.kvstore.types import BaseKVStore, DEFAULT_BATCH_SIZE, DEFAULT_COLLECTION
+from llama_index.core.storage.docstore.keyval_docstore import KVDocumentStore
+
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+import os
+import json
+import sqlite3
+import threading
+
+import logging
+logger = logging.getLogger("uvicorn")
+
+# Wait for the writes of the other processes instead of failing with "database is locked"
+SQLITE_KV_STORE_BUSY_TIMEOUT_SECONDS = 30
+
+class SqliteKVStore(BaseKVStore):
+    """
+    Key value store in a SQLite database, each put only writes its own rows instead of rewriting the whole store like the SimpleKVStore
+    The database is shared by the threads of the process through a single connection and by the processes through the SQLite locking
+    """
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        # Autocommit mode, the batched writes open their own transaction
+        self._connection = sqlite3.connect(db_path, timeout=SQLITE_KV_STORE_BUSY_TIMEOUT_SECONDS, isolation_level=None, check_same_thread=False)
+        # The readers do not block the writer and the writer does not block the readers
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS kv_store ("
+            "collection TEXT NOT NULL, "
+            "key TEXT NOT NULL, "
+            "value TEXT NOT NULL, "
+            "PRIMARY KEY (collection, key)"
+            ") WITHOUT ROWID"
+        )
+
+    def put(self, key: str, val: dict, collection: str = DEFAULT_COLLECTION) -> None:
+        self.put_all([(key, val)], collection=collection)
+
+    async def aput(self, key: str, val: dict, collection: str = DEFAULT_COLLECTION) -> None:
+        self.put(key, val, collection=collection)
+
+    def put_all(self, kv_pairs: List[Tuple[str, dict]], collection: str = DEFAULT_COLLECTION, batch_size: int = DEFAULT_BATCH_SIZE) -> None:
+        """Write all the pairs in a single transaction"""
+        if not kv_pairs:
+            return
+        rows = [(collection, key, json.dumps(val)) for key, val in kv_pairs]
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                self._connection.executemany("INSERT OR REPLACE INTO kv_store (collection, key, value) VALUES (?, ?, ?)", rows)
+                self._connection.execute("COMMIT")
+            except Exception:
+                self._connection.execute("ROLLBACK")
+                raise
+
+    async def aput_all(self, kv_pairs: List[Tuple[str, dict]], collection: str = DEFAULT_COLLECTION, batch_size: int = DEFAULT_BATCH_SIZE) -> None:
+        self.put_all(kv_pairs, collection=collection, batch_size=batch_size)
+
+    def get(self, key: str, collection: str = DEFAULT_COLLECTION) -> Optional[dict]:
+        with self._lock:
+            row = self._connection.execute("SELECT value FROM kv_store WHERE collection = ? AND key = ?", (collection, key)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    async def aget(self, key: str, collection: str = DEFAULT_COLLECTION) -> Optional[dict]:
+        return self.get(key, collection=collection)
+
+    def get_all(self, collection: str = DEFAULT_COLLECTION) -> Dict[str, dict]:
+        with self._lock:
+            rows = self._connection.execute("SELECT key, value FROM kv_store WHERE collection = ?", (collection,)).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    async def aget_all(self, collection: str = DEFAULT_COLLECTION) -> Dict[str, dict]:
+        return self.get_all(collection=collection)
+
+    def delete(self, key: str, collection: str = DEFAULT_COLLECTION) -> bool:
+        with self._lock:
+            cursor = self._connection.execute("DELETE FROM kv_store WHERE collection = ? AND key = ?", (collection, key))
+        return cursor.rowcount > 0
+
+    async def adelete(self, key: str, collection: str = DEFAULT_COLLECTION) -> bool:
+        return self.delete(key, collection=collection)
+
+    def migrate_from_simple_kv_store_file(self, json_path: str) -> int:
+        """
+        Import the collections of a persisted SimpleKVStore json file, then rename the file so that it is only imported once
+        The keys already in the database are kept as they are newer than the file
+        Returns the number of imported keys
+        """
+        with self._lock:
+            # Hold the write lock while checking the file so that only one process imports it
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                if not os.path.exists(json_path):
+                    self._connection.execute("ROLLBACK")
+                    return 0
+                with open(json_path, "r") as f:
+                    data: Dict[str, Dict[str, dict]] = json.load(f)
+                rows = [(collection, key, json.dumps(val)) for collection, collection_data in data.items() for key, val in collection_data.items()]
+                self._connection.executemany("INSERT OR IGNORE INTO kv_store (collection, key, value) VALUES (?, ?, ?)", rows)
+                # Renamed before the commit while the write lock is held, another process can not find the file between the two
+                os.replace(json_path, f"{json_path}.migrated")
+            except Exception:
+                self._connection.execute("ROLLBACK")
+                raise
+            try:
+                self._connection.execute("COMMIT")
+            except Exception:
+                # Nothing was imported, the file is imported again on the next open
+                os.replace(f"{json_path}.migrated", json_path)
+                if self._connection.in_transaction:
+                    self._connection.execute("ROLLBACK")
+                raise
+        return len(rows)
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+class SqliteDocumentStore(KVDocumentStore):
+    """
+    Document store on a SqliteKVStore, the changes are written when they are made so it does not need to be persisted
+    """
+    def __init__(self, db_path: str, namespace: Optional[str] = None, batch_size: int = DEFAULT_BATCH_SIZE):
+        super().__init__(SqliteKVStore(db_path), namespace=namespace, batch_size=batch_size)
+
+    @classmethod
+    def from_db_path(cls, db_path: str, simple_doc_store_json_path: Optional[str] = None) -> "SqliteDocumentStore":
+        """Open the document store of a database, importing the SimpleDocumentStore json file persisted before it if there is one"""
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        doc_store = cls(db_path)
+        if simple_doc_store_json_path and os.path.exists(simple_doc_store_json_path):
+            imported_keys_count = doc_store._kvstore.migrate_from_simple_kv_store_file(simple_doc_store_json_path)
+            if imported_keys_count:
+                logger.info(f"Migrated {imported_keys_count} docstore keys from {simple_doc_store_json_path} to {db_path}")
+        return doc_store
+
+    def close(self) -> None:
+        self._kvstore.close()
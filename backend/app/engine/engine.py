@@ -1,4 +1,5 @@
 from typing import List
+from contextlib import ExitStack
 
 from llama_index.core.agent.react import ReActAgent, ReActChatFormatter
 from llama_index.core.agent import AgentRunner
@@ -8,7 +9,7 @@ from llama_index.core.llms import LLM
 from sqlalchemy.orm import Session
 #from app.engine.tools import ToolFactory
 from app.settings.model_initialization import init_embedding_model
-from app.datasources.file_manager.service.llama_index import create_query_tool, create_vector_store, create_doc_store
+from app.datasources.file_manager.service.llama_index import create_query_tool, datasource_stores
 from app.settings.schemas import SettingResponse, AppSettings
 from app.settings.service import get_setting
 from app.datasources.database.models import Datasource
@@ -21,6 +22,7 @@ logger = logging.getLogger("uvicorn")
 def get_chat_engine(datasources_db_session: Session,
                     settings_db_session: Session,
                     user_uuid: str,
+                    stores_exit_stack: ExitStack,
                     llm: LLM,
                     max_iterations: int,
                     system_prompt: str,
@@ -29,6 +31,10 @@ def get_chat_engine(datasources_db_session: Session,
                     params=None,
                     event_handlers=None,
                     **kwargs) -> AgentRunner:
+    """
+    Create the chat engine with the query tools of the datasources
+    The stores of the datasources are held until stores_exit_stack is closed, it must stay open while the chat engine is used
+    """
     try:
         # The tools that will be used by the agent
         tools: List[BaseTool] = []
@@ -39,9 +45,10 @@ def get_chat_engine(datasources_db_session: Session,
         if datasource_identifier:
             # Get the corresponding datasource
             datasource = datasources_db_session.query(Datasource).filter(Datasource.identifier == datasource_identifier).first()
-            # Get the vector store and doc store from the datasource identifier
-            vector_store = create_vector_store(datasource.identifier, user_uuid)
-            doc_store = create_doc_store(datasource.identifier, user_uuid)
+            # Get the open vector store and doc store of the datasource, shared with the other requests and the processing
+            stores = stores_exit_stack.enter_context(datasource_stores(datasource.identifier, user_uuid))
+            vector_store = stores.vector_store
+            doc_store = stores.doc_store
             # Get the embedding model setting for the datasource
             embedding_model_setting = get_setting(settings_db_session=settings_db_session, identifier=datasource.embedding_setting_identifier)
             # Init the embedding model from the app settings
@@ -60,9 +67,10 @@ def get_chat_engine(datasources_db_session: Session,
             # Get all datasource tools
             datasources = datasources_db_session.query(Datasource).all()
             for datasource in datasources:
-                # Get the vector store and doc store from the datasource identifier
-                vector_store = create_vector_store(datasource.identifier, user_uuid)
-                doc_store = create_doc_store(datasource.identifier, user_uuid)
+                # Get the open vector store and doc store of the datasource, shared with the other requests and the processing
+                stores = stores_exit_stack.enter_context(datasource_stores(datasource.identifier, user_uuid))
+                vector_store = stores.vector_store
+                doc_store = stores.doc_store
                 # Get the embedding model setting for the datasource
                 embedding_model_setting = get_setting(settings_db_session=settings_db_session, identifier=datasource.embedding_setting_identifier)
                 # Init the embedding model from the app settings
@@ -0,0 +1,38 @@
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import PlainTextResponse
+from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from typing import Annotated
+import os
+import secrets
+
+from app.api.metrics import render_metrics_prometheus
+
+import logging
+logger = logging.getLogger("uvicorn")
+
+# Bearer token the metrics scraper must send, the metrics endpoint is disabled if it is not set
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+
+metrics_bearer_scheme = HTTPBearer(auto_error=False)
+
+metrics_router = r = APIRouter()
+
+def verify_metrics_token(credentials: Annotated[HTTPAuthorizationCredentials | None, Depends(metrics_bearer_scheme)]) -> None:
+    """
+    Check the token of the metrics scraper, the metrics are not tied to a user so the user tokens are not accepted
+    """
+    if not METRICS_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if credentials is None or not secrets.compare_digest(credentials.credentials.encode(), METRICS_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Invalid metrics token", headers={"WWW-Authenticate": "Bearer"})
+
+@r.get("", response_class=PlainTextResponse, dependencies=[Depends(verify_metrics_token)])
+async def metrics_route() -> PlainTextResponse:
+    """
+    Get the metrics of all the workers of the host in the Prometheus text format
+    """
+    try:
+        return PlainTextResponse(render_metrics_prometheus(), media_type="text/plain; version=0.0.4")
+    except Exception as e:
+        logger.error(f"Error rendering metrics: {str(e)}")
+        raise HTTPException(status_code=500, detail="Error rendering metrics")
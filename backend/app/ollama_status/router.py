@@ -1,16 +1,24 @@
 from fastapi import APIRouter, Depends, BackgroundTasks, HTTPException, WebSocket
+from fastapi.concurrency import run_in_threadpool
 from app.settings.database.session import get_settings_db_session
 from app.auth.service import get_keyring_with_access_sk_token
+from app.auth.dependencies import get_user_uuid_from_token
+from app.api.mount_user_data_dir import mount_user_data_dir_dependency
 from sqlalchemy.orm import Session
 import logging
+import os
+import time
 from app.api.websocket import StatusWebSocket
 from fastapi import WebSocketDisconnect
 from app.ollama_status.schemas import OllamaStatusResponse
-from app.ollama_status.service import can_process
-from typing import Annotated
+from app.ollama_status.service import can_process, get_ollama_models_pulls_in_flight_on_host, is_ollama_model_pull_in_flight, _get_ollama_models_to_check
+from typing import Annotated, List, Tuple
 
 logger = logging.getLogger("uvicorn")
 
+# The ollama models of the settings of a user are read again at this interval by the status websockets
+OLLAMA_STATUS_USER_MODELS_REFRESH_SECONDS = float(os.environ.get("OLLAMA_STATUS_USER_MODELS_REFRESH_SECONDS", 30))
+
 ollama_status_router = r = APIRouter()
 
 @r.get("", response_model=OllamaStatusResponse)
@@ -21,7 +29,8 @@ async def get_ollama_status_route(
     """Get the current status of Ollama model downloads"""
     try:
         #logger.info(f"Getting Ollama status")
-        if not await can_process(settings_db_session, True): # Don't download models, it will be done on file processing
+        # The installed models are read from the cache of the ollama servers
+        if not await can_process(settings_db_session, False): # Don't download models, it will be done on file processing
             return {"is_downloading": True}
         else:
             return {"is_downloading": False}
@@ -36,13 +45,33 @@ async def ollama_status_websocket_route(
     websocket: WebSocket,
     token: str
 ):
-    """WebSocket endpoint for Ollama status updates"""
+    """WebSocket endpoint for Ollama status updates, only the pulls of the models of the user settings are reported"""
+    user_uuid = get_user_uuid_from_token(token)
+    user_ollama_models: List[Tuple[str, str]] = []
+    user_ollama_models_refresh_time = float("-inf")
+
+    async def get_user_ollama_models() -> List[Tuple[str, str]]:
+        nonlocal user_ollama_models, user_ollama_models_refresh_time
+        if time.monotonic() - user_ollama_models_refresh_time < OLLAMA_STATUS_USER_MODELS_REFRESH_SECONDS:
+            return user_ollama_models
+        try:
+            async with mount_user_data_dir_dependency(user_uuid):
+                keyring = await run_in_threadpool(get_keyring_with_access_sk_token, token)
+                settings_db_session = await run_in_threadpool(get_settings_db_session, keyring)
+                user_ollama_models = await run_in_threadpool(_get_ollama_models_to_check, settings_db_session)
+        except Exception as e:
+            # Keep the last known models and try again at the next refresh
+            logger.error(f"Error getting the ollama models of user {user_uuid}: {str(e)}")
+        user_ollama_models_refresh_time = time.monotonic()
+        return user_ollama_models
+
     async def get_status():
-        #keyring = get_keyring_with_access_sk_token(token)
-        #with get_settings_db_session(keyring) as settings_db_session:
-        is_downloading = False #not await can_process(settings_db_session, False)
-        # TODO !
-        return {"is_downloading": is_downloading}
+        ollama_models = await get_user_ollama_models()
+        if not ollama_models:
+            return {"is_downloading": False}
+        # The pulls of all the workers of the host, the pulls are started by the processing of any worker
+        ollama_models_pulls = await run_in_threadpool(get_ollama_models_pulls_in_flight_on_host)
+        return {"is_downloading": any(is_ollama_model_pull_in_flight(ollama_models_pulls, base_url, model_name) for base_url, model_name in ollama_models)}
     
     status_ws = StatusWebSocket(websocket, get_status)
     await status_ws.accept()
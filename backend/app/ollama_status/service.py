@@ -1,130 +1,261 @@
 import logging
-from typing import List
+from typing import Dict, List, Set, Tuple
 from app.settings.schemas import OllamaLLMSettings, OllamaEmbedSettings, SettingResponse, AppSettings
 import httpx
+import os
+import json
 import time
+import fcntl
+import hashlib
+import weakref
+import asyncio
+import threading
+import concurrent.futures
 from sqlalchemy.orm import Session
 from app.settings.service import get_setting, get_all_settings_with_schema_identifier
 
 logger = logging.getLogger("uvicorn")
 
+# The installed models of an ollama server are cached so that the status checks and the processing starts do not call the server each time
+OLLAMA_INSTALLED_MODELS_CACHE_TTL_SECONDS = float(os.environ.get("OLLAMA_INSTALLED_MODELS_CACHE_TTL_SECONDS", 30))
+# An unreachable server is cached for less time so that it is used again soon after it comes back
+OLLAMA_UNREACHABLE_CACHE_TTL_SECONDS = float(os.environ.get("OLLAMA_UNREACHABLE_CACHE_TTL_SECONDS", 5))
+# Timeout of the requests to the ollama servers except the model pulls that can take minutes
+OLLAMA_REQUEST_TIMEOUT_SECONDS = 10
+
+# Pooled http client of each ollama server, per event loop as the api and each processing worker thread run their own loop
+ollama_http_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, httpx.AsyncClient]]" = weakref.WeakKeyDictionary()
+ollama_http_clients_lock = threading.Lock()
+
+# Installed models of each ollama server with their expiration time, None if the server is unreachable
+ollama_installed_models_cache: Dict[str, Tuple[float, Set[str] | None]] = {}
+ollama_installed_models_cache_lock = threading.Lock()
+
+# Pulls in progress on this host, the worker pulling a model holds a lock on the marker file of the pull so that the pulls of a crashed worker are not reported
+OLLAMA_MODELS_PULLS_DIR_PATH = "/data/.ollama_models_pulls"
+
+# Pulls in progress by server and model, the concurrent callers of any event loop wait for the same pull
+ollama_models_pulls_in_flight: Dict[Tuple[str, str], concurrent.futures.Future] = {}
+ollama_models_pulls_in_flight_lock = threading.Lock()
+
+def _get_ollama_http_client(base_url: str) -> httpx.AsyncClient:
+    """Get the pooled client of an ollama server for the running event loop"""
+    loop = asyncio.get_running_loop()
+    with ollama_http_clients_lock:
+        loop_clients = ollama_http_clients.setdefault(loop, {})
+        client = loop_clients.get(base_url)
+        if client is None or client.is_closed:
+            client = httpx.AsyncClient(base_url=base_url, timeout=OLLAMA_REQUEST_TIMEOUT_SECONDS)
+            loop_clients[base_url] = client
+        return client
+
+def _normalize_ollama_base_url(base_url: str) -> str:
+    return base_url.rstrip("/")
+
+def _get_ollama_model_full_name(model_name: str) -> str:
+    """The installed models are listed with their tag"""
+    return f"{model_name}:latest" if ':' not in model_name else model_name
+
+async def get_ollama_installed_models(base_url: str, refresh: bool = False) -> Set[str] | None:
+    """
+    Get the installed models of an ollama server from the cache or from the server if expired, None if the server is unreachable
+    """
+    base_url = _normalize_ollama_base_url(base_url)
+    if not refresh:
+        with ollama_installed_models_cache_lock:
+            cached_installed_models = ollama_installed_models_cache.get(base_url)
+        if cached_installed_models is not None and cached_installed_models[0] > time.monotonic():
+            return cached_installed_models[1]
+
+    installed_models = None
+    try:
+        response = await _get_ollama_http_client(base_url).get("/api/tags")
+        if response.status_code == 200:
+            installed_models = {model['name'] for model in response.json()['models']}
+    except Exception as e:
+        #logger.error(f"Error getting the installed models of ollama server {base_url}: {str(e)}")
+        pass
+
+    ttl_seconds = OLLAMA_INSTALLED_MODELS_CACHE_TTL_SECONDS if installed_models is not None else OLLAMA_UNREACHABLE_CACHE_TTL_SECONDS
+    with ollama_installed_models_cache_lock:
+        ollama_installed_models_cache[base_url] = (time.monotonic() + ttl_seconds, installed_models)
+    return installed_models
+
+def invalidate_ollama_installed_models(base_url: str) -> None:
+    """Drop the cached installed models of an ollama server, eg. after a model was pulled"""
+    with ollama_installed_models_cache_lock:
+        ollama_installed_models_cache.pop(_normalize_ollama_base_url(base_url), None)
+
+def _get_ollama_model_pull_marker_path(pull_key: Tuple[str, str]) -> str:
+    """The marker of a model is always the same file so that the markers of the crashed workers do not pile up"""
+    return os.path.join(OLLAMA_MODELS_PULLS_DIR_PATH, f"{hashlib.sha256(json.dumps(pull_key).encode()).hexdigest()}.json")
+
+def _create_ollama_model_pull_marker(pull_key: Tuple[str, str]) -> int | None:
+    """Lock and write the marker of a pull, returns its file descriptor or None if another worker of the host is pulling the same model"""
+    os.makedirs(OLLAMA_MODELS_PULLS_DIR_PATH, exist_ok=True)
+    marker_fd = os.open(_get_ollama_model_pull_marker_path(pull_key), os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(marker_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(marker_fd)
+        return None
+    os.ftruncate(marker_fd, 0)
+    os.write(marker_fd, json.dumps({"base_url": pull_key[0], "model": pull_key[1]}).encode())
+    return marker_fd
+
+def _remove_ollama_model_pull_marker(pull_key: Tuple[str, str], marker_fd: int) -> None:
+    """Remove the marker of a pull before unlocking it so that the readers waiting for the lock see the pull as done"""
+    try:
+        os.remove(_get_ollama_model_pull_marker_path(pull_key))
+    except FileNotFoundError:
+        pass
+    finally:
+        os.close(marker_fd)
+
+def get_ollama_models_pulls_in_flight_on_host() -> Set[Tuple[str, str]]:
+    """Get the servers and full names of the models being pulled by any worker of this host, it reads the marker files and blocks"""
+    ollama_models_pulls: Set[Tuple[str, str]] = set()
+    try:
+        marker_files = [f for f in os.listdir(OLLAMA_MODELS_PULLS_DIR_PATH) if f.endswith(".json")]
+    except FileNotFoundError:
+        return ollama_models_pulls
+    for marker_file in marker_files:
+        try:
+            with open(os.path.join(OLLAMA_MODELS_PULLS_DIR_PATH, marker_file), "r") as f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                    # Not locked by a worker, the pull is done or its worker crashed
+                    continue
+                except BlockingIOError:
+                    pass
+                marker = json.load(f)
+            ollama_models_pulls.add((marker["base_url"], marker["model"]))
+        except (FileNotFoundError, ValueError, KeyError):
+            # Removed or not written yet
+            continue
+    return ollama_models_pulls
+
+def is_ollama_model_pull_in_flight(ollama_models_pulls: Set[Tuple[str, str]], base_url: str, model_name: str) -> bool:
+    """Check if a model is among the pulls in progress returned by get_ollama_models_pulls_in_flight_on_host"""
+    return (_normalize_ollama_base_url(base_url), _get_ollama_model_full_name(model_name)) in ollama_models_pulls
+
 async def _download_ollama_model(base_url: str, model_name: str):
-    """Download a model"""
+    """Download a model, the concurrent downloads of the same model wait for the first one"""
     if not model_name or not model_name.strip():
         return
-        
+
+    base_url = _normalize_ollama_base_url(base_url)
+    pull_key = (base_url, _get_ollama_model_full_name(model_name))
+    with ollama_models_pulls_in_flight_lock:
+        pull_future = ollama_models_pulls_in_flight.get(pull_key)
+        is_pull_owner = pull_future is None
+        if is_pull_owner:
+            pull_future = concurrent.futures.Future()
+            ollama_models_pulls_in_flight[pull_key] = pull_future
+
+    if not is_pull_owner:
+        logger.info(f"Model {model_name} is already being pulled, waiting for it")
+        await asyncio.wrap_future(pull_future)
+        return
+
+    marker_fd = None
     try:
-        async with httpx.AsyncClient() as client:
-            logger.info(f"Pulling model: {model_name}")
-            response = await client.post(
-                f"{base_url}/api/pull",
-                json={"name": model_name},
-                timeout=None
-            )
-            response.raise_for_status()
-            logger.info(f"Successfully pulled model: {model_name}")
-        
+        try:
+            marker_fd = _create_ollama_model_pull_marker(pull_key)
+        except Exception as e:
+            # The pull is only not reported to the status websockets
+            logger.error(f"Failed to create the pull marker of model {model_name}: {str(e)}")
+        logger.info(f"Pulling model: {model_name}")
+        response = await _get_ollama_http_client(base_url).post(
+            "/api/pull",
+            json={"name": model_name},
+            timeout=None
+        )
+        response.raise_for_status()
+        logger.info(f"Successfully pulled model: {model_name}")
+        pull_future.set_result(None)
+
     except Exception as e:
         logger.error(f"Error downloading model {model_name}: {str(e)}")
+        pull_future.set_exception(e)
         raise e
-        
-async def _check_ollama_model(base_url: str, model_name: str):
+    finally:
+        # A cancelled pull is cancelled for its waiters too
+        if not pull_future.done():
+            pull_future.cancel()
+        if marker_fd is not None:
+            _remove_ollama_model_pull_marker(pull_key, marker_fd)
+        with ollama_models_pulls_in_flight_lock:
+            ollama_models_pulls_in_flight.pop(pull_key, None)
+        invalidate_ollama_installed_models(base_url)
+
+async def _check_ollama_model(base_url: str, model_name: str, refresh: bool = False):
     """Check if a model is installed"""
     if not model_name or not model_name.strip():
         return True
-        
-    try:
-        async with httpx.AsyncClient() as client:
-            #logger.info(f"Checking model: {model_name}")
-            response = await client.get(f"{base_url}/api/tags")
-            if response.status_code == 200:
-                models_data = response.json()
-                installed_models = [model['name'] for model in models_data['models']]
-                
-                model_name_to_check = f"{model_name}:latest" if ':' not in model_name else model_name
-                
-                if model_name_to_check not in installed_models:
-                    return False
-                
-                return True
-            
-    except Exception as e:
-        logger.error(f"Error checking/pulling model {model_name}: {str(e)}")
-        return False
+
+    installed_models = await get_ollama_installed_models(base_url, refresh)
+    return installed_models is not None and _get_ollama_model_full_name(model_name) in installed_models
 
 async def is_ollama_server_reachable(base_url: str) -> bool:
     """Check if the ollama server is reachable"""
-    try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(f"{base_url}/api/tags")
-            return response.status_code == 200
-    except Exception as e:
-        #logger.error(f"Error checking if ollama server is reachable: {str(e)}")
-        return False
+    return await get_ollama_installed_models(base_url) is not None
+
+def _get_ollama_models_to_check(settings_db_session: Session) -> List[Tuple[str, str]]:
+    """Get the ollama servers and models used by the embedding settings and the llm, each pair once"""
+    ollama_models: Dict[Tuple[str, str], None] = {}
+    # TODO Also check for other models
+    # Get all embedding settings that have the schema_identifier "ollama_embed"
+    embedding_settings : List[SettingResponse] = get_all_settings_with_schema_identifier(settings_db_session, "ollama_embed")
+    # TODO Check only for the ones currently used in datasources
+    for embedding_setting in embedding_settings:
+        ollama_embed_settings : OllamaEmbedSettings = OllamaEmbedSettings.model_validate_json(embedding_setting.value_json)
+        ollama_models[(_normalize_ollama_base_url(ollama_embed_settings.host), ollama_embed_settings.model)] = None
+
+    # Check llm model
+    app_settings_response : SettingResponse = get_setting(settings_db_session, "app")
+    app_settings : AppSettings = AppSettings.model_validate_json(app_settings_response.value_json)
+    # Get the llm setting
+    llm_setting : SettingResponse = get_setting(settings_db_session, app_settings.llm_setting_identifier)
+    # TODO Check only for the ones currently used in agents
+    if llm_setting.schema_identifier == "ollama_llm":
+        ollama_llm_settings : OllamaLLMSettings = OllamaLLMSettings.model_validate_json(llm_setting.value_json)
+        ollama_models[(_normalize_ollama_base_url(ollama_llm_settings.host), ollama_llm_settings.model)] = None
+    return list(ollama_models.keys())
 
-# If you dont want to pull the models if not available, set background_tasks to None
+# If you dont want to pull the models if not available, set download_models to False
 async def can_process(settings_db_session: Session, download_models: bool = True) -> bool:
-    """Check if Ollama models are ready for processing"""
+    """Check if Ollama models are ready for processing, the installed models are read from the cache"""
     try:
-        # TODO Also check for other models
-        # Get all embedding settings that have the schema_identifier "ollama_embed"
-        embedding_settings : List[SettingResponse] = get_all_settings_with_schema_identifier(settings_db_session, "ollama_embed")
-        # TODO Check only for the ones currently used in datasources
-        # Check if any datasource is using ollama
-        for embedding_setting in embedding_settings:
-            ollama_embed_settings : OllamaEmbedSettings = OllamaEmbedSettings.model_validate_json(embedding_setting.value_json)
+        for base_url, model_name in _get_ollama_models_to_check(settings_db_session):
             # Check if the ollama server is reachable
-            if not await is_ollama_server_reachable(ollama_embed_settings.host):
+            if not await is_ollama_server_reachable(base_url):
                 # We can't process files if the ollama server is not reachable, skip this processing request
                 #logger.error("Ollama server is not reachable, skipping processing request")
                 return False
-            if not await _check_ollama_model(ollama_embed_settings.host, ollama_embed_settings.model):
-                logger.info(f"Model {ollama_embed_settings.model} not found, downloading...")
+            if not await _check_ollama_model(base_url, model_name):
+                logger.info(f"Model {model_name} not found, downloading...")
                 if download_models:
-                    await _download_ollama_model(ollama_embed_settings.host, ollama_embed_settings.model)
+                    await _download_ollama_model(base_url, model_name)
                     # Check again if the model is installed
-                    if not await _check_ollama_model(ollama_embed_settings.host, ollama_embed_settings.model):
-                        logger.error(f"Model {ollama_embed_settings.model} still not found after downloading")
+                    if not await _check_ollama_model(base_url, model_name, refresh=True):
+                        logger.error(f"Model {model_name} still not found after downloading")
                         return False
                 else:
                     return False
-                    
-        # Check llm model
-        app_settings_response : SettingResponse = get_setting(settings_db_session, "app")
-        app_settings : AppSettings = AppSettings.model_validate_json(app_settings_response.value_json)
-        # Get the llm setting
-        llm_setting : SettingResponse = get_setting(settings_db_session, app_settings.llm_setting_identifier)
-        # TODO Check only for the ones currently used in agents
-        if llm_setting.schema_identifier == "ollama_llm":
-            ollama_llm_settings : OllamaLLMSettings = OllamaLLMSettings.model_validate_json(llm_setting.value_json)
-            # Check if the ollama server is reachable
-            if not await is_ollama_server_reachable(ollama_llm_settings.host):
-                # We can't process files if the ollama server is not reachable, skip this processing request
-                logger.error("Ollama server is not reachable, skipping processing request")
-                return False
-            if not await _check_ollama_model(ollama_llm_settings.host, ollama_llm_settings.model):
-                logger.info(f"Model {ollama_llm_settings.model} not found, downloading...")
-                if download_models:
-                    await _download_ollama_model(ollama_llm_settings.host, ollama_llm_settings.model)
-                    # Check again if the model is installed
-                    if not await _check_ollama_model(ollama_llm_settings.host, ollama_llm_settings.model):
-                        logger.error(f"Model {ollama_llm_settings.model} still not found after downloading")
-                        return False
-                else:
-                    return False
-        
+
         # If all models are installed or ollama is not used, return True
         return True
     except Exception as e:
         logger.error(f"Error checking if can process: {str(e)}")
-        return False 
-    
+        return False
+
 async def trigger_download_and_wait_for_ollama_models_to_be_downloaded(settings_db_session: Session):
     """Wait for Ollama models to be ready"""
     while True:
         # Check if we need to wait for Ollama models without pulling them if they don't exist
         if await can_process(settings_db_session, True):
             return
-        
+
         logger.info("Waiting for Ollama models to be ready before processing files...")
-        time.sleep(1)
\ No newline at end of file
+        await asyncio.sleep(1)
@@ -0,0 +1,129 @@
+from app.api.metrics import get_counter, get_histogram
+from app.settings.schemas import OllamaLLMSettings, OllamaEmbedSettings, SettingResponse, AppSettings
+from app.settings.service import get_setting, get_all_settings_with_schema_identifier
+from app.ollama_status.service import _get_ollama_http_client, _normalize_ollama_base_url, _get_ollama_model_full_name, _check_ollama_model
+
+from sqlalchemy.orm import Session
+from typing import Dict, List, Tuple
+import os
+import time
+import asyncio
+import threading
+
+import logging
+logger = logging.getLogger("uvicorn")
+
+# A model is not pre-warmed again before this delay, its keep alive keeps it loaded in between
+OLLAMA_MODELS_PREWARM_MIN_INTERVAL_SECONDS = float(os.environ.get("OLLAMA_MODELS_PREWARM_MIN_INTERVAL_SECONDS", 60))
+
+OLLAMA_MODEL_KIND_EMBEDDING = "embedding"
+OLLAMA_MODEL_KIND_LLM = "llm"
+
+ollama_model_cold_starts_counter = get_counter(
+    "idapt_ollama_model_cold_starts_total",
+    "Number of times an ollama model was not loaded when it was pre-warmed",
+    ("kind", "model")
+)
+ollama_model_load_duration_histogram = get_histogram(
+    "idapt_ollama_model_load_seconds",
+    "Duration of the loading of the ollama models that were not loaded when pre-warmed",
+    ("kind", "model"),
+    (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+)
+
+class OllamaModelWarmup:
+    """Ollama model to pre-warm with the keep alive of its setting"""
+    def __init__(self, kind: str, base_url: str, model_name: str, keep_alive: str):
+        self.kind = kind
+        self.base_url = _normalize_ollama_base_url(base_url)
+        self.model_name = model_name
+        self.keep_alive = keep_alive
+
+# Last pre-warm time and pre-warm in progress of each ollama server and model
+ollama_models_last_prewarm_times: Dict[Tuple[str, str], float] = {}
+ollama_models_prewarms_in_flight: Dict[Tuple[str, str], asyncio.Task] = {}
+ollama_models_prewarm_lock = threading.Lock()
+
+def _get_ollama_models_to_prewarm(settings_db_session: Session) -> List[OllamaModelWarmup]:
+    """Get the ollama models of the embedding settings and of the llm"""
+    ollama_models_warmups: List[OllamaModelWarmup] = []
+    embedding_settings : List[SettingResponse] = get_all_settings_with_schema_identifier(settings_db_session, "ollama_embed")
+    for embedding_setting in embedding_settings:
+        ollama_embed_settings : OllamaEmbedSettings = OllamaEmbedSettings.model_validate_json(embedding_setting.value_json)
+        ollama_models_warmups.append(OllamaModelWarmup(OLLAMA_MODEL_KIND_EMBEDDING, ollama_embed_settings.host, ollama_embed_settings.model, ollama_embed_settings.keep_alive))
+
+    app_settings_response : SettingResponse = get_setting(settings_db_session, "app")
+    app_settings : AppSettings = AppSettings.model_validate_json(app_settings_response.value_json)
+    llm_setting : SettingResponse = get_setting(settings_db_session, app_settings.llm_setting_identifier)
+    if llm_setting.schema_identifier == "ollama_llm":
+        ollama_llm_settings : OllamaLLMSettings = OllamaLLMSettings.model_validate_json(llm_setting.value_json)
+        ollama_models_warmups.append(OllamaModelWarmup(OLLAMA_MODEL_KIND_LLM, ollama_llm_settings.host, ollama_llm_settings.model, ollama_llm_settings.keep_alive))
+    return ollama_models_warmups
+
+def schedule_ollama_models_prewarm(settings_db_session: Session) -> None:
+    """
+    Load the ollama models in the background before they are used, eg. when files are queued or a chat is opened
+    The settings are read now as the session is closed with the request
+    """
+    try:
+        ollama_models_warmups = _get_ollama_models_to_prewarm(settings_db_session)
+    except Exception as e:
+        logger.error(f"Failed to get the ollama models to pre-warm: {str(e)}")
+        return
+
+    now = time.monotonic()
+    with ollama_models_prewarm_lock:
+        for ollama_model_warmup in ollama_models_warmups:
+            prewarm_key = (ollama_model_warmup.base_url, _get_ollama_model_full_name(ollama_model_warmup.model_name))
+            if prewarm_key in ollama_models_prewarms_in_flight:
+                continue
+            if now - ollama_models_last_prewarm_times.get(prewarm_key, float("-inf")) < OLLAMA_MODELS_PREWARM_MIN_INTERVAL_SECONDS:
+                continue
+            ollama_models_last_prewarm_times[prewarm_key] = now
+            prewarm_task = asyncio.create_task(_prewarm_ollama_model(ollama_model_warmup))
+            ollama_models_prewarms_in_flight[prewarm_key] = prewarm_task
+            def _on_prewarm_done(done_prewarm_task: asyncio.Task, prewarm_key: Tuple[str, str] = prewarm_key):
+                with ollama_models_prewarm_lock:
+                    ollama_models_prewarms_in_flight.pop(prewarm_key, None)
+                # Retrieve the error so that it is not reported as unhandled as nobody waits for a pre-warm
+                if not done_prewarm_task.cancelled() and done_prewarm_task.exception() is not None:
+                    logger.error(f"Error pre-warming ollama model {prewarm_key[1]}: {done_prewarm_task.exception()}")
+            prewarm_task.add_done_callback(_on_prewarm_done)
+
+async def _is_ollama_model_loaded(base_url: str, model_name: str) -> bool:
+    """Check if a model is loaded in the memory of the ollama server"""
+    response = await _get_ollama_http_client(base_url).get("/api/ps")
+    response.raise_for_status()
+    return _get_ollama_model_full_name(model_name) in {model['name'] for model in response.json()['models']}
+
+async def _prewarm_ollama_model(ollama_model_warmup: OllamaModelWarmup) -> None:
+    """
+    Load a model with a request without content, it also extends the time the model stays loaded
+    The models not installed are skipped, they are pulled by the processing
+    """
+    if not await _check_ollama_model(ollama_model_warmup.base_url, ollama_model_warmup.model_name):
+        return
+
+    is_loaded = await _is_ollama_model_loaded(ollama_model_warmup.base_url, ollama_model_warmup.model_name)
+    client = _get_ollama_http_client(ollama_model_warmup.base_url)
+    load_start_time = time.perf_counter()
+    if ollama_model_warmup.kind == OLLAMA_MODEL_KIND_EMBEDDING:
+        response = await client.post(
+            "/api/embed",
+            json={"model": ollama_model_warmup.model_name, "input": "", "keep_alive": ollama_model_warmup.keep_alive},
+            timeout=None
+        )
+    else:
+        # A generate request without prompt only loads the model
+        response = await client.post(
+            "/api/generate",
+            json={"model": ollama_model_warmup.model_name, "keep_alive": ollama_model_warmup.keep_alive},
+            timeout=None
+        )
+    response.raise_for_status()
+
+    if not is_loaded:
+        load_seconds = time.perf_counter() - load_start_time
+        ollama_model_cold_starts_counter.inc(kind=ollama_model_warmup.kind, model=ollama_model_warmup.model_name)
+        ollama_model_load_duration_histogram.observe(load_seconds, kind=ollama_model_warmup.kind, model=ollama_model_warmup.model_name)
+        logger.info(f"Pre-warmed ollama {ollama_model_warmup.kind} model {ollama_model_warmup.model_name} in {load_seconds:.2f}s")
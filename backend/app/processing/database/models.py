@@ -0,0 +1,50 @@
+from sqlalchemy import Column, String, DateTime, Integer, Enum, UniqueConstraint
+import enum
+from datetime import datetime
+from sqlalchemy.ext.declarative import declarative_base
+
+Base = declarative_base()
+
+class ProcessingJobStatus(enum.Enum):
+    QUEUED = "queued"
+    LEASED = "leased"
+    FAILED = "failed"
+
+class ProcessingJobPriority(enum.IntEnum):
+    """Lanes of the processing queue, the lower lanes are leased first"""
+    INTERACTIVE = 0
+    NORMAL = 1
+    BULK = 2
+
+class ProcessingJob(Base):
+    """
+    Durable processing job of a queued file, the job is deleted once the file is processed
+    A leased job whose lease is expired has been interrupted and can be leased again
+    """
+    __tablename__ = 'processing_jobs'
+    __table_args__ = (UniqueConstraint('datasource_name', 'file_id'),)
+
+    id = Column(Integer, primary_key=True)
+    datasource_name = Column(String, nullable=False)
+    file_manager_db_path = Column(String, nullable=False)
+    file_id = Column(Integer, nullable=False)
+    file_size = Column(Integer, nullable=False, default=0)
+    priority = Column(Integer, nullable=False, default=ProcessingJobPriority.NORMAL, server_default=str(int(ProcessingJobPriority.NORMAL)))
+
+    status = Column(Enum(ProcessingJobStatus), default=ProcessingJobStatus.QUEUED, nullable=False)
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False)
+    last_error = Column(String, nullable=True)
+    # Not leased before this time, used for the retries backoff
+    available_at = Column(DateTime, nullable=False, default=datetime.now)
+    # When the job was queued, not moved by the retries, used for the priority aging
+    enqueued_at = Column(DateTime, nullable=False, default=datetime.now)
+
+    # Lease of the scheduler processing the job
+    lease_owner = Column(String, nullable=True)
+    lease_expires_at = Column(DateTime, nullable=True)
+    heartbeat_at = Column(DateTime, nullable=True)
+
+    # System tracking
+    created_at = Column(DateTime, nullable=False, default=datetime.now)
+    updated_at = Column(DateTime, nullable=False, default=datetime.now, onupdate=datetime.now)
@@ -0,0 +1,32 @@
+from app.api.db_sessions import get_session
+from app.auth.schemas import Keyring
+from app.auth.dependencies import get_keyring_with_user_data_mounting_dependency
+from sqlalchemy.orm import Session
+from fastapi import Depends, HTTPException
+from pathlib import Path
+from typing import Annotated
+import logging
+
+logger = logging.getLogger("uvicorn")
+
+PROCESSING_DB_PATH = "/data/{user_uuid}/processing/processing.db"
+
+def get_processing_db_session(keyring: Annotated[Keyring, Depends(get_keyring_with_user_data_mounting_dependency)]) -> Session:
+    """
+    Get a session for the processing jobs database
+    """
+    try:
+        return get_processing_db_session_for_user(keyring.user_uuid)
+    except Exception as e:
+        logger.error(f"Error getting processing database session: {e}")
+        raise HTTPException(status_code=500, detail="Error getting processing database session")
+
+def get_processing_db_session_for_user(user_uuid: str) -> Session:
+    """
+    Get a session for the processing jobs database outside of a request, the jobs only reference files so the database does not need the keyring
+    """
+    db_path = PROCESSING_DB_PATH.format(user_uuid=user_uuid)
+    script_location = Path(__file__).parent
+    from app.processing.database.models import Base
+    with get_session(str(db_path), str(script_location), Base) as processing_db_session:
+        return processing_db_session
@@ -0,0 +1,32 @@
+"""Add processing job enqueued at
+
+Revision ID: 3a7f5d9c2e1b
+Revises: 8d2e4b6a1c3f
+Create Date: 2026-10-19 21:14:27.381052
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3a7f5d9c2e1b'
+down_revision: Union[str, None] = '8d2e4b6a1c3f'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    with op.batch_alter_table('processing_jobs', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('enqueued_at', sa.DateTime(), nullable=True))
+    # The existing jobs have been waiting since they were created
+    op.execute("UPDATE processing_jobs SET enqueued_at = created_at")
+    with op.batch_alter_table('processing_jobs', schema=None) as batch_op:
+        batch_op.alter_column('enqueued_at', existing_type=sa.DateTime(), nullable=False)
+
+
+def downgrade() -> None:
+    with op.batch_alter_table('processing_jobs', schema=None) as batch_op:
+        batch_op.drop_column('enqueued_at')
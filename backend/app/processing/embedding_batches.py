@@ -0,0 +1,240 @@
+from app.api.metrics import get_counter
+from app.datasources.file_manager.service.ingestion_cache import SqliteLRUCacheKVStore
+
+from llama_index.core.schema import BaseNode, MetadataMode, TransformComponent
+
+from typing import Dict, List, Sequence
+import os
+import json
+import hashlib
+import time
+import asyncio
+import threading
+
+import logging
+logger = logging.getLogger("uvicorn")
+
+# Bounds of the number of nodes sent to an embedding endpoint per request, the batch size adapts between them
+PROCESSING_EMBEDDING_MIN_BATCH_NODES = int(os.environ.get("PROCESSING_EMBEDDING_MIN_BATCH_NODES", 8))
+PROCESSING_EMBEDDING_BATCH_NODES = int(os.environ.get("PROCESSING_EMBEDDING_BATCH_NODES", 256))
+# Maximum number of in flight requests per embedding endpoint in this process, the concurrency adapts between 1 and it
+PROCESSING_EMBEDDING_MAX_CONCURRENCY = int(os.environ.get("PROCESSING_EMBEDDING_MAX_CONCURRENCY", 4))
+# Maximum number of in flight requests per endpoint for the embedding models sending one request per text, their requests are smaller
+PROCESSING_EMBEDDING_MAX_TEXT_CONCURRENCY = int(os.environ.get("PROCESSING_EMBEDDING_MAX_TEXT_CONCURRENCY", 8))
+# Requests slower than this are treated as a sign of overload of the endpoint
+PROCESSING_EMBEDDING_TARGET_LATENCY_SECONDS = float(os.environ.get("PROCESSING_EMBEDDING_TARGET_LATENCY_SECONDS", 5))
+PROCESSING_EMBEDDING_MAX_RETRIES = 2
+PROCESSING_EMBEDDING_RETRY_BACKOFF_SECONDS = 1
+# Polling interval bounds while waiting for an in flight request slot
+EMBEDDING_SLOT_POLL_MIN_INTERVAL_SECONDS = 0.005
+EMBEDDING_SLOT_POLL_MAX_INTERVAL_SECONDS = 0.1
+# Embedding models whose batch embedding sends one concurrent request per text, eg. ollama with /api/embeddings
+EMBEDDING_MODELS_WITH_ONE_REQUEST_PER_TEXT = {"OllamaEmbedding"}
+
+# The processing throughput in nodes/s is the rate of the embedded nodes over the rate of the embedding seconds
+processing_embedded_nodes_counter = get_counter(
+    "idapt_processing_embedded_nodes_total",
+    "Number of nodes embedded by the processing pipeline"
+)
+processing_embedding_seconds_counter = get_counter(
+    "idapt_processing_embedding_seconds_total",
+    "Time spent embedding nodes in the processing pipeline"
+)
+processing_embedding_requests_counter = get_counter(
+    "idapt_processing_embedding_requests_total",
+    "Number of embedding requests sent by the processing pipeline by result",
+    ("result",)
+)
+
+class EmbeddingEndpointLimiter:
+    """
+    Limit of the in flight requests and of the batch size for an embedding endpoint, shared by all the processing threads of the process
+    Both limits follow AIMD: they grow additively while the requests succeed under the target latency and are halved on errors or slow requests
+    """
+    def __init__(self, endpoint: str, max_concurrency: int = PROCESSING_EMBEDDING_MAX_CONCURRENCY, min_batch_size: int = PROCESSING_EMBEDDING_MIN_BATCH_NODES, max_batch_size: int = PROCESSING_EMBEDDING_BATCH_NODES, adaptive: bool = True):
+        self.endpoint = endpoint
+        self.max_concurrency = max(1, max_concurrency)
+        self.min_batch_size = max(1, min(min_batch_size, max_batch_size))
+        self.max_batch_size = max(1, max_batch_size)
+        self.adaptive = adaptive
+        # Start low and let the limits grow while the endpoint keeps up
+        self.concurrency = 1 if adaptive else self.max_concurrency
+        self.batch_size = self.min_batch_size if adaptive else self.max_batch_size
+        self._in_flight = 0
+        # Successes since the last concurrency increase, the concurrency grows by one per window of concurrency successes
+        self._successes_in_window = 0
+        self._lock = threading.Lock()
+
+    def _try_acquire(self) -> bool:
+        with self._lock:
+            if self._in_flight >= self.concurrency:
+                return False
+            self._in_flight += 1
+            return True
+
+    async def aacquire(self) -> None:
+        """Wait for an in flight request slot without blocking the event loop"""
+        poll_interval = EMBEDDING_SLOT_POLL_MIN_INTERVAL_SECONDS
+        while not self._try_acquire():
+            await asyncio.sleep(poll_interval)
+            poll_interval = min(poll_interval * 2, EMBEDDING_SLOT_POLL_MAX_INTERVAL_SECONDS)
+
+    def release(self) -> None:
+        with self._lock:
+            self._in_flight -= 1
+
+    def on_success(self, latency: float) -> None:
+        """Additive increase while the endpoint answers under the target latency, multiplicative decrease otherwise"""
+        processing_embedding_requests_counter.inc(result="success")
+        if not self.adaptive:
+            return
+        if latency > PROCESSING_EMBEDDING_TARGET_LATENCY_SECONDS:
+            self._decrease(f"slow request of {latency:.2f}s")
+            return
+        with self._lock:
+            self.batch_size = min(self.max_batch_size, self.batch_size + self.min_batch_size)
+            self._successes_in_window += 1
+            if self._successes_in_window >= self.concurrency:
+                self._successes_in_window = 0
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+
+    def on_error(self, error: Exception) -> None:
+        processing_embedding_requests_counter.inc(result="error")
+        if self.adaptive:
+            self._decrease(f"error {str(error)}")
+
+    def _decrease(self, reason: str) -> None:
+        with self._lock:
+            self.concurrency = max(1, self.concurrency // 2)
+            self.batch_size = max(self.min_batch_size, self.batch_size // 2)
+            self._successes_in_window = 0
+            concurrency, batch_size = self.concurrency, self.batch_size
+        logger.info(f"Reducing embedding load on {self.endpoint} after {reason}: concurrency {concurrency}, batch size {batch_size}")
+
+
+def _sends_one_request_per_text(embed_model: TransformComponent) -> bool:
+    return embed_model.class_name() in EMBEDDING_MODELS_WITH_ONE_REQUEST_PER_TEXT
+
+def _get_request_batch_size(embed_model: TransformComponent, limiter: "EmbeddingEndpointLimiter") -> int:
+    """
+    Number of nodes sent in one request, each of our batches must be a single request for the limiter to bound the in flight requests
+    The batches are not larger than the batch size of the embedding model so that it does not split them again
+    """
+    if _sends_one_request_per_text(embed_model):
+        return 1
+    return max(1, min(limiter.batch_size, getattr(embed_model, "embed_batch_size", None) or limiter.batch_size))
+
+
+embedding_endpoints_limiters: Dict[str, EmbeddingEndpointLimiter] = {}
+embedding_endpoints_limiters_lock = threading.Lock()
+
+def get_embedding_endpoint_limiter(embed_model: TransformComponent) -> EmbeddingEndpointLimiter:
+    """Get the limiter of the endpoint of an embedding model, the models created for each file share the limiter of their endpoint"""
+    base_url = getattr(embed_model, "base_url", None) or getattr(embed_model, "api_base", None)
+    endpoint = f"{type(embed_model).__name__}:{base_url}:{getattr(embed_model, 'model_name', None)}"
+    with embedding_endpoints_limiters_lock:
+        limiter = embedding_endpoints_limiters.get(endpoint)
+        if limiter is None:
+            if _sends_one_request_per_text(embed_model):
+                limiter = EmbeddingEndpointLimiter(endpoint, max_concurrency=PROCESSING_EMBEDDING_MAX_TEXT_CONCURRENCY, min_batch_size=1, max_batch_size=1)
+            else:
+                limiter = EmbeddingEndpointLimiter(endpoint)
+            embedding_endpoints_limiters[endpoint] = limiter
+        return limiter
+
+
+def get_embedding_cache_collection(embed_model: TransformComponent) -> str:
+    """
+    Cache collection of the embeddings of a model, only the settings changing the vectors are part of it so that the endpoint or the batch size can change
+    """
+    embedding_config = {
+        "class_name": type(embed_model).__name__,
+        "model_name": getattr(embed_model, "model_name", None),
+        "dimensions": getattr(embed_model, "dimensions", None),
+    }
+    return f"embeddings_{hashlib.sha256(json.dumps(embedding_config, sort_keys=True).encode()).hexdigest()[:16]}"
+
+def get_embedding_cache_key(node: BaseNode) -> str:
+    """The embedded content of a node, the same chunk in several files or after a retry has the same key"""
+    return hashlib.sha256(node.get_content(metadata_mode=MetadataMode.EMBED).encode()).hexdigest()
+
+async def aembed_nodes_in_batches(embed_model: TransformComponent, nodes: Sequence[BaseNode], limiter: EmbeddingEndpointLimiter | None = None, cache_store: SqliteLRUCacheKVStore | None = None) -> None:
+    """
+    Embed the nodes that do not have an embedding yet with concurrent requests to the embedding endpoint, the embeddings are set on the nodes
+    The batch size and the number of in flight requests follow the limiter of the endpoint
+    The embeddings found in the cache store are reused and the new ones are added to it
+    """
+    nodes_to_embed = [node for node in nodes if node.embedding is None]
+    if not nodes_to_embed:
+        return
+
+    cache_collection = None
+    if cache_store is not None:
+        cache_collection = get_embedding_cache_collection(embed_model)
+        nodes_cache_keys = {node.node_id: get_embedding_cache_key(node) for node in nodes_to_embed}
+        cached_embeddings = await asyncio.to_thread(cache_store.get_many, list(nodes_cache_keys.values()), cache_collection)
+        for node in nodes_to_embed:
+            cached_embedding = cached_embeddings.get(nodes_cache_keys[node.node_id])
+            if cached_embedding is not None:
+                node.embedding = cached_embedding["embedding"]
+        nodes_to_embed = [node for node in nodes_to_embed if node.embedding is None]
+        if cached_embeddings:
+            logger.info(f"Reused {len(cached_embeddings)} cached embeddings")
+        if not nodes_to_embed:
+            return
+    if limiter is None:
+        limiter = get_embedding_endpoint_limiter(embed_model)
+
+    start_time = time.perf_counter()
+    batch_tasks: List[asyncio.Task] = []
+    position = 0
+    while position < len(nodes_to_embed):
+        await limiter.aacquire()
+        # Stop sending new batches once a batch has failed for good
+        if any(batch_task.done() and batch_task.exception() is not None for batch_task in batch_tasks):
+            limiter.release()
+            break
+        batch_nodes = nodes_to_embed[position:position + _get_request_batch_size(embed_model, limiter)]
+        position += len(batch_nodes)
+        batch_tasks.append(asyncio.create_task(_aembed_batch(embed_model, batch_nodes, limiter, cache_store, cache_collection)))
+    results = await asyncio.gather(*batch_tasks, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+    duration = time.perf_counter() - start_time
+    # Wall time so that concurrent requests are not counted several times
+    processing_embedding_seconds_counter.inc(duration)
+    logger.info(f"Embedded {len(nodes_to_embed)} nodes in {duration:.2f}s ({len(nodes_to_embed) / max(duration, 1e-6):.1f} nodes/s) with concurrency {limiter.concurrency} and batch size {limiter.batch_size}")
+
+async def _aembed_batch(embed_model: TransformComponent, batch_nodes: List[BaseNode], limiter: EmbeddingEndpointLimiter, cache_store: SqliteLRUCacheKVStore | None, cache_collection: str | None) -> None:
+    """
+    Embed a batch of nodes in one request holding an in flight request slot of the limiter, the batch is retried after the limiter reduced the load
+    The embeddings are cached as soon as the batch succeeds so that a retry of the file after another batch failed reuses them
+    """
+    try:
+        texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in batch_nodes]
+        for attempt in range(PROCESSING_EMBEDDING_MAX_RETRIES + 1):
+            request_start_time = time.perf_counter()
+            try:
+                embeddings = await embed_model.aget_text_embedding_batch(texts)
+            except Exception as e:
+                limiter.on_error(e)
+                if attempt == PROCESSING_EMBEDDING_MAX_RETRIES:
+                    raise
+                await asyncio.sleep(PROCESSING_EMBEDDING_RETRY_BACKOFF_SECONDS * 2 ** attempt)
+                continue
+            latency = time.perf_counter() - request_start_time
+            limiter.on_success(latency)
+            for node, embedding in zip(batch_nodes, embeddings):
+                node.embedding = embedding
+            processing_embedded_nodes_counter.inc(len(batch_nodes))
+            if cache_store is not None:
+                try:
+                    await asyncio.to_thread(cache_store.put_all, [(get_embedding_cache_key(node), {"embedding": node.embedding}) for node in batch_nodes], cache_collection)
+                except Exception as e:
+                    # The embeddings are still usable, only their reuse is lost
+                    logger.error(f"Failed to cache {len(batch_nodes)} embeddings: {str(e)}")
+            return
+    finally:
+        limiter.release()
@@ -0,0 +1,263 @@
+from app.datasources.file_manager.database.models import File, FileStatus
+from app.processing.database.models import ProcessingJob, ProcessingJobStatus, ProcessingJobPriority
+
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List
+from sqlalchemy import and_, or_, cast, func, Integer
+from sqlalchemy.orm import Session
+import os
+
+import logging
+logger = logging.getLogger("uvicorn")
+
+# A leased job is considered interrupted once its lease expires without heartbeat
+PROCESSING_JOB_LEASE_SECONDS = int(os.environ.get("PROCESSING_JOB_LEASE_SECONDS", 30))
+PROCESSING_JOB_HEARTBEAT_SECONDS = PROCESSING_JOB_LEASE_SECONDS / 3
+PROCESSING_JOB_MAX_ATTEMPTS = int(os.environ.get("PROCESSING_JOB_MAX_ATTEMPTS", 3))
+# Exponential backoff between the attempts of a failed job
+PROCESSING_JOB_BACKOFF_BASE_SECONDS = 10
+PROCESSING_JOB_BACKOFF_MAX_SECONDS = 10 * 60
+# A waiting job moves up one priority lane each time it waits this long, so the large and bulk files are not starved by the small ones
+PROCESSING_JOB_PRIORITY_AGING_SECONDS = int(os.environ.get("PROCESSING_JOB_PRIORITY_AGING_SECONDS", 5 * 60))
+
+def enqueue_processing_jobs_for_queued_files(processing_db_session: Session, file_manager_db_sessions: Dict[str, Session], queued_file_ids: Dict[str, Iterable[int]], priority: ProcessingJobPriority = ProcessingJobPriority.NORMAL) -> int:
+    """
+    Create the processing jobs of the queued files and queue the failed ones again, returns the number of jobs made available
+    Only the files queued by the caller are enqueued, given by datasource in queued_file_ids
+    The waiting jobs keep their attempts, their backoff and their priority, only a failed job gets a fresh attempts budget
+    """
+    try:
+        now = datetime.now()
+        enqueued_jobs_count = 0
+        for datasource_name, file_manager_db_session in file_manager_db_sessions.items():
+            datasource_queued_file_ids = list(queued_file_ids.get(datasource_name, []))
+            if not datasource_queued_file_ids:
+                continue
+            queued_files = file_manager_db_session.query(File.id, File.size).filter(
+                File.status == FileStatus.QUEUED,
+                File.id.in_(datasource_queued_file_ids)
+            ).all()
+            if not queued_files:
+                continue
+            jobs_by_file_id = {
+                job.file_id: job for job in processing_db_session.query(ProcessingJob).filter(
+                    ProcessingJob.datasource_name == datasource_name,
+                    ProcessingJob.file_id.in_([queued_file.id for queued_file in queued_files])
+                ).all()
+            }
+            for queued_file in queued_files:
+                job = jobs_by_file_id.get(queued_file.id)
+                if job is None:
+                    processing_db_session.add(ProcessingJob(
+                        datasource_name=datasource_name,
+                        file_manager_db_path=file_manager_db_session.get_bind().url.database,
+                        file_id=queued_file.id,
+                        file_size=queued_file.size or 0,
+                        priority=priority,
+                        max_attempts=PROCESSING_JOB_MAX_ATTEMPTS,
+                        available_at=now,
+                        enqueued_at=now
+                    ))
+                    enqueued_jobs_count += 1
+                elif job.status == ProcessingJobStatus.FAILED:
+                    # Queued again by the user after it ran out of attempts, retry now with a fresh attempts budget
+                    job.status = ProcessingJobStatus.QUEUED
+                    job.priority = priority
+                    job.file_size = queued_file.size or 0
+                    job.attempts = 0
+                    job.available_at = now
+                    job.enqueued_at = now
+                    job.last_error = None
+                    enqueued_jobs_count += 1
+                elif job.status == ProcessingJobStatus.QUEUED:
+                    # Already waiting, possibly for the backoff of a retry, only the size of an overwritten file changes
+                    job.file_size = queued_file.size or 0
+        processing_db_session.commit()
+        return enqueued_jobs_count
+    except Exception as e:
+        processing_db_session.rollback()
+        logger.error(f"Failed to enqueue processing jobs: {str(e)}")
+        raise
+
+def _leasable_processing_jobs_filter(now: datetime):
+    """Queued jobs past their backoff and leased jobs whose lease expired"""
+    return or_(
+        and_(ProcessingJob.status == ProcessingJobStatus.QUEUED, ProcessingJob.available_at <= now),
+        and_(ProcessingJob.status == ProcessingJobStatus.LEASED, ProcessingJob.lease_expires_at < now)
+    )
+
+def _leasable_processing_jobs_order(now: datetime):
+    """
+    Lane of the jobs lowered by their waiting time since they were queued, then the smallest files first, then the oldest jobs first
+    """
+    waiting_seconds = (func.julianday(now) - func.julianday(ProcessingJob.enqueued_at)) * 86400
+    effective_priority = ProcessingJob.priority - cast(waiting_seconds / PROCESSING_JOB_PRIORITY_AGING_SECONDS, Integer)
+    return (
+        effective_priority.asc(),
+        ProcessingJob.file_size.asc(),
+        ProcessingJob.enqueued_at.asc()
+    )
+
+def get_next_leasable_processing_job(processing_db_session: Session, excluded_job_ids: Iterable[int]) -> ProcessingJob | None:
+    """Get the job that can be leased with the highest priority"""
+    now = datetime.now()
+    return processing_db_session.query(ProcessingJob).filter(
+        _leasable_processing_jobs_filter(now),
+        ProcessingJob.id.notin_(list(excluded_job_ids))
+    ).order_by(
+        *_leasable_processing_jobs_order(now)
+    ).first()
+
+def get_leasable_processing_jobs_for_datasource(processing_db_session: Session, datasource_name: str, excluded_job_ids: Iterable[int], limit: int) -> List[ProcessingJob]:
+    """Get the jobs of a datasource that can be leased with the highest priority, used to batch the files of a datasource together"""
+    now = datetime.now()
+    return processing_db_session.query(ProcessingJob).filter(
+        _leasable_processing_jobs_filter(now),
+        ProcessingJob.datasource_name == datasource_name,
+        ProcessingJob.id.notin_(list(excluded_job_ids))
+    ).order_by(
+        *_leasable_processing_jobs_order(now)
+    ).limit(limit).all()
+
+def set_processing_jobs_priority(processing_db_session: Session, datasource_name: str, file_ids: List[int], priority: ProcessingJobPriority) -> int:
+    """
+    Move the waiting jobs of files to a priority lane, returns the number of jobs moved
+    """
+    try:
+        if not file_ids:
+            return 0
+        updated_jobs_count = processing_db_session.query(ProcessingJob).filter(
+            ProcessingJob.datasource_name == datasource_name,
+            ProcessingJob.file_id.in_(file_ids),
+            ProcessingJob.status == ProcessingJobStatus.QUEUED
+        ).update({
+            ProcessingJob.priority: priority,
+            ProcessingJob.updated_at: datetime.now()
+        }, synchronize_session=False)
+        processing_db_session.commit()
+        return updated_jobs_count
+    except Exception as e:
+        processing_db_session.rollback()
+        logger.error(f"Failed to set the priority of the processing jobs of {datasource_name}: {str(e)}")
+        raise
+
+def lease_processing_job(processing_db_session: Session, job_id: int, lease_owner: str) -> bool:
+    """
+    Lease a job if it is still leasable, the check and the update are a single statement so only one scheduler can win the lease
+    """
+    try:
+        now = datetime.now()
+        leased_rows_count = processing_db_session.query(ProcessingJob).filter(
+            ProcessingJob.id == job_id,
+            _leasable_processing_jobs_filter(now)
+        ).update({
+            ProcessingJob.status: ProcessingJobStatus.LEASED,
+            ProcessingJob.lease_owner: lease_owner,
+            ProcessingJob.lease_expires_at: now + timedelta(seconds=PROCESSING_JOB_LEASE_SECONDS),
+            ProcessingJob.heartbeat_at: now,
+            ProcessingJob.attempts: ProcessingJob.attempts + 1,
+            ProcessingJob.updated_at: now
+        }, synchronize_session=False)
+        processing_db_session.commit()
+        return leased_rows_count == 1
+    except Exception as e:
+        processing_db_session.rollback()
+        logger.error(f"Failed to lease processing job {job_id}: {str(e)}")
+        raise
+
+def heartbeat_processing_jobs(processing_db_session: Session, job_ids: List[int], lease_owner: str) -> None:
+    """Extend the leases of the running jobs"""
+    try:
+        now = datetime.now()
+        processing_db_session.query(ProcessingJob).filter(
+            ProcessingJob.id.in_(job_ids),
+            ProcessingJob.status == ProcessingJobStatus.LEASED,
+            ProcessingJob.lease_owner == lease_owner
+        ).update({
+            ProcessingJob.lease_expires_at: now + timedelta(seconds=PROCESSING_JOB_LEASE_SECONDS),
+            ProcessingJob.heartbeat_at: now
+        }, synchronize_session=False)
+        processing_db_session.commit()
+    except Exception as e:
+        processing_db_session.rollback()
+        logger.error(f"Failed to heartbeat processing jobs {job_ids}: {str(e)}")
+        raise
+
+def complete_processing_job(processing_db_session: Session, job: ProcessingJob) -> None:
+    """Delete a processed job"""
+    try:
+        processing_db_session.delete(job)
+        processing_db_session.commit()
+    except Exception as e:
+        processing_db_session.rollback()
+        logger.error(f"Failed to complete processing job {job.id}: {str(e)}")
+        raise
+
+def fail_processing_job(processing_db_session: Session, job: ProcessingJob, error_message: str) -> bool:
+    """
+    Release a failed job, it is retried after an exponential backoff until it runs out of attempts
+    Returns True if the job will be retried
+    """
+    try:
+        will_retry = job.attempts < job.max_attempts
+        job.last_error = error_message
+        job.lease_owner = None
+        job.lease_expires_at = None
+        if will_retry:
+            backoff_seconds = min(PROCESSING_JOB_BACKOFF_BASE_SECONDS * 2 ** (job.attempts - 1), PROCESSING_JOB_BACKOFF_MAX_SECONDS)
+            job.status = ProcessingJobStatus.QUEUED
+            job.available_at = datetime.now() + timedelta(seconds=backoff_seconds)
+        else:
+            job.status = ProcessingJobStatus.FAILED
+        processing_db_session.commit()
+        return will_retry
+    except Exception as e:
+        processing_db_session.rollback()
+        logger.error(f"Failed to release failed processing job {job.id}: {str(e)}")
+        raise
+
+def postpone_processing_jobs(processing_db_session: Session, jobs: List[ProcessingJob], delay_seconds: float) -> None:
+    """Release leased jobs that could not start, they are leased again after the delay without losing an attempt"""
+    try:
+        available_at = datetime.now() + timedelta(seconds=delay_seconds)
+        for job in jobs:
+            job.status = ProcessingJobStatus.QUEUED
+            job.lease_owner = None
+            job.lease_expires_at = None
+            # Give back the attempt counted by the lease
+            job.attempts = max(job.attempts - 1, 0)
+            job.available_at = available_at
+        processing_db_session.commit()
+    except Exception as e:
+        processing_db_session.rollback()
+        logger.error(f"Failed to postpone processing jobs {[job.id for job in jobs]}: {str(e)}")
+        raise
+
+def release_stale_processing_job_leases(processing_db_session: Session, lease_owner_prefix: str, lease_owner: str) -> int:
+    """
+    Make the jobs leased by a previous scheduler of the same host available again without waiting for their lease to expire
+    Returns the number of released jobs
+    """
+    try:
+        released_jobs_count = processing_db_session.query(ProcessingJob).filter(
+            ProcessingJob.status == ProcessingJobStatus.LEASED,
+            ProcessingJob.lease_owner.startswith(lease_owner_prefix),
+            ProcessingJob.lease_owner != lease_owner
+        ).update({
+            ProcessingJob.status: ProcessingJobStatus.QUEUED,
+            ProcessingJob.lease_owner: None,
+            ProcessingJob.lease_expires_at: None,
+            ProcessingJob.available_at: datetime.now()
+        }, synchronize_session=False)
+        processing_db_session.commit()
+        return released_jobs_count
+    except Exception as e:
+        processing_db_session.rollback()
+        logger.error(f"Failed to release stale processing job leases: {str(e)}")
+        raise
+
+def has_pending_processing_jobs(processing_db_session: Session) -> bool:
+    """Check if there are jobs left to process, including the ones waiting for a retry"""
+    return processing_db_session.query(ProcessingJob.id).filter(
+        ProcessingJob.status.in_([ProcessingJobStatus.QUEUED, ProcessingJobStatus.LEASED])
+    ).first() is not None
@@ -0,0 +1,249 @@
+from llama_index.core.readers import SimpleDirectoryReader
+from llama_index.core.schema import BaseNode, Document, MetadataMode, TransformComponent
+from llama_index.core.storage.docstore.utils import doc_to_json, json_to_doc
+from llama_index.core.utils import get_tokenizer
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, List, Tuple
+import os
+import uuid
+import time
+import hashlib
+import shutil
+import asyncio
+import resource
+import threading
+import multiprocessing
+
+import logging
+logger = logging.getLogger("uvicorn")
+
+# Number of processes parsing and splitting the files, 0 parses in the processing threads
+PROCESSING_PARSING_POOL_SIZE = int(os.environ.get("PROCESSING_PARSING_POOL_SIZE", os.cpu_count() or 1))
+# A file taking longer is failed and the process parsing it is killed so that it does not stall the queue
+PROCESSING_PARSING_TIMEOUT_SECONDS = float(os.environ.get("PROCESSING_PARSING_TIMEOUT_SECONDS", 300))
+# Address space limit of each parsing process, a file needing more fails with a MemoryError instead of exhausting the host memory, 0 disables the limit
+PROCESSING_PARSING_MEMORY_LIMIT_MB = int(os.environ.get("PROCESSING_PARSING_MEMORY_LIMIT_MB", 4096))
+# The parsing processes are replaced after this many files so that the memory kept by the readers does not grow forever
+PROCESSING_PARSING_MAX_FILES_PER_PROCESS = int(os.environ.get("PROCESSING_PARSING_MAX_FILES_PER_PROCESS", 50))
+
+PROCESSING_TMP_FOLDER_PATH = "/data/{user_uuid}/processing/tmp"
+
+# Metadata created by the file reader that we dont want to embed and llm
+EXCLUDED_READER_METADATA_KEYS = ["file_path","file_name", "file_type", "file_size", "document_id", "doc_id", "ref_doc_id"]
+
+# Created on first use so that importing this module does not spawn processes
+parsing_executor: ProcessPoolExecutor | None = None
+parsing_executor_lock = threading.Lock()
+
+def _limit_parsing_process_memory(memory_limit_mb: int):
+    """Initializer of the parsing processes"""
+    if memory_limit_mb > 0:
+        memory_limit_bytes = memory_limit_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit_bytes, memory_limit_bytes))
+
+def get_parsing_executor() -> ProcessPoolExecutor:
+    """
+    Get the process pool parsing and splitting the files, shared by all the processing threads of the process
+    """
+    global parsing_executor
+    with parsing_executor_lock:
+        if parsing_executor is None:
+            # Spawn instead of fork as the uvicorn workers are multi threaded
+            parsing_executor = ProcessPoolExecutor(
+                max_workers=PROCESSING_PARSING_POOL_SIZE,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_limit_parsing_process_memory,
+                initargs=(PROCESSING_PARSING_MEMORY_LIMIT_MB,),
+                max_tasks_per_child=PROCESSING_PARSING_MAX_FILES_PER_PROCESS
+            )
+        return parsing_executor
+
+def _reset_parsing_executor(executor: ProcessPoolExecutor, reason: str):
+    """
+    Kill the processes of a parsing pool and let the next file create a new one
+    A process stuck in a reader can't be cancelled, killing the pool is the only way to get its cpu and memory back
+    """
+    global parsing_executor
+    with parsing_executor_lock:
+        if parsing_executor is not executor:
+            # Already replaced by another processing thread
+            return
+        parsing_executor = None
+    logger.error(f"Resetting the parsing process pool: {reason}")
+    # The executor does not expose its processes, they have to be killed before the shutdown which would wait for the stuck one
+    for process in list((executor._processes or {}).values()):
+        try:
+            process.kill()
+        except Exception as e:
+            logger.error(f"Failed to kill parsing process {process.pid}: {str(e)}")
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def parse_file(
+        user_uuid: str,
+        file_name: str,
+        content: bytes,
+        file_created_at: str,
+        file_modified_at: str,
+        stack_identifier: str,
+        node_parser: TransformComponent | None,
+        known_documents_hashes: Dict[str, str]
+    ) -> Tuple[List[dict], List[dict], Dict[str, float]]:
+    """
+    Load the documents of a file and split the documents changed since their last ingestion with the node parser of the stack
+    It only receives and returns picklable values so that it can run in a parsing process
+    Returns the serialized documents, the serialized nodes of the changed documents and the durations and counts of the loading and the splitting
+    """
+    load_start_time = time.perf_counter()
+    documents = _load_file_documents(user_uuid, file_name, content, file_created_at, file_modified_at, stack_identifier)
+    load_seconds = time.perf_counter() - load_start_time
+
+    # The documents unchanged since their last ingestion are skipped by the docstore upserts, do not split them again
+    split_start_time = time.perf_counter()
+    changed_documents = [document for document in documents if known_documents_hashes.get(document.doc_id) != document.hash]
+    nodes: List[BaseNode] = []
+    if changed_documents and node_parser is not None:
+        nodes = _assign_content_node_ids(node_parser(changed_documents))
+    elif changed_documents:
+        nodes = changed_documents
+    split_seconds = time.perf_counter() - split_start_time
+
+    # Count the tokens here as the parsing processes run in parallel
+    tokenizer = get_tokenizer()
+    tokens_count = sum(len(tokenizer(node.get_content(metadata_mode=MetadataMode.EMBED))) for node in nodes)
+    parse_stats = {
+        "load_seconds": load_seconds,
+        "split_seconds": split_seconds,
+        "documents": len(documents),
+        "changed_documents": len(changed_documents),
+        "nodes": len(nodes),
+        "tokens": tokens_count
+    }
+    return [doc_to_json(document) for document in documents], [doc_to_json(node) for node in nodes], parse_stats
+
+def _assign_content_node_ids(nodes: List[BaseNode]) -> List[BaseNode]:
+    """
+    Replace the random ids given by the node parser with ids derived from the document and the embedded content of the nodes
+    A chunk unchanged in a new version of a document keeps its id so that only the new chunks are embedded
+    """
+    new_node_ids: Dict[str, str] = {}
+    occurrences: Dict[Tuple[str | None, str], int] = {}
+    for node in nodes:
+        content_hash = hashlib.sha256(node.get_content(metadata_mode=MetadataMode.EMBED).encode()).hexdigest()
+        # The same chunk can appear several times in a document
+        occurrence = occurrences.get((node.ref_doc_id, content_hash), 0)
+        occurrences[(node.ref_doc_id, content_hash)] = occurrence + 1
+        new_node_ids[node.node_id] = str(uuid.uuid5(uuid.NAMESPACE_URL, f"{node.ref_doc_id}:{content_hash}:{occurrence}"))
+    for node in nodes:
+        node.id_ = new_node_ids[node.node_id]
+        # Keep the previous, next, parent and child relationships pointing to the renamed nodes
+        for related_nodes in node.relationships.values():
+            for related_node in (related_nodes if isinstance(related_nodes, list) else [related_nodes]):
+                related_node.node_id = new_node_ids.get(related_node.node_id, related_node.node_id)
+    return nodes
+
+def _load_file_documents(user_uuid: str, file_name: str, content: bytes, file_created_at: str, file_modified_at: str, stack_identifier: str) -> List[Document]:
+    """Load the documents of a file with their metadata for a processing stack"""
+    # Use SimpleDirectoryReader from llama index
+    # It try to use existing apropriate readers based on the file type to get the most metadata from it
+    # TODO Make this better
+    # Write the file content to a temp file, in its own folder as the files of a batch are parsed at the same time
+    tmp_folder_path = PROCESSING_TMP_FOLDER_PATH.format(user_uuid=user_uuid)
+    temp_folder_path = os.path.join(tmp_folder_path, f".{uuid.uuid4().hex}")
+    temp_file_path = os.path.join(temp_folder_path, file_name)
+    os.makedirs(temp_folder_path, exist_ok=True)
+    try:
+        with open(temp_file_path, "wb") as f:
+            f.write(content)
+        reader = SimpleDirectoryReader(
+            input_files=[temp_file_path],
+            filename_as_id=True,
+            raise_on_error=True,
+        )
+        documents = reader.load_data()
+    finally:
+        shutil.rmtree(temp_folder_path, ignore_errors=True)
+
+    # Remove the unwanted metadata from the documents
+    # In case multiple documents are created from the same file ?
+    for document in documents:
+        document.metadata.pop("creation_date", None)
+        document.metadata.pop("last_modified_date", None)
+
+        # Remove the metadata created by the file reader that we dont want to embed and llm
+        document.excluded_embed_metadata_keys = list(EXCLUDED_READER_METADATA_KEYS)
+        document.excluded_llm_metadata_keys = list(EXCLUDED_READER_METADATA_KEYS)
+
+        # Set the origin metadata of the document
+        document.metadata["origin"] = "upload"
+        document.excluded_embed_metadata_keys.append("origin")
+        document.excluded_llm_metadata_keys.append("origin")
+
+        # Override the file creation time to the current time with the times from the database
+        # Set the creation and modification times
+        document.metadata["created_at"] = file_created_at
+        document.metadata["modified_at"] = file_modified_at
+        # Remove from embed and llm
+        document.excluded_embed_metadata_keys.append("created_at")
+        document.excluded_embed_metadata_keys.append("modified_at")
+        document.excluded_llm_metadata_keys.append("created_at")
+        document.excluded_llm_metadata_keys.append("modified_at")
+
+        # Set the transformations stack name for the datasource_documents
+        document.metadata["transformations_stack_identifier"] = stack_identifier
+        document.excluded_embed_metadata_keys.append("transformations_stack_identifier")
+        document.excluded_llm_metadata_keys.append("transformations_stack_identifier")
+
+        # The reader ids and paths are based on the temp file path, keep them as if the file was written directly in the tmp folder so that the doc ids stay the same between runs
+        original_doc_id = document.doc_id.replace(temp_folder_path, tmp_folder_path, 1)
+        if "file_path" in document.metadata:
+            document.metadata["file_path"] = document.metadata["file_path"].replace(temp_folder_path, tmp_folder_path, 1)
+
+        # Modify the doc id to append the transformation stack at the end so that they are treated as different documents by the docstore upserts and are managable independently of each other
+        document.doc_id = f"{original_doc_id}_{stack_identifier}"
+
+    return documents
+
+
+async def aparse_file(
+        user_uuid: str,
+        file_name: str,
+        content: bytes,
+        file_created_at: str,
+        file_modified_at: str,
+        stack_identifier: str,
+        node_parser: TransformComponent | None,
+        known_documents_hashes: Dict[str, str]
+    ) -> Tuple[List[Document], List[BaseNode], Dict[str, float]]:
+    """
+    Load and split a file in the parsing process pool without blocking the event loop
+    Returns the documents of the file, the nodes of its changed documents and the durations and counts of the parsing
+    """
+    # The llama index components drop their unpicklable attributes like the tokenizer when pickled and recreate them when unpickled
+    parse_file_args = (user_uuid, file_name, content, file_created_at, file_modified_at, stack_identifier, node_parser, known_documents_hashes)
+
+    if PROCESSING_PARSING_POOL_SIZE <= 0:
+        serialized_documents, serialized_nodes, parse_stats = await asyncio.to_thread(parse_file, *parse_file_args)
+    else:
+        loop = asyncio.get_running_loop()
+        # A file is retried once in a new pool if the pool broke because of another file
+        for attempt in range(2):
+            executor = get_parsing_executor()
+            try:
+                serialized_documents, serialized_nodes, parse_stats = await asyncio.wait_for(
+                    loop.run_in_executor(executor, parse_file, *parse_file_args),
+                    timeout=PROCESSING_PARSING_TIMEOUT_SECONDS
+                )
+                break
+            except asyncio.TimeoutError:
+                _reset_parsing_executor(executor, f"parsing of {file_name} took more than {PROCESSING_PARSING_TIMEOUT_SECONDS}s")
+                raise TimeoutError(f"Parsing of {file_name} took more than {PROCESSING_PARSING_TIMEOUT_SECONDS}s")
+            except BrokenProcessPool as e:
+                # The process of this file or of another file died, the memory limit can kill a process without MemoryError
+                _reset_parsing_executor(executor, f"parsing process died while parsing {file_name}")
+                if attempt == 1:
+                    raise RuntimeError(f"Parsing process died while parsing {file_name}: {str(e)}")
+
+    return [json_to_doc(document) for document in serialized_documents], [json_to_doc(node) for node in serialized_nodes], parse_stats
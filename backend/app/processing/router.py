@@ -1,15 +1,23 @@
 from fastapi import APIRouter, HTTPException, Depends, BackgroundTasks
+from fastapi.concurrency import run_in_threadpool
 import logging
 from sqlalchemy.orm import Session
 import asyncio
 from fastapi import WebSocket
 from fastapi import WebSocketDisconnect
-from typing import Annotated
-from app.processing.service import get_queue_status, mark_items_as_queued, start_processing_thread
-from app.processing.schemas import ProcessingRequest, ProcessingStatusResponse
+from typing import Annotated, Dict, List
+from app.processing.service import get_queue_status, mark_items_as_queued, get_items_file_ids, register_user_processing_db_sessions, get_ingestion_cache_stats
+from app.processing.scheduler import schedule_user_processing
+from app.processing.jobs import enqueue_processing_jobs_for_queued_files, set_processing_jobs_priority
+from app.processing.database.session import get_processing_db_session
+from app.processing.database.models import ProcessingJobPriority
+from app.processing.status_hub import ProcessingStatusSubscription, publish_processing_status, has_processing_status
+from app.ollama_status.warmup import schedule_ollama_models_prewarm
+from app.processing.schemas import ProcessingRequest, ProcessingStatusResponse, ProcessingCacheStatsResponse, ProcessingPriorityRequest, ProcessingPriorityResponse
 from app.auth.dependencies import get_user_uuid_from_token
 from app.auth.schemas import Keyring
 from app.auth.dependencies import get_keyring_with_user_data_mounting_dependency
+from app.api.mount_user_data_dir import schedule_user_data_dir_premount
 from app.datasources.file_manager.database.session import get_datasources_file_manager_db_session
 from app.datasources.database.session import get_datasources_db_session
 from app.settings.database.session import get_settings_db_session
@@ -29,11 +37,14 @@ async def processing_route(
     settings_db_session: Annotated[Session, Depends(get_settings_db_session)],
     datasources_db_session: Annotated[Session, Depends(get_datasources_db_session)],
     processing_stacks_db_session: Annotated[Session, Depends(get_processing_stacks_db_session)],
+    processing_db_session: Annotated[Session, Depends(get_processing_db_session)],
 ) -> ProcessingStatusResponse:
     """Add files or folders to generation queue and start processing if needed"""
     try:
         # Get the file manager db sessions for all datasources in the files to be processed
         file_manager_db_sessions = {}
+        newly_queued_count = 0
+        queued_file_ids: Dict[str, List[int]] = {}
         for item in request.items:
             # Extract the datasource name from the original path
             datasource_name = item.original_path.split("/")[0]
@@ -50,23 +61,35 @@ async def processing_route(
                 file_manager_db_session = file_manager_db_sessions[datasource_name]
 
             # Process all items in the request
-            mark_items_as_queued(
+            item_newly_queued_count, item_queued_file_ids = mark_items_as_queued(
                 processing_stacks_db_session=processing_stacks_db_session,
                 file_manager_db_session=file_manager_db_session,
                 user_uuid=user_uuid,
                 items=[item]
             )
+            newly_queued_count += item_newly_queued_count
+            queued_file_ids.setdefault(datasource_name, []).extend(item_queued_file_ids)
 
-        # Start processing thread if needed
-        start_processing_thread(
+        # Create the durable jobs of the files queued by this request and hand them to the processing scheduler of the host
+        enqueue_processing_jobs_for_queued_files(processing_db_session, file_manager_db_sessions, queued_file_ids, ProcessingJobPriority[request.priority.upper()])
+        register_user_processing_db_sessions(
             user_uuid=user_uuid,
             file_manager_db_sessions=file_manager_db_sessions,
             datasources_db_session=datasources_db_session,
             settings_db_session=settings_db_session,
             processing_stacks_db_session=processing_stacks_db_session
         )
+        schedule_user_processing(user_uuid)
+        # Load the models while the files wait in the queue so that the first batch does not pay their loading
+        if newly_queued_count:
+            schedule_ollama_models_prewarm(settings_db_session)
 
-        return get_queue_status(user_uuid)
+        queue_status = get_queue_status(user_uuid)
+        # The status websockets get the queued files from the status hub instead of polling the databases
+        # The snapshot is written to the user data directory, off the event loop
+        await run_in_threadpool(publish_processing_status, user_uuid, queue_status)
+        queue_status["newly_queued_count"] = newly_queued_count
+        return queue_status
     
     except HTTPException:
         raise
@@ -74,6 +97,41 @@ async def processing_route(
         logger.error(f"Error in processing endpoint: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@r.post("/priority", response_model=ProcessingPriorityResponse)
+async def processing_priority_route(
+    request: ProcessingPriorityRequest,
+    user_uuid: Annotated[str, Depends(get_user_uuid_from_token)],
+    keyring: Annotated[Keyring, Depends(get_keyring_with_user_data_mounting_dependency)],
+    datasources_db_session: Annotated[Session, Depends(get_datasources_db_session)],
+    processing_db_session: Annotated[Session, Depends(get_processing_db_session)],
+) -> ProcessingPriorityResponse:
+    """Move the waiting files of files or folders to another lane of the generation queue"""
+    try:
+        original_paths_by_datasource = {}
+        for original_path in request.original_paths:
+            original_paths_by_datasource.setdefault(original_path.split("/")[0], []).append(original_path)
+
+        updated_count = 0
+        for datasource_name, original_paths in original_paths_by_datasource.items():
+            file_manager_db_session = await get_datasources_file_manager_db_session(
+                datasource_name=datasource_name,
+                keyring=keyring,
+                datasources_db_session=datasources_db_session
+            )
+            file_ids = get_items_file_ids(file_manager_db_session, original_paths)
+            updated_count += set_processing_jobs_priority(processing_db_session, datasource_name, file_ids, ProcessingJobPriority[request.priority.upper()])
+
+        # The next files are picked with the new priorities
+        if updated_count:
+            schedule_user_processing(user_uuid)
+        return ProcessingPriorityResponse(updated_count=updated_count)
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error in processing_priority_route: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @r.get("/status", response_model=ProcessingStatusResponse)
 async def get_processing_status_route(
     user_uuid: Annotated[str, Depends(get_user_uuid_from_token)],
@@ -87,6 +145,18 @@ async def get_processing_status_route(
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@r.get("/cache/stats", response_model=List[ProcessingCacheStatsResponse])
+async def get_processing_cache_stats_route(
+    user_uuid: Annotated[str, Depends(get_user_uuid_from_token)],
+    datasources_db_session: Annotated[Session, Depends(get_datasources_db_session)],
+) -> List[ProcessingCacheStatsResponse]:
+    """Get the size and the hit rate of the ingestion cache of each datasource"""
+    try:
+        return get_ingestion_cache_stats(datasources_db_session, user_uuid)
+    except Exception as e:
+        logger.error(f"Error in get_processing_cache_stats_route: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @r.websocket("/status/ws")
 async def processing_status_websocket(
     websocket: WebSocket,
@@ -94,9 +164,19 @@ async def processing_status_websocket(
 ):
     """WebSocket endpoint for processing status updates"""
     user_uuid = get_user_uuid_from_token(token)
+    # The status websocket is opened when the app is loaded, mount the user data directory before the first requests arrive
+    schedule_user_data_dir_premount(user_uuid)
+    # Resume the pending processing jobs of the user if they were interrupted while the user data directory was unmounted
+    schedule_user_processing(user_uuid)
+    if not await run_in_threadpool(has_processing_status, user_uuid):
+        # No worker published the status since the user data directory was created, seed it from the databases once
+        await run_in_threadpool(publish_processing_status, user_uuid, get_queue_status(user_uuid))
+    # The status is pushed by the processing pipeline, an idle websocket does not query the databases
+    processing_status_subscription = ProcessingStatusSubscription(user_uuid)
     status_ws = StatusWebSocket(
         websocket, 
-        lambda: get_queue_status(user_uuid)
+        processing_status_subscription.get_status,
+        wait_for_change=processing_status_subscription.wait_for_change
     )
     await status_ws.accept()
     
@@ -0,0 +1,558 @@
+from app.datasources.file_manager.database.models import File, FileStatus
+from app.datasources.database.session import DATASOURCES_DB_PATH
+from app.settings.database.session import SETTINGS_DB_PATH
+from app.processing_stacks.database.session import PROCESSING_STACKS_DB_PATH
+from app.processing.database.session import PROCESSING_DB_PATH, get_processing_db_session_for_user
+from app.processing.database.models import ProcessingJob
+from app.processing.jobs import PROCESSING_JOB_HEARTBEAT_SECONDS, get_next_leasable_processing_job, get_leasable_processing_jobs_for_datasource, lease_processing_job, heartbeat_processing_jobs, complete_processing_job, fail_processing_job, postpone_processing_jobs, release_stale_processing_job_leases, has_pending_processing_jobs
+from app.processing.service import _process_files
+from app.processing.status_hub import publish_files_processing_status
+from app.ollama_status.service import can_process
+from app.api.user_data_locks import LockMode, user_data_lock, user_data_lock_sync
+from app.api.mount_user_data_dir import DATA_FOLDER_PATH, USER_DATA_FOLDER_PATH, mount_user_data_dir, touch_user_data_dir
+
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from typing import Deque, Dict, List, Set, Tuple
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+import os
+import json
+import math
+import time
+import uuid
+import fcntl
+import socket
+import asyncio
+import threading
+
+import logging
+logger = logging.getLogger("uvicorn")
+
+# Maximum number of file batches processed at the same time by this host and by each user
+PROCESSING_MAX_CONCURRENT_FILES = int(os.environ.get("PROCESSING_MAX_CONCURRENT_FILES", 2))
+PROCESSING_MAX_CONCURRENT_FILES_PER_USER = int(os.environ.get("PROCESSING_MAX_CONCURRENT_FILES_PER_USER", 1))
+# Bytes of files credited to each backlogged user per deficit round robin round
+PROCESSING_SCHEDULER_QUANTUM_BYTES = int(os.environ.get("PROCESSING_SCHEDULER_QUANTUM_BYTES", 4 * 1024 * 1024))
+# Admission control, no new file is started above this load average per cpu or below this available memory, unless nothing is running
+PROCESSING_MAX_LOAD_PER_CPU = float(os.environ.get("PROCESSING_MAX_LOAD_PER_CPU", 1.5))
+PROCESSING_MIN_AVAILABLE_MEMORY_BYTES = int(os.environ.get("PROCESSING_MIN_AVAILABLE_MEMORY_MB", 512)) * 1024 * 1024
+# Queued files of the same datasource leased together so that their nodes are embedded in large batches
+PROCESSING_BATCH_MAX_FILES = int(os.environ.get("PROCESSING_BATCH_MAX_FILES", 16))
+PROCESSING_BATCH_MAX_BYTES = int(os.environ.get("PROCESSING_BATCH_MAX_BYTES", 16 * 1024 * 1024))
+
+# Where the processing jobs run:
+# - all: the api workers enqueue the jobs and one of them processes them
+# - api: the api workers only enqueue the jobs, they are processed by standalone workers started with python -m app.processing.worker
+# - worker: standalone worker processing the jobs without serving the api
+PROCESSING_MODE = os.environ.get("PROCESSING_MODE", "all")
+
+# The uvicorn worker holding this lock owns the scheduler of the host, the others hand the users to process off through the spool folder
+PROCESSING_SCHEDULER_LOCK_PATH = "/data/.processing_scheduler.lock"
+PROCESSING_SCHEDULER_SPOOL_DIR_PATH = "/data/.processing_scheduler_spool"
+PROCESSING_SCHEDULER_TICK_SECONDS = 0.5
+PROCESSING_SCHEDULER_ELECTION_RETRY_SECONDS = 5
+# Interval of the sweep registering the users with pending jobs, it resumes the jobs interrupted by a crash
+PROCESSING_JOBS_RECOVERY_SWEEP_SECONDS = 60
+# Delay before the jobs of a user are leased again when its models are not ready, the ollama server can be down or still pulling them
+PROCESSING_MODELS_UNAVAILABLE_RETRY_SECONDS = 30
+
+# Lease owner of the jobs leased by this scheduler, prefixed by the host so that a new scheduler of the same host can take over the leases of a crashed one
+PROCESSING_JOB_LEASE_OWNER_PREFIX = f"{socket.gethostname()}:"
+PROCESSING_JOB_LEASE_OWNER = f"{PROCESSING_JOB_LEASE_OWNER_PREFIX}{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+class UserProcessingQueue:
+    """
+    Scheduling state of a user with pending processing jobs
+    """
+    def __init__(self, user_uuid: str):
+        self.user_uuid = user_uuid
+        # Deficit round robin credit in bytes
+        self.deficit = 0
+        # Ids of the jobs being processed and number of batches they are processed in
+        self.running_job_ids: Set[int] = set()
+        self.running_batches_count = 0
+        # The models are checked and downloaded if needed once per activation of the user
+        self.models_checked = False
+        # Incremented each time the user is scheduled, a user scheduled again while its jobs were peeked is not unregistered
+        self.schedule_requests_count = 0
+
+
+# Scheduler state, only used in the owner worker
+users_processing_queues: Dict[str, UserProcessingQueue] = {}
+# Round robin order of the users with pending jobs
+users_processing_ring: Deque[str] = deque()
+running_batches_count = 0
+# Only guards the in memory scheduler state, the databases and the mounts are accessed without it
+processing_scheduler_condition = threading.Condition()
+# Set when the scheduler is notified so that a notification sent while it dispatches jobs is not lost
+processing_scheduler_notified = False
+processing_scheduler_executor: ThreadPoolExecutor | None = None
+processing_scheduler_db_engines: Dict[str, Engine] = {}
+processing_scheduler_db_engines_lock = threading.Lock()
+# File descriptor holding the owner lock, None if this worker is not the owner
+processing_scheduler_lock_fd: int | None = None
+
+processing_worker_thread_local = threading.local()
+
+
+def setup_processing_scheduler():
+    """Setup and start the processing scheduler thread, it only schedules jobs once this worker is elected as the owner"""
+    if PROCESSING_MODE == "api":
+        logger.info("Processing jobs are run by the standalone processing workers, not starting the processing scheduler")
+        return
+    logger.info("Setting up processing scheduler")
+    scheduler_thread = threading.Thread(
+        target=processing_scheduler_loop,
+        daemon=True,  # Terminate when main thread exits
+        name="processing-scheduler",
+        args=(logger,)
+    )
+    scheduler_thread.start()
+
+def schedule_user_processing(user_uuid: str):
+    """
+    Make the scheduler of the host process the pending jobs of the user
+    """
+    try:
+        if processing_scheduler_lock_fd is not None:
+            _register_user_processing_queue(user_uuid)
+        else:
+            # Hand the user off to the owner worker
+            _write_spool_descriptor(user_uuid)
+    except Exception as e:
+        logger.error(f"Failed to schedule processing for user {user_uuid}: {str(e)}")
+        raise
+
+def _write_spool_descriptor(user_uuid: str) -> None:
+    """Write the descriptor of the user in the spool folder, it is written to a temporary file and renamed so that the owner never reads a partial one"""
+    os.makedirs(PROCESSING_SCHEDULER_SPOOL_DIR_PATH, exist_ok=True)
+    descriptor_id = str(uuid.uuid4())
+    tmp_descriptor_path = os.path.join(PROCESSING_SCHEDULER_SPOOL_DIR_PATH, f".{descriptor_id}.tmp")
+    with open(tmp_descriptor_path, "w") as f:
+        json.dump({"user_uuid": user_uuid}, f)
+    os.rename(tmp_descriptor_path, os.path.join(PROCESSING_SCHEDULER_SPOOL_DIR_PATH, f"{descriptor_id}.json"))
+
+def _consume_spool_descriptors() -> None:
+    """Register the users handed off by the other workers"""
+    try:
+        descriptor_files = [f for f in os.listdir(PROCESSING_SCHEDULER_SPOOL_DIR_PATH) if f.endswith(".json")]
+    except FileNotFoundError:
+        return
+    for descriptor_file in descriptor_files:
+        # Claim the descriptor before reading it as several standalone workers can consume the same spool folder
+        descriptor_path = os.path.join(PROCESSING_SCHEDULER_SPOOL_DIR_PATH, f".{descriptor_file}.{os.getpid()}.claimed")
+        try:
+            os.rename(os.path.join(PROCESSING_SCHEDULER_SPOOL_DIR_PATH, descriptor_file), descriptor_path)
+        except FileNotFoundError:
+            continue
+        try:
+            with open(descriptor_path, "r") as f:
+                descriptor = json.load(f)
+            _register_user_processing_queue(descriptor["user_uuid"])
+        except Exception as e:
+            logger.error(f"Failed to read processing spool descriptor {descriptor_file}, dropping it: {str(e)}")
+        finally:
+            try:
+                os.remove(descriptor_path)
+            except FileNotFoundError:
+                pass
+
+def _register_user_processing_queue(user_uuid: str) -> None:
+    """Add the user to the round robin of the scheduler"""
+    with processing_scheduler_condition:
+        if user_uuid not in users_processing_queues:
+            users_processing_queues[user_uuid] = UserProcessingQueue(user_uuid)
+            users_processing_ring.append(user_uuid)
+        users_processing_queues[user_uuid].schedule_requests_count += 1
+        _notify_processing_scheduler()
+
+def _notify_processing_scheduler() -> None:
+    """Wake the scheduler up, processing_scheduler_condition must be held"""
+    global processing_scheduler_notified
+    processing_scheduler_notified = True
+    processing_scheduler_condition.notify()
+
+def _try_to_become_owner() -> bool:
+    """Try to take the scheduler owner lock of the host, it is held until this worker exits"""
+    global processing_scheduler_lock_fd
+    if processing_scheduler_lock_fd is not None:
+        return True
+    os.makedirs(os.path.dirname(PROCESSING_SCHEDULER_LOCK_PATH), exist_ok=True)
+    lock_fd = os.open(PROCESSING_SCHEDULER_LOCK_PATH, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(lock_fd)
+        return False
+    processing_scheduler_lock_fd = lock_fd
+    logger.info(f"Worker {os.getpid()} is now the owner of the processing scheduler")
+    return True
+
+
+def processing_scheduler_loop(logger: logging.Logger, elect_owner: bool = True):
+    """
+    Wait to be elected as the owner of the scheduler then dispatch the pending jobs to the worker pool
+    Standalone workers do not take part in the election, they all schedule jobs and the job leases make sure each job runs once
+    """
+    global processing_scheduler_executor, processing_scheduler_notified
+    if elect_owner:
+        while not _try_to_become_owner():
+            time.sleep(PROCESSING_SCHEDULER_ELECTION_RETRY_SECONDS)
+
+    processing_scheduler_executor = ThreadPoolExecutor(max_workers=PROCESSING_MAX_CONCURRENT_FILES, thread_name_prefix="processing-worker")
+    # The previous owner of this host is gone, resume its jobs right away
+    # Standalone workers can run side by side on the same host so they wait for the leases of the others to expire instead
+    _recover_processing_jobs(release_stale_leases=elect_owner)
+    last_recovery_sweep_time = time.monotonic()
+    last_heartbeat_time = time.monotonic()
+    while True:
+        try:
+            if time.monotonic() - last_recovery_sweep_time >= PROCESSING_JOBS_RECOVERY_SWEEP_SECONDS:
+                _recover_processing_jobs(release_stale_leases=False)
+                last_recovery_sweep_time = time.monotonic()
+            if time.monotonic() - last_heartbeat_time >= PROCESSING_JOB_HEARTBEAT_SECONDS:
+                _heartbeat_running_processing_jobs()
+                last_heartbeat_time = time.monotonic()
+            _consume_spool_descriptors()
+            _dispatch_processing_jobs()
+            with processing_scheduler_condition:
+                if not processing_scheduler_notified:
+                    processing_scheduler_condition.wait(timeout=PROCESSING_SCHEDULER_TICK_SECONDS)
+                processing_scheduler_notified = False
+        except Exception as e:
+            logger.error(f"Error in the processing scheduler loop, continuing anyway: {str(e)}")
+            time.sleep(1)
+
+def _recover_processing_jobs(release_stale_leases: bool) -> None:
+    """
+    Register the users of the user data directories available on this host that have pending jobs
+    Jobs interrupted by a crash are leased again once their lease expires, or right away if they were leased by a previous scheduler of this host
+    """
+    try:
+        user_data_dirs = [d for d in os.listdir(DATA_FOLDER_PATH) if not d.startswith(".") and os.path.isdir(os.path.join(DATA_FOLDER_PATH, d))]
+    except Exception as e:
+        logger.error(f"Error listing user data directories to recover processing jobs: {str(e)}")
+        return
+    for user_uuid in user_data_dirs:
+        if user_uuid in users_processing_queues or not os.path.exists(PROCESSING_DB_PATH.format(user_uuid=user_uuid)):
+            continue
+        try:
+            with user_data_lock_sync(user_uuid):
+                with Session(bind=_get_processing_db_engine(user_uuid)) as processing_db_session:
+                    if release_stale_leases:
+                        released_jobs_count = release_stale_processing_job_leases(processing_db_session, PROCESSING_JOB_LEASE_OWNER_PREFIX, PROCESSING_JOB_LEASE_OWNER)
+                        if released_jobs_count:
+                            logger.info(f"Resuming {released_jobs_count} interrupted processing jobs for user {user_uuid}")
+                    user_has_pending_jobs = has_pending_processing_jobs(processing_db_session)
+            if user_has_pending_jobs:
+                _register_user_processing_queue(user_uuid)
+        except Exception as e:
+            logger.error(f"Error recovering processing jobs for user {user_uuid}, continuing with the next user: {str(e)}")
+
+def _heartbeat_running_processing_jobs() -> None:
+    """Extend the leases of the running jobs, done from the scheduler thread so that long blocking steps in the workers do not lose their lease"""
+    with processing_scheduler_condition:
+        users_running_job_ids = {user_uuid: list(user_processing_queue.running_job_ids) for user_uuid, user_processing_queue in users_processing_queues.items() if user_processing_queue.running_job_ids}
+    for user_uuid, running_job_ids in users_running_job_ids.items():
+        try:
+            with Session(bind=_get_processing_db_engine(user_uuid)) as processing_db_session:
+                heartbeat_processing_jobs(processing_db_session, running_job_ids, PROCESSING_JOB_LEASE_OWNER)
+        except Exception as e:
+            logger.error(f"Failed to heartbeat processing jobs for user {user_uuid}: {str(e)}")
+
+def _dispatch_processing_jobs() -> None:
+    """Start as many jobs as the worker pool and the admission control allow"""
+    while True:
+        with processing_scheduler_condition:
+            if running_batches_count >= PROCESSING_MAX_CONCURRENT_FILES or not users_processing_ring:
+                return
+            has_running_batches = running_batches_count > 0
+        # Always let one batch run so that the queue makes progress on a loaded host
+        if has_running_batches and not _is_host_admitting_processing():
+            return
+        next_batch = _pick_next_processing_batch()
+        if next_batch is None:
+            return
+        user_processing_queue, job_ids = next_batch
+        processing_scheduler_executor.submit(_run_processing_batch, user_processing_queue, job_ids)
+
+def _is_host_admitting_processing() -> bool:
+    """Check the cpu load and the available memory of the host"""
+    try:
+        if os.getloadavg()[0] / (os.cpu_count() or 1) > PROCESSING_MAX_LOAD_PER_CPU:
+            return False
+    except OSError:
+        pass
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    # The value is in kB
+                    return int(line.split()[1]) * 1024 >= PROCESSING_MIN_AVAILABLE_MEMORY_BYTES
+    except OSError:
+        pass
+    return True
+
+def _pick_next_processing_batch() -> Tuple[UserProcessingQueue, List[int]] | None:
+    """
+    Pick and lease the next job with deficit round robin weighted by file size, its slot is reserved in the running batches
+    Instead of visiting the users round after round, the number of rounds needed by the first user to afford its next file is credited at once
+    The other leasable jobs of the same datasource are leased with it as a batch and charged to the user deficit
+    processing_scheduler_condition is only held to pick the user and reserve the slot, the jobs are peeked and leased without it
+    """
+    global running_batches_count
+    with processing_scheduler_condition:
+        users_to_peek = [
+            (user_processing_queue, set(user_processing_queue.running_job_ids), user_processing_queue.schedule_requests_count)
+            for user_processing_queue in (users_processing_queues[user_uuid] for user_uuid in users_processing_ring)
+            if user_processing_queue.running_batches_count < PROCESSING_MAX_CONCURRENT_FILES_PER_USER
+        ]
+
+    candidates: List[Tuple[UserProcessingQueue, int, int]] = []
+    for user_processing_queue, running_job_ids, schedule_requests_count in users_to_peek:
+        next_job, user_has_pending_jobs = _peek_next_processing_job(user_processing_queue.user_uuid, running_job_ids)
+        if next_job is None:
+            if not user_has_pending_jobs:
+                _unregister_idle_user_processing_queue(user_processing_queue, schedule_requests_count)
+            continue
+        job_id, file_size = next_job
+        candidates.append((user_processing_queue, job_id, max(file_size, 1)))
+
+    if not candidates:
+        return None
+
+    picked_job: Tuple[UserProcessingQueue, int, int] | None = None
+    with processing_scheduler_condition:
+        rounds = min(max(0, math.ceil((file_size - user_processing_queue.deficit) / PROCESSING_SCHEDULER_QUANTUM_BYTES)) for user_processing_queue, _, file_size in candidates)
+        for user_processing_queue, _, _ in candidates:
+            user_processing_queue.deficit += rounds * PROCESSING_SCHEDULER_QUANTUM_BYTES
+        for user_processing_queue, job_id, file_size in candidates:
+            if user_processing_queue.deficit >= file_size:
+                user_processing_queue.deficit -= file_size
+                # The next round starts after this user
+                if user_processing_queue.user_uuid in users_processing_ring:
+                    while users_processing_ring[0] != user_processing_queue.user_uuid:
+                        users_processing_ring.rotate(-1)
+                    users_processing_ring.rotate(-1)
+                # Reserve the slot so that the user and the host limits count the batch while its jobs are leased
+                user_processing_queue.running_job_ids.add(job_id)
+                user_processing_queue.running_batches_count += 1
+                running_batches_count += 1
+                running_job_ids = set(user_processing_queue.running_job_ids)
+                picked_job = (user_processing_queue, job_id, file_size)
+                break
+    if picked_job is None:
+        return None
+
+    user_processing_queue, job_id, file_size = picked_job
+    if not _lease_processing_job(user_processing_queue.user_uuid, job_id):
+        # Leased by another scheduler in the meantime, try again on the next tick
+        _release_processing_batch_slot(user_processing_queue, [job_id])
+        return None
+    batch_job_ids, batch_file_size = _lease_processing_batch_jobs(user_processing_queue.user_uuid, job_id, file_size, running_job_ids)
+    with processing_scheduler_condition:
+        user_processing_queue.running_job_ids.update(batch_job_ids)
+        user_processing_queue.deficit -= batch_file_size
+    return user_processing_queue, [job_id] + batch_job_ids
+
+def _release_processing_batch_slot(user_processing_queue: UserProcessingQueue, job_ids: List[int]) -> None:
+    """Release the slot of a batch that ended or could not be leased"""
+    global running_batches_count
+    with processing_scheduler_condition:
+        user_processing_queue.running_job_ids.difference_update(job_ids)
+        user_processing_queue.running_batches_count -= 1
+        running_batches_count -= 1
+        _notify_processing_scheduler()
+
+def _peek_next_processing_job(user_uuid: str, running_job_ids: Set[int]) -> Tuple[Tuple[int, int] | None, bool]:
+    """
+    Get the id and file size of the oldest leasable job of the user that is not already running
+    Also returns if the user has pending jobs, possibly waiting for their retry backoff
+    """
+    try:
+        _ensure_user_data_dir_mounted_sync(user_uuid)
+        with user_data_lock_sync(user_uuid):
+            with Session(bind=_get_processing_db_engine(user_uuid)) as processing_db_session:
+                next_job = get_next_leasable_processing_job(processing_db_session, running_job_ids)
+                next_job = (next_job.id, next_job.file_size) if next_job is not None else None
+                user_has_pending_jobs = next_job is not None or has_pending_processing_jobs(processing_db_session)
+        if user_has_pending_jobs:
+            # Keep the user data directory mounted while there are jobs to process
+            touch_user_data_dir(user_uuid)
+        return next_job, user_has_pending_jobs
+    except Exception as e:
+        logger.error(f"Failed to get the next processing job for user {user_uuid}: {str(e)}")
+        return None, False
+
+def _lease_processing_job(user_uuid: str, job_id: int) -> bool:
+    try:
+        with user_data_lock_sync(user_uuid):
+            with Session(bind=_get_processing_db_engine(user_uuid)) as processing_db_session:
+                return lease_processing_job(processing_db_session, job_id, PROCESSING_JOB_LEASE_OWNER)
+    except Exception as e:
+        logger.error(f"Failed to lease processing job {job_id} for user {user_uuid}: {str(e)}")
+        return False
+
+def _lease_processing_batch_jobs(user_uuid: str, job_id: int, file_size: int, running_job_ids: Set[int]) -> Tuple[List[int], int]:
+    """Lease the other leasable jobs of the datasource of a leased job within the batch limits, returns their ids and total file size"""
+    batch_job_ids = []
+    batch_file_size = 0
+    if PROCESSING_BATCH_MAX_FILES <= 1:
+        return batch_job_ids, batch_file_size
+    try:
+        with user_data_lock_sync(user_uuid):
+            with Session(bind=_get_processing_db_engine(user_uuid)) as processing_db_session:
+                job = processing_db_session.query(ProcessingJob).filter(ProcessingJob.id == job_id).first()
+                batch_jobs = get_leasable_processing_jobs_for_datasource(processing_db_session, job.datasource_name, running_job_ids | {job_id}, PROCESSING_BATCH_MAX_FILES - 1)
+                for batch_job in batch_jobs:
+                    if file_size + batch_file_size + batch_job.file_size > PROCESSING_BATCH_MAX_BYTES:
+                        break
+                    if lease_processing_job(processing_db_session, batch_job.id, PROCESSING_JOB_LEASE_OWNER):
+                        batch_job_ids.append(batch_job.id)
+                        batch_file_size += batch_job.file_size
+    except Exception as e:
+        # The batch is only an optimization, process the leased job alone
+        logger.error(f"Failed to lease a processing batch for user {user_uuid}: {str(e)}")
+    return batch_job_ids, batch_file_size
+
+def _ensure_user_data_dir_mounted_sync(user_uuid: str) -> None:
+    """Mount the user data directory from the scheduler thread if it has been unmounted while jobs were pending"""
+    if os.path.exists(USER_DATA_FOLDER_PATH.format(user_uuid=user_uuid)):
+        return
+    with user_data_lock_sync(user_uuid, mode=LockMode.EXCLUSIVE):
+        if not os.path.exists(USER_DATA_FOLDER_PATH.format(user_uuid=user_uuid)):
+            mount_user_data_dir(user_uuid)
+        touch_user_data_dir(user_uuid)
+
+def _unregister_idle_user_processing_queue(user_processing_queue: UserProcessingQueue, schedule_requests_count: int) -> None:
+    """Remove a user without pending jobs from the scheduler, unless it was scheduled again or has running jobs since its jobs were peeked"""
+    user_uuid = user_processing_queue.user_uuid
+    with processing_scheduler_condition:
+        if user_processing_queue.schedule_requests_count != schedule_requests_count or user_processing_queue.running_job_ids:
+            return
+        # Nothing left to process for this user, an empty queue loses its deficit
+        users_processing_queues.pop(user_uuid, None)
+        if user_uuid in users_processing_ring:
+            users_processing_ring.remove(user_uuid)
+    user_data_folder_path = USER_DATA_FOLDER_PATH.format(user_uuid=user_uuid)
+    with processing_scheduler_db_engines_lock:
+        db_engines = [processing_scheduler_db_engines.pop(db_path) for db_path in list(processing_scheduler_db_engines.keys()) if db_path.startswith(user_data_folder_path + "/")]
+    for db_engine in db_engines:
+        db_engine.dispose()
+    logger.info(f"No more files to process for user {user_uuid}")
+
+def _get_db_engine(db_path: str) -> Engine:
+    """Get the engine of a user database already created and migrated by the api"""
+    with processing_scheduler_db_engines_lock:
+        db_engine = processing_scheduler_db_engines.get(db_path)
+        if db_engine is None:
+            # The engine connects lazily, creating it does not access the database
+            db_engine = create_engine(
+                "sqlite:///" + db_path,
+                connect_args={
+                    "check_same_thread": False,
+                    "timeout": 30  # SQLite busy timeout in seconds
+                }
+            )
+            processing_scheduler_db_engines[db_path] = db_engine
+        return db_engine
+
+def _get_processing_db_engine(user_uuid: str) -> Engine:
+    """Get the engine of the processing jobs database of a user, migrating it on first use"""
+    db_path = PROCESSING_DB_PATH.format(user_uuid=user_uuid)
+    with processing_scheduler_db_engines_lock:
+        db_engine = processing_scheduler_db_engines.get(db_path)
+    if db_engine is None:
+        # The migration runs without the lock so that the other users are not blocked by it
+        db_engine = get_processing_db_session_for_user(user_uuid).get_bind()
+        with processing_scheduler_db_engines_lock:
+            db_engine = processing_scheduler_db_engines.setdefault(db_path, db_engine)
+    return db_engine
+
+
+def _run_processing_batch(user_processing_queue: UserProcessingQueue, job_ids: List[int]) -> None:
+    """Process a batch of jobs in a worker thread of the pool, each worker thread keeps its own event loop"""
+    try:
+        loop = getattr(processing_worker_thread_local, "loop", None)
+        if loop is None:
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            processing_worker_thread_local.loop = loop
+        loop.run_until_complete(_process_batch(user_processing_queue, job_ids))
+    except Exception as e:
+        logger.error(f"Processing batch error for user {user_processing_queue.user_uuid}: {str(e)}")
+    finally:
+        touch_user_data_dir(user_processing_queue.user_uuid)
+        _release_processing_batch_slot(user_processing_queue, job_ids)
+
+async def _process_batch(user_processing_queue: UserProcessingQueue, job_ids: List[int]) -> None:
+    """Process the files of a batch of leased jobs of the same datasource with sessions dedicated to this batch"""
+    user_uuid = user_processing_queue.user_uuid
+    # Hold a shared lock on the user data so that it is not unmounted while the files are processed
+    async with user_data_lock(user_uuid):
+        with Session(bind=_get_processing_db_engine(user_uuid)) as processing_db_session:
+            jobs = processing_db_session.query(ProcessingJob).filter(ProcessingJob.id.in_(job_ids)).all()
+            if not jobs:
+                return
+
+            with Session(bind=_get_db_engine(jobs[0].file_manager_db_path)) as file_manager_db_session, \
+                    Session(bind=_get_db_engine(DATASOURCES_DB_PATH.format(user_uuid=user_uuid))) as datasources_db_session, \
+                    Session(bind=_get_db_engine(SETTINGS_DB_PATH.format(user_uuid=user_uuid))) as settings_db_session, \
+                    Session(bind=_get_db_engine(PROCESSING_STACKS_DB_PATH.format(user_uuid=user_uuid))) as processing_stacks_db_session:
+                jobs_files: List[Tuple[ProcessingJob, File]] = []
+                for job in jobs:
+                    file = file_manager_db_session.query(File).filter(File.id == job.file_id).first()
+                    if file is None or file.status not in (FileStatus.QUEUED, FileStatus.PROCESSING):
+                        # Deleted or dequeued since the job was created
+                        complete_processing_job(processing_db_session, job)
+                        continue
+
+                    if file.status == FileStatus.PROCESSING:
+                        # The previous attempt was interrupted, the already processed stacks are skipped and the interrupted one is upserted again
+                        logger.info(f"Resuming interrupted processing of file {file.path}, attempt {job.attempts}")
+                        if job.attempts > job.max_attempts:
+                            file.status = FileStatus.ERROR
+                            file.error_message = "Processing was interrupted too many times"
+                            file_manager_db_session.commit()
+                            publish_files_processing_status(user_uuid, [file])
+                            fail_processing_job(processing_db_session, job, file.error_message)
+                            continue
+                    jobs_files.append((job, file))
+                if not jobs_files:
+                    return
+
+                if not user_processing_queue.models_checked:
+                    # Wait for the models to be downloaded
+                    # TODO Make it work with other providers
+                    if not await can_process(settings_db_session, True):
+                        # The models are not ready yet, the files are processed later without losing an attempt
+                        logger.info(f"Models not ready for user {user_uuid}, postponing the processing of {len(jobs_files)} files")
+                        postpone_processing_jobs(processing_db_session, [job for job, _ in jobs_files], PROCESSING_MODELS_UNAVAILABLE_RETRY_SECONDS)
+                        return
+                    user_processing_queue.models_checked = True
+
+                try:
+                    await _process_files(file_manager_db_session=file_manager_db_session, datasources_db_session=datasources_db_session, settings_db_session=settings_db_session, processing_stacks_db_session=processing_stacks_db_session, files=[file for _, file in jobs_files], user_uuid=user_uuid)
+                except Exception as e:
+                    logger.error(f"Failed to process queued files batch: {str(e)}, marking the unfinished files as error")
+                    file_manager_db_session.rollback()
+                    for _, file in jobs_files:
+                        if file.status != FileStatus.COMPLETED:
+                            file.status = FileStatus.ERROR
+                            file.error_message = str(e)
+                    file_manager_db_session.commit()
+                    publish_files_processing_status(user_uuid, [file for _, file in jobs_files])
+
+                for job, file in jobs_files:
+                    if file.status != FileStatus.ERROR:
+                        complete_processing_job(processing_db_session, job)
+                        continue
+
+                    if fail_processing_job(processing_db_session, job, file.error_message or "Unknown error"):
+                        # Show the file as queued again until its retry, the error of the last attempt is kept
+                        logger.info(f"Retrying processing of file {file.path} after {job.available_at}")
+                        file.status = FileStatus.QUEUED
+                        file_manager_db_session.commit()
+                        publish_files_processing_status(user_uuid, [file])
@@ -7,6 +7,16 @@ class ProcessingItem(BaseModel):
 
 class ProcessingRequest(BaseModel):
     items: List[ProcessingItem]
+    # Lane of the queued files, interactive for the files a user waits for and bulk for the backfills
+    priority: Literal['interactive', 'normal', 'bulk'] = 'normal'
+
+class ProcessingPriorityRequest(BaseModel):
+    # Files or folders whose waiting files are moved to the lane
+    original_paths: List[str]
+    priority: Literal['interactive', 'normal', 'bulk']
+
+class ProcessingPriorityResponse(BaseModel):
+    updated_count: int
 
 
 class ItemProcessingStatusResponse(BaseModel):
@@ -20,3 +30,16 @@ class ProcessingStatusResponse(BaseModel):
     queued_items: List[ItemProcessingStatusResponse]
     processing_count: int
     processing_items: List[ItemProcessingStatusResponse]
+    # Files queued by the request that were not queued before, only set in the response of a queuing request
+    newly_queued_count: int = 0
+
+
+class ProcessingCacheStatsResponse(BaseModel):
+    datasource_identifier: str
+    entries_count: int
+    size_bytes: int
+    max_size_bytes: int
+    hits: int
+    misses: int
+    evictions: int
+    evicted_bytes: int
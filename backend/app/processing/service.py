@@ -1,30 +1,37 @@
 from app.datasources.utils import get_datasource_identifier_from_path
 from app.datasources.file_manager.service.service import get_file_info
+from app.datasources.file_manager.schemas import FileInfoResponse
 from app.datasources.file_manager.service.llama_index import delete_file_llama_index, delete_file_processing_stack_from_llama_index
 from app.datasources.file_manager.database.models import File, FileStatus, Folder
 from app.datasources.database.models import Datasource
-from app.processing_stacks.database.models import ProcessingStack
-from app.datasources.file_manager.service.llama_index import get_llama_index_datasource_folder_path, create_vector_store, create_doc_store
-from app.processing_stacks.service import get_transformations_for_stack
-from app.ollama_status.service import can_process
+from app.datasources.file_manager.service.llama_index import DatasourceStores, acquire_datasource_stores, release_datasource_stores, get_ingestion_cache_db_path, get_vector_store_ref_doc_node_ids
+from app.datasources.file_manager.service.ingestion_cache import SqliteLRUCacheKVStore
+from app.processing_stacks.service import get_transformations_for_stack, get_processing_stacks_routing_index, ProcessingStacksRoutingIndex
 from app.datasources.file_manager.utils import validate_path
 from app.settings.service import get_setting
-from app.processing.schemas import ProcessingItem, ProcessingRequest, ProcessingStatusResponse, ItemProcessingStatusResponse
+from app.settings.schemas import SettingResponse
+from app.processing.schemas import ProcessingItem, ProcessingRequest, ProcessingStatusResponse, ItemProcessingStatusResponse, ProcessingCacheStatsResponse
+from app.processing.embedding_batches import aembed_nodes_in_batches
+from app.processing.parsing_pool import aparse_file
+from app.processing.status_hub import publish_files_processing_status
+from app.processing.tracing import ProcessingTrace, PROCESSING_STAGE_DECRYPT, PROCESSING_STAGE_PARSE_QUEUE, PROCESSING_STAGE_LOAD, PROCESSING_STAGE_SPLIT, PROCESSING_STAGE_DIFF, PROCESSING_STAGE_EXTRACT, PROCESSING_STAGE_EMBED, PROCESSING_STAGE_UPSERT
 
 # Set the llama index default llm and embed model to none otherwise it will raise an error.
 # We use on demand initialization of the llm and embed model when needed as it can change depending on the request.
 from llama_index.core.settings import Settings
 Settings.llm = None
 Settings.embed_model = None
-from llama_index.core.ingestion import IngestionPipeline, DocstoreStrategy
-from llama_index.core.readers import SimpleDirectoryReader
+from llama_index.core.ingestion import IngestionPipeline, IngestionCache
+from llama_index.vector_stores.chroma import ChromaVectorStore
+from llama_index.core.schema import BaseNode, Document, TransformComponent
+from llama_index.core.storage.docstore.types import BaseDocumentStore
 
 from datetime import datetime, timedelta
-import os
-from typing import List, Dict
-from pathlib import Path
+from typing import List, Dict, Tuple
+from sqlalchemy import update, and_, or_, func, text, column, bindparam, ColumnElement
 from sqlalchemy.orm import Session
 import json
+import time
 import threading
 import asyncio
 
@@ -32,74 +39,45 @@ import logging
 
 logger = logging.getLogger("uvicorn")
 
-# Global processing thread reference
-users_processing_threads: Dict[str, threading.Thread] = {}
-users_processing_threads_lock = threading.Lock()
-
+# Collection of the ingestion cache holding the outputs of the transformations between the node parser and the embedding
+PROCESSING_TRANSFORMATIONS_CACHE_COLLECTION = "transformations"
+
+# The stacks columns hold json encoded lists in json columns, these are the decoded lists of the file being updated, empty if not set
+FILE_STACKS_TO_PROCESS_JSON_SQL = "coalesce(nullif(json_extract(files.stacks_to_process, '$'), ''), '[]')"
+FILE_PROCESSED_STACKS_JSON_SQL = "coalesce(nullif(json_extract(files.processed_stacks, '$'), ''), '[]')"
+# Whether some of the stacks of the json list :stacks are not already processed for the file
+FILE_HAS_STACKS_TO_ADD_SQL = f"""EXISTS (
+    SELECT 1 FROM json_each(:stacks) AS stack
+    WHERE stack.value NOT IN (SELECT value FROM json_each({FILE_PROCESSED_STACKS_JSON_SQL}))
+)"""
+# Stacks to process of the file followed by the stacks of :stacks not already processed or to process, json encoded again as the python code does
+FILE_STACKS_TO_PROCESS_WITH_STACKS_TO_ADD_SQL = f"""SELECT json_quote(json_group_array(value) || '') FROM (
+    SELECT 0 AS part, key, value FROM json_each({FILE_STACKS_TO_PROCESS_JSON_SQL})
+    UNION ALL
+    SELECT 1 AS part, key, value FROM json_each(:stacks)
+    WHERE value NOT IN (SELECT value FROM json_each({FILE_PROCESSED_STACKS_JSON_SQL}))
+    AND value NOT IN (SELECT value FROM json_each({FILE_STACKS_TO_PROCESS_JSON_SQL}))
+    ORDER BY part, key
+)"""
+
+# Sessions of the users with queued files, used to report the queue status
 users_file_manager_db_sessions: Dict[str, Dict[str, Session]] = {}
 users_settings_db_session: Dict[str, Session] = {}
 users_processing_stacks_db_session: Dict[str, Session] = {}
 users_datasources_db_session: Dict[str, Session] = {}
+users_processing_db_sessions_lock = threading.Lock()
 
-def start_processing_thread(user_uuid: str, file_manager_db_sessions: Dict[str, Session], datasources_db_session: Session, settings_db_session: Session, processing_stacks_db_session: Session):
-    """Start a new processing thread if none is running"""
-    global users_processing_threads
-    global users_file_manager_db_sessions
-    global users_settings_db_session
-    global users_processing_stacks_db_session
-    global users_datasources_db_session
-
-    with users_processing_threads_lock:
-        # Initialize the user's thread entry if it doesn't exist
-        if user_uuid not in users_processing_threads:
-            users_processing_threads[user_uuid] = None
-            
-        # Now check if there's an active thread
-        if users_processing_threads[user_uuid] and users_processing_threads[user_uuid].is_alive():
-            logger.info(f"Processing thread already running")
-            return
-        
-        # Init the global variables for the user if they don't exist
+def register_user_processing_db_sessions(user_uuid: str, file_manager_db_sessions: Dict[str, Session], datasources_db_session: Session, settings_db_session: Session, processing_stacks_db_session: Session):
+    """Register the sessions of a user with queued files so that the queue status can be reported, the files are processed by the scheduler"""
+    with users_processing_db_sessions_lock:
         if user_uuid not in users_file_manager_db_sessions:
             users_file_manager_db_sessions[user_uuid] = {}
-        if user_uuid not in users_settings_db_session:
-            users_settings_db_session[user_uuid] = {}
-        if user_uuid not in users_processing_stacks_db_session:
-            users_processing_stacks_db_session[user_uuid] = {}
-        if user_uuid not in users_datasources_db_session:
-            users_datasources_db_session[user_uuid] = {}
-        
-        # Store the sessions in the global variables
-        # Append the sessions to the global variables
         for datasource_name in file_manager_db_sessions.keys():
             if datasource_name not in users_file_manager_db_sessions[user_uuid]:
                 users_file_manager_db_sessions[user_uuid][datasource_name] = file_manager_db_sessions[datasource_name]
         users_settings_db_session[user_uuid] = settings_db_session
         users_processing_stacks_db_session[user_uuid] = processing_stacks_db_session
         users_datasources_db_session[user_uuid] = datasources_db_session
-        
-        # Create thread sessions
-        file_manager_thread_sessions: Dict[str, Session] = {}
-        for datasource_name in file_manager_db_sessions.keys():
-            file_manager_thread_sessions[datasource_name] = Session(bind=file_manager_db_sessions[datasource_name].get_bind())
-        settings_thread_session = Session(bind=settings_db_session.get_bind())
-        processing_stacks_thread_session = Session(bind=processing_stacks_db_session.get_bind())
-        datasources_thread_session = Session(bind=datasources_db_session.get_bind())
-
-        def process_wrapper():
-            try:
-                asyncio.run(process_queued_files(file_manager_thread_sessions, datasources_thread_session, settings_thread_session, processing_stacks_thread_session, user_uuid))
-            except Exception as e:
-                logger.error(f"Processing thread error: {str(e)}")
-            finally:
-                for file_manager_thread_session in file_manager_thread_sessions.values():
-                    file_manager_thread_session.close()
-                settings_thread_session.close()
-                processing_stacks_thread_session.close()
-                datasources_thread_session.close()
-
-        users_processing_threads[user_uuid] = threading.Thread(target=process_wrapper, daemon=True)
-        users_processing_threads[user_uuid].start()
 
 
 def mark_items_as_queued(
@@ -107,10 +85,13 @@ def mark_items_as_queued(
         file_manager_db_session: Session,
         user_uuid: str, 
         items: List[ProcessingItem]
-    ):
-    """Mark items as queued"""
+    ) -> Tuple[int, List[int]]:
+    """Mark items as queued, returns the number of files that were not queued before and the ids of the files queued by this call"""
     try:
-        total_files = 0
+        newly_queued_count = 0
+        queued_file_ids: List[int] = []
+        # The stacks of all the files are validated against the routing index instead of querying the stacks for each file
+        routing_index = get_processing_stacks_routing_index(processing_stacks_db_session)
         
         for item in items:
             # Validate path
@@ -121,136 +102,110 @@ def mark_items_as_queued(
             # Check if it's a folder
             folder = file_manager_db_session.query(Folder).filter(Folder.original_path == item.original_path).first()
             if folder:
-                # Get all files in the folder from the database
-                files = file_manager_db_session.query(File).filter(File.path.like(f"{folder.path}%")).all()
-                for file in files:
-                    mark_file_as_queued(
-                        processing_stacks_db_session,
-                        file_manager_db_session,
-                        file.path,
-                        item.stacks_identifiers_to_queue
-                    )
-                total_files += len(files)
-                continue
-                
-            # If not a folder, try as a file
-            file = file_manager_db_session.query(File).filter(File.original_path == item.original_path).first()
-            if file:
-                mark_file_as_queued(
-                    processing_stacks_db_session,
+                # Queue all the files under the folder, escape the path so that its characters are not like wildcards and do not match the sibling folders with the same prefix
+                folder_newly_queued_count, folder_queued_file_ids = _mark_files_as_queued(
                     file_manager_db_session,
-                    file.path,
+                    routing_index,
+                    File.path.startswith(f"{folder.path}/", autoescape=True),
                     item.stacks_identifiers_to_queue
                 )
-                total_files += 1
+                newly_queued_count += folder_newly_queued_count
+                queued_file_ids.extend(folder_queued_file_ids)
+                continue
+                
+            # If not a folder, try as a file
+            file_id = file_manager_db_session.query(File.id).filter(File.original_path == item.original_path).scalar()
+            if file_id is not None:
+                file_newly_queued_count, file_queued_file_ids = _mark_files_as_queued(file_manager_db_session, routing_index, File.id == file_id, item.stacks_identifiers_to_queue)
+                newly_queued_count += file_newly_queued_count
+                queued_file_ids.extend(file_queued_file_ids)
                 continue
 
             logger.warning(f"File or folder {item.original_path} not found, skipping")
 
+        return newly_queued_count, queued_file_ids
+
     except Exception as e:
         logger.error(f"Failed to mark items as queued: {str(e)}")
         raise
 
-# Not used for now do not use it
-def _validate_stacks_to_process_for_file_extension(processing_stacks_db_session: Session, stacks_to_process: List[str], file_extension: str) -> List[str]:
-    """Validate the stacks to process for a given file extension"""
+def get_items_file_ids(file_manager_db_session: Session, original_paths: List[str]) -> List[int]:
+    """Get the ids of the files and of the files under the folders"""
     try:
-        validated_stacks_to_process = []
-        for stack_name in stacks_to_process:
-            # Get the stack from the database
-            stack = processing_stacks_db_session.query(ProcessingStack).filter(ProcessingStack.identifier == stack_name).first()
-            if not stack:
-                logger.error(f"Stack {stack_name} not found, skipping")
+        file_ids: List[int] = []
+        for original_path in original_paths:
+            validate_path(original_path)
+            folder = file_manager_db_session.query(Folder).filter(Folder.original_path == original_path).first()
+            if folder:
+                file_ids.extend(file_id for (file_id,) in file_manager_db_session.query(File.id).filter(File.path.startswith(f"{folder.path}/", autoescape=True)).all())
                 continue
-            # Check if this transformation stack is applicable to the file type
-            if stack.supported_extensions and file_extension in stack.supported_extensions:
-                validated_stacks_to_process.append(stack_name)
-            else:
-                logger.warning(f"Stack {stack_name} does not support file extension {file_extension}, skipping")
-                
-        return validated_stacks_to_process
+            file_id = file_manager_db_session.query(File.id).filter(File.original_path == original_path).scalar()
+            if file_id is not None:
+                file_ids.append(file_id)
+                continue
+            logger.warning(f"File or folder {original_path} not found, skipping")
+        return file_ids
     except Exception as e:
-        logger.error(f"Failed to validate stacks to process for file extension {file_extension}: {str(e)}")
-        return stacks_to_process
+        logger.error(f"Failed to get the file ids of the items: {str(e)}")
+        raise
 
 def mark_file_as_queued(
         processing_stacks_db_session: Session, 
         file_manager_db_session: Session,
         file_path: str, 
         stacks_to_process: List[str]
-    ):
-    """Mark a file as queued"""
+    ) -> List[int]:
+    """Mark a file as queued, returns its id if it was queued"""
+    # Get the file
+    file_id = file_manager_db_session.query(File.id).filter(File.path == file_path).scalar()
+    if file_id is None:
+        raise ValueError(f"File not found: {file_path}")
+    routing_index = get_processing_stacks_routing_index(processing_stacks_db_session)
+    _, queued_file_ids = _mark_files_as_queued(file_manager_db_session, routing_index, File.id == file_id, stacks_to_process)
+    return queued_file_ids
+
+def _mark_files_as_queued(
+        file_manager_db_session: Session,
+        routing_index: ProcessingStacksRoutingIndex,
+        files_filter: ColumnElement[bool],
+        stacks_to_process: List[str]
+    ) -> Tuple[int, List[int]]:
+    """
+    Add the stacks supporting the extension of each file and not already processed to its stacks to process
+    The files are updated in the database without loading them, with one update per group of extensions supporting the same stacks, in a single transaction
+    Returns the number of files that were not queued before and the ids of the files that got stacks to process
+    """
     try:
-        # Get the file extension
-        file_extension = os.path.splitext(file_path)[1]
-        # For each transformation stack name
-        validated_stacks_to_process = _validate_stacks_to_process_for_file_extension(processing_stacks_db_session, stacks_to_process, file_extension)
-        
-        # Get the file
-        file = file_manager_db_session.query(File).filter(File.path == file_path).first()
-        if not file:
-            raise ValueError(f"File not found: {file_path}")
-
-        # Try to load the stacks_to_process as a json list, set it as an empty list if it is null
-        existing_stacks_to_process = json.loads(file.stacks_to_process) if file.stacks_to_process else []
-        # Try to load the processed_stacks as a json list, set it as an empty list if it is null
-        processed_stacks = json.loads(file.processed_stacks) if file.processed_stacks else []
-
-        stacks_to_process_not_already_processed = []
-        # Check in the processing_stacks json list and add the stacks that are not already processed
-        for stack in validated_stacks_to_process:
-            if stack not in processed_stacks:
-                stacks_to_process_not_already_processed.append(stack)
-
-        if not stacks_to_process_not_already_processed:
-            logger.info(f"All stacks for file {file_path} are already processed, skipping")
-            return
-        
-        stacks_to_process_not_already_in_stacks_to_process = []
-        for stack in stacks_to_process_not_already_processed:
-            if stack not in existing_stacks_to_process:
-                stacks_to_process_not_already_in_stacks_to_process.append(stack)
-
-        # Make sure the file is queued as there is stacks to process
-        file.status = FileStatus.QUEUED
-        # Add the stacks to process to the existing stacks to process
-        existing_stacks_to_process.extend(stacks_to_process_not_already_in_stacks_to_process)
-        # Convert back to json string and store it in the database
-        file.stacks_to_process = json.dumps(existing_stacks_to_process)
-        
+        files_path = func.lower(File.path)
+        groups_filters: List[Tuple[str, ColumnElement[bool]]] = []
+        for stacks, file_extensions in routing_index.get_extensions_by_stacks(stacks_to_process).items():
+            stacks_json = json.dumps(list(stacks))
+            groups_filters.append((stacks_json, and_(
+                # The extension of the file name, a name starting with a dot has no extension
+                or_(*[and_(files_path.endswith(file_extension, autoescape=True), ~files_path.endswith(f"/{file_extension}", autoescape=True)) for file_extension in file_extensions]),
+                text(FILE_HAS_STACKS_TO_ADD_SQL).bindparams(bindparam("stacks", stacks_json, unique=True))
+            )))
+        if not groups_filters:
+            return 0, []
+
+        # Counted before the updates in a single query as the updates do not return the previous status
+        newly_queued_count = file_manager_db_session.query(func.count(File.id)).filter(files_filter, File.status != FileStatus.QUEUED, or_(*[group_filter for _, group_filter in groups_filters])).scalar()
+        queued_file_ids: List[int] = []
+        for stacks_json, group_filter in groups_filters:
+            result = file_manager_db_session.execute(
+                update(File).where(files_filter, group_filter).values(
+                    status=FileStatus.QUEUED,
+                    stacks_to_process=text(FILE_STACKS_TO_PROCESS_WITH_STACKS_TO_ADD_SQL).bindparams(bindparam("stacks", stacks_json, unique=True)).columns(column("stacks_to_process")).scalar_subquery()
+                ).returning(File.id).execution_options(synchronize_session=False)
+            )
+            queued_file_ids.extend(file_id for (file_id,) in result.all())
         file_manager_db_session.commit()
+        logger.info(f"Queued {len(queued_file_ids)} files, {newly_queued_count} newly queued")
+        return newly_queued_count, queued_file_ids
 
     except Exception as e:
         file_manager_db_session.rollback()
-        logger.error(f"Failed to mark file as queued: {str(e)}")
-        raise
-
-async def process_queued_files(
-        file_manager_db_sessions: Dict[str, Session],
-        datasources_db_session: Session,
-        settings_db_session: Session,
-        processing_stacks_db_session: Session,
-        user_uuid: str
-    ):
-    """Processing loop"""
-    try:
-        # TODO Check only for the datasources that are in the files to process
-        # TODO Make it work with other providers
-
-        # Wait for Ollama models to be downloaded
-        #for file_manager_db_session in file_manager_db_sessions.values():
-        await can_process(settings_db_session, True)
-   
-        logger.info("Beginning processing files")
-        # Process all files marked as processing that have been interrupted with unfinished processing
-        #await _process_files_marked_as_processing(file_manager_db_session=file_manager_db_session, settings_db_session=settings_db_session, processing_stacks_db_session=processing_stacks_db_session, user_uuid=user_uuid)
-
-        # Process all queued files
-        await _process_all_queued_files(file_manager_db_sessions=file_manager_db_sessions, datasources_db_session=datasources_db_session, settings_db_session=settings_db_session, processing_stacks_db_session=processing_stacks_db_session, user_uuid=user_uuid)
-   
-
-    except Exception as e:
-        logger.error(f"Processing loop error: {str(e)}")
+        logger.error(f"Failed to mark files as queued: {str(e)}")
         raise
 
 #async def _process_files_marked_as_processing(file_manager_db_sessions: Dict[str, Session], settings_db_session: Session, processing_stacks_db_session: Session, user_uuid: str):
@@ -308,256 +263,394 @@ async def process_queued_files(
 #        logger.error(f"Failed to process all queued files: {str(e)}")
 #        raise
         
-async def _process_all_queued_files(file_manager_db_sessions: Dict[str, Session], datasources_db_session: Session, settings_db_session: Session, processing_stacks_db_session: Session, user_uuid: str):
-    """Process all queued files"""
-    try:
-        queued_files = []  # Initialize the variable
-        # For each datasource file manager db session we have
-        for file_manager_db_session in file_manager_db_sessions.values():
-            # Get the files one by one so that in case of queued file changes we get the freshest database data
-            # Get oldest queued file
-            queued_files.extend(file_manager_db_session.query(File).filter(
-                File.status == FileStatus.QUEUED
-            ).order_by(
-                File.uploaded_at.asc()
-            ).all())
-
-            if not queued_files:
-                continue
+async def _process_single_file(file_manager_db_session: Session, datasources_db_session: Session, settings_db_session: Session, processing_stacks_db_session: Session, file: File, user_uuid: str):
+    """Process a single file through the ingestion pipeline"""
+    await _process_files(file_manager_db_session=file_manager_db_session, datasources_db_session=datasources_db_session, settings_db_session=settings_db_session, processing_stacks_db_session=processing_stacks_db_session, files=[file], user_uuid=user_uuid)
+
+async def _process_files(file_manager_db_session: Session, datasources_db_session: Session, settings_db_session: Session, processing_stacks_db_session: Session, files: List[File], user_uuid: str):
+    """
+    Process files through the ingestion pipeline, the nodes of the files of the same datasource are embedded together in large batches
+    A failing file is marked as error without failing the other files
+    """
+    files_responses: Dict[int, FileInfoResponse] = {}
+    # The stages of each file are recorded in the processing metrics and saved on the file once it is completed or failed
+    files_traces: Dict[int, ProcessingTrace] = {file.id: ProcessingTrace() for file in files}
+    for file in files:
+        try:
+            # Get file response, its content is read and decrypted
+            with files_traces[file.id].stage(PROCESSING_STAGE_DECRYPT, bytes=file.size or 0):
+                files_responses[file.id] = await get_file_info(file_manager_db_session, user_uuid, file.original_path, include_content=True)
+
+            # Update status to processing
+            file.error_message = None
+            file.status = FileStatus.PROCESSING
+            file.processing_started_at = datetime.now()
+            file_manager_db_session.commit()
+            publish_files_processing_status(user_uuid, [file])
 
-            for file in queued_files:
-                try:
-                    await _process_single_file(file_manager_db_session=file_manager_db_session, datasources_db_session=datasources_db_session, settings_db_session=settings_db_session, processing_stacks_db_session=processing_stacks_db_session, file=file, user_uuid=user_uuid)
-                except Exception as e:
-                    logger.error(f"Failed to process queued file {file.path}: {str(e)}, marking as error")
-                    file.status = FileStatus.ERROR
-                    file.error_message = str(e)
-                    file_manager_db_session.commit()
-                queued_files.remove(file)
-
-        if not queued_files:
-            logger.info("No more files to process, stopping")
-            # Reset the global variables for the user
-            # TODO Make it remove the unuesed datasource once there is no more files in this datasource to process
-            users_file_manager_db_sessions[user_uuid] = {}
-            users_settings_db_session[user_uuid] = {}
-            users_processing_stacks_db_session[user_uuid] = {}
-            return
+            logger.info(f"Processing file: {file.path}")
+        except Exception as e:
+            _mark_file_as_error(file_manager_db_session, file, e, user_uuid, files_traces[file.id])
+
+    # Group the files by datasource as the embedding setting and the stores are per datasource
+    datasources_files: Dict[str, List[File]] = {}
+    for file in files:
+        if file.id in files_responses:
+            datasources_files.setdefault(get_datasource_identifier_from_path(file.path), []).append(file)
+
+    for datasource_identifier, datasource_files in datasources_files.items():
+        # Process the files stack by stack so that the files sharing a stack are embedded together
+        stack_identifiers = []
+        for file in datasource_files:
+            for stack_identifier in (json.loads(file.stacks_to_process) if file.stacks_to_process else []):
+                if stack_identifier not in stack_identifiers:
+                    stack_identifiers.append(stack_identifier)
+
+        for stack_identifier in stack_identifiers:
+            stack_files = [file for file in datasource_files if file.id in files_responses and stack_identifier in (json.loads(file.stacks_to_process) if file.stacks_to_process else [])]
+            if not stack_files:
+                continue
+            failed_files = await _process_files_stack(
+                file_manager_db_session=file_manager_db_session,
+                datasources_db_session=datasources_db_session,
+                settings_db_session=settings_db_session,
+                processing_stacks_db_session=processing_stacks_db_session,
+                datasource_identifier=datasource_identifier,
+                stack_identifier=stack_identifier,
+                files=stack_files,
+                files_responses=files_responses,
+                files_traces=files_traces,
+                user_uuid=user_uuid
+            )
+            for file in stack_files:
+                if file.id in failed_files:
+                    files_responses.pop(file.id)
+                    _mark_file_as_error(file_manager_db_session, file, failed_files[file.id], user_uuid, files_traces[file.id])
+            # Publish the stacks left to process of the files
+            publish_files_processing_status(user_uuid, [file for file in stack_files if file.id in files_responses])
+
+    for file in files:
+        if file.id not in files_responses:
+            continue
+        try:
+            # All stacks are processed, update status to completed
+            file.status = FileStatus.COMPLETED
+            file.processing_started_at = datetime.now()
+            file.processing_trace = json.dumps(files_traces[file.id].finish("completed"))
+            file_manager_db_session.commit()
+            publish_files_processing_status(user_uuid, [file])
 
-    except Exception as e:
-        logger.error(f"Failed to process all queued files: {str(e)}")
-        raise
+            logger.info(f"Processed file '{file.path}' for user '{user_uuid}'")
+        except Exception as e:
+            _mark_file_as_error(file_manager_db_session, file, e, user_uuid, files_traces[file.id])
 
-async def _process_single_file(file_manager_db_session: Session, datasources_db_session: Session, settings_db_session: Session, processing_stacks_db_session: Session, file: File, user_uuid: str):
-    """Process a single file through the ingestion pipeline"""
+def _mark_file_as_error(file_manager_db_session: Session, file: File, error: Exception, user_uuid: str, trace: ProcessingTrace):
+    logger.error(f"Failed to process file {file.path}: {str(error)}")
     try:
-        # Get file response
-        file_response = await get_file_info(file_manager_db_session, user_uuid, file.original_path, include_content=True)
-
-        # Update status to processing
-        file.error_message = None
-        file.status = FileStatus.PROCESSING
-        file.processing_started_at = datetime.now()
+        file.status = FileStatus.ERROR
+        file.error_message = str(error)
+        file.processing_trace = json.dumps(trace.finish("error"))
         file_manager_db_session.commit()
+        publish_files_processing_status(user_uuid, [file])
+    except Exception as e:
+        file_manager_db_session.rollback()
+        logger.error(f"Failed to update file status for {file.path}: {str(e)}")
 
-        logger.info(f"Processing file: {file.path}")
-        
-        # Properly decode JSON stacks with defaults
-        stacks_to_process = json.loads(file.stacks_to_process) if file.stacks_to_process else []
+async def _process_files_stack(
+        file_manager_db_session: Session,
+        datasources_db_session: Session,
+        settings_db_session: Session,
+        processing_stacks_db_session: Session,
+        datasource_identifier: str,
+        stack_identifier: str,
+        files: List[File],
+        files_responses: Dict[int, FileInfoResponse],
+        files_traces: Dict[int, ProcessingTrace],
+        user_uuid: str
+    ) -> Dict[int, Exception]:
+    """
+    Process a stack for files of the same datasource:
+    - the documents of the files are loaded and split at the same time in the parsing process pool, the other transformations before the embedding run in this thread
+    - the nodes of the changed documents are diffed against the nodes already in the vector store, only the new chunks go through the next steps
+    - the new nodes of all the files are embedded together with concurrent batched requests
+    - the new nodes of each file are added to the vector store and its obsolete nodes are deleted from it
+    Returns the errors of the files that failed, keyed by file id
+    """
+    failed_files: Dict[int, Exception] = {}
+    files_to_process: List[File] = []
+    for file in files:
         processed_stacks = json.loads(file.processed_stacks) if file.processed_stacks else []
-        datasource_identifier = get_datasource_identifier_from_path(file.path)
+        # If the stack is already processed, skip it
+        if stack_identifier in processed_stacks:
+            logger.info(f"Stack {stack_identifier} already processed for file {file.path}, skipping")
+            # Remove the stack from the stacks_to_process list
+            stacks_to_process = json.loads(file.stacks_to_process) if file.stacks_to_process else []
+            file.stacks_to_process = json.dumps([stack for stack in stacks_to_process if stack != stack_identifier])
+            file_manager_db_session.commit()
+            continue
+        files_to_process.append(file)
+    if not files_to_process:
+        return failed_files
+
+    try:
         datasource = datasources_db_session.query(Datasource).filter(Datasource.identifier == datasource_identifier).first()
-        
-        # Process each stack
-        for stack_identifier in stacks_to_process:
-            try:
-                # If the stack is not already processed, process it
-                if processed_stacks and stack_identifier in processed_stacks:
-                    logger.info(f"Stack {stack_identifier} already processed, skipping")
-                    # Remove the stack from the stacks_to_process list
-                    stacks_to_process = [stack for stack in stacks_to_process if stack != stack_identifier]
-                    file.stacks_to_process = json.dumps(stacks_to_process)
-                    file_manager_db_session.commit()
-                    continue
+        # Get the embedding settings for this datasource
+        embedding_settings_response = get_setting(settings_db_session, datasource.embedding_setting_identifier)
+        # The stores are held until the nodes are upserted so that they are not closed or reopened while the files are parsed and embedded
+        stores = acquire_datasource_stores(datasource.identifier, user_uuid)
+    except Exception as e:
+        for file in files_to_process:
+            failed_files[file.id] = e
+        _handle_files_stack_failures(file_manager_db_session, files_to_process, failed_files, stack_identifier, user_uuid)
+        return failed_files
 
-                logger.info(f"Processing stack {stack_identifier} for file {file.path}")
-                
-                # Create the ingestion pipeline for the datasource
-                vector_store = create_vector_store(datasource.identifier, user_uuid)
-                doc_store = create_doc_store(datasource.identifier, user_uuid)
-
-                # Create the ingestion pipeline for the datasource
-                ingestion_pipeline = IngestionPipeline(
-                    name=f"ingestion_pipeline_{datasource.identifier}",
-                    docstore=doc_store,
-                    vector_store=vector_store,
-                    docstore_strategy=DocstoreStrategy.UPSERTS,
-                    #docstore_strategy=DocstoreStrategy.DUPLICATES_ONLY, # Otherwise it dont work with the hierarchical node parser because it always upserts all previous nodes for this document
-                    # TODO Make a hierarchical node parser that works with the ingestion pipeline
-                )
+    try:
+        await _ingest_files_stack(file_manager_db_session, processing_stacks_db_session, datasource, embedding_settings_response, stores, stack_identifier, files_to_process, files_responses, files_traces, failed_files, user_uuid)
+    except Exception as e:
+        for file in files_to_process:
+            failed_files.setdefault(file.id, e)
+    finally:
+        release_datasource_stores(stores)
+
+    for file in files_to_process:
+        if file.id in failed_files:
+            continue
+        # Get the processed stacks from json
+        processed_stacks = json.loads(file.processed_stacks) if file.processed_stacks else []
+        # Add the stack to the processed stacks
+        processed_stacks.append(stack_identifier)
+        file.processed_stacks = json.dumps(processed_stacks)
+        # Remove the stack from the stacks to process
+        stacks_to_process = json.loads(file.stacks_to_process) if file.stacks_to_process else []
+        if stack_identifier in stacks_to_process:
+            stacks_to_process = [stack for stack in stacks_to_process if stack != stack_identifier]
+            file.stacks_to_process = json.dumps(stacks_to_process)
+    file_manager_db_session.commit()
 
-                # Load/create pipeline cache
-                #try:
-                    #ingestion_pipeline.load(f"/data/.idapt/output/pipeline_storage_{datasource_identifier}")
-                #except Exception as e:
-                #    logger.error(f"No existing pipeline cache found: {str(e)}")
-                    #ingestion_pipeline.persist(f"/data/.idapt/output/pipeline_storage_{datasource_identifier}")
-
-
-                # Use SimpleDirectoryReader from llama index
-                # It try to use existing apropriate readers based on the file type to get the most metadata from it
-                # TODO Make this better
-                # Write the file content to a temp file
-                temp_file_path = f"/data/{user_uuid}/processing/tmp/{file.name}"
-                os.makedirs(os.path.dirname(temp_file_path), exist_ok=True)
-                with open(temp_file_path, "wb") as f:
-                    f.write(file_response.content.encode('utf-8'))
-                reader = SimpleDirectoryReader(
-                    input_files=[temp_file_path],
-                    filename_as_id=True,
-                    raise_on_error=True,
+    _handle_files_stack_failures(file_manager_db_session, files_to_process, failed_files, stack_identifier, user_uuid)
+    return failed_files
+
+async def _ingest_files_stack(
+        file_manager_db_session: Session,
+        processing_stacks_db_session: Session,
+        datasource: Datasource,
+        embedding_settings_response: SettingResponse,
+        stores: DatasourceStores,
+        stack_identifier: str,
+        files_to_process: List[File],
+        files_responses: Dict[int, FileInfoResponse],
+        files_traces: Dict[int, ProcessingTrace],
+        failed_files: Dict[int, Exception],
+        user_uuid: str
+    ):
+    """
+    Parse, embed and upsert the files of a stack with the acquired stores of their datasource, the errors of the files are added to failed_files
+    """
+    # The docstore is only read while parsing, the ingested documents hashes let the parsing skip the unchanged documents
+    doc_store = stores.doc_store
+    vector_store = stores.vector_store
+    ingestion_cache_store = stores.ingestion_cache_store
+
+    # Load and split the documents of the files at the same time in the parsing process pool
+    files_ingestions: Dict[int, FileStackIngestion] = {}
+    embed_model = None
+    parsed_files = await asyncio.gather(*[
+        _parse_file_for_stack(file_manager_db_session, processing_stacks_db_session, datasource, embedding_settings_response, doc_store, vector_store, ingestion_cache_store, stack_identifier, file, files_responses[file.id], files_traces[file.id], user_uuid)
+        for file in files_to_process
+    ], return_exceptions=True)
+    for file, parsed_file in zip(files_to_process, parsed_files):
+        if isinstance(parsed_file, BaseException):
+            failed_files[file.id] = parsed_file
+            continue
+        files_ingestions[file.id] = parsed_file
+        if embed_model is None:
+            embed_model = parsed_file.transformations[-1]
+
+    # Embed the new nodes of all the files together
+    nodes_to_embed = [node for file_ingestion in files_ingestions.values() for node in file_ingestion.new_nodes]
+    if nodes_to_embed:
+        embed_start_time = time.perf_counter()
+        try:
+            await aembed_nodes_in_batches(embed_model, nodes_to_embed, cache_store=ingestion_cache_store)
+            # The files are embedded together, each file is given the share of the time of its nodes
+            embed_seconds = time.perf_counter() - embed_start_time
+            for file_id, file_ingestion in files_ingestions.items():
+                files_traces[file_id].record_stage(
+                    PROCESSING_STAGE_EMBED,
+                    embed_seconds * len(file_ingestion.new_nodes) / len(nodes_to_embed),
+                    stack_identifier,
+                    nodes=len(file_ingestion.new_nodes),
+                    batch_nodes=len(nodes_to_embed)
                 )
-                documents = reader.load_data()
-                os.unlink(temp_file_path)
-
-                # Remove the unwanted metadata from the documents
-                # In case multiple documents are created from the same file ?
-                for document in documents:
-                    document.metadata.pop("creation_date", None)
-                    document.metadata.pop("last_modified_date", None)
-                    
-                    # Remove the metadata created by the file reader that we dont want to embed and llm
-                    document.excluded_embed_metadata_keys = ["file_path","file_name", "file_type", "file_size", "document_id", "doc_id", "ref_doc_id"]
-                    document.excluded_llm_metadata_keys = ["file_path","file_name", "file_type", "file_size", "document_id", "doc_id", "ref_doc_id"]
-
-                    # Set the origin metadata of the document
-                    document.metadata["origin"] = "upload"
-                    document.excluded_embed_metadata_keys.append("origin")
-                    document.excluded_llm_metadata_keys.append("origin")
-
-                    # Override the file creation time to the current time with the times from the database
-                    # Set the creation and modification times
-                    document.metadata["created_at"] = file.file_created_at.isoformat()
-                    document.metadata["modified_at"] = file.file_modified_at.isoformat()
-                    # Remove from embed and llm
-                    document.excluded_embed_metadata_keys.append("created_at")
-                    document.excluded_embed_metadata_keys.append("modified_at")
-                    document.excluded_llm_metadata_keys.append("created_at")
-                    document.excluded_llm_metadata_keys.append("modified_at")
-
-                    # Set the transformations stack name for the datasource_documents
-                    document.metadata["transformations_stack_identifier"] = stack_identifier
-                    document.excluded_embed_metadata_keys.append("transformations_stack_identifier")
-                    document.excluded_llm_metadata_keys.append("transformations_stack_identifier")
-
-                    original_doc_id = document.doc_id
-
-                    # Modify the doc id to append the transformation stack at the end so that they are treated as different documents by the docstore upserts and are managable independently of each other
-                    document.doc_id = f"{original_doc_id}_{stack_identifier}"
-
-                    # Get the embedding settings for this datasource
-                    embedding_settings_response = get_setting(settings_db_session, datasource.embedding_setting_identifier)
-
-                    # Get the transformations stack
-                    transformations = get_transformations_for_stack(processing_stacks_db_session, stack_identifier, datasource, file_response, embedding_settings_response)
-
-                    # Update the file in the database with the ref_doc_ids
-                    # Do this before the ingestion so that if it crashes we can try to delete the file from the vector store and docstore with its ref_doc_ids and reprocess
-                    
-                    # Parse the json ref_doc_ids as a list
-                    file_ref_doc_ids = json.loads(file.ref_doc_ids) if file.ref_doc_ids else []
-                    # Add the new doc id to the list
-                    file_ref_doc_ids.append(document.doc_id)
-                    # Update the file in the database
-                    file.ref_doc_ids = json.dumps(file_ref_doc_ids)
-                    file_manager_db_session.commit()
-
-                    # TODO : Make the HierarchicalNodeParser work with the ingestion pipeline
-                    #if transformations_stack_name == "hierarchical":
-                    #    # Dont work with ingestion pipeline so use it directly to extract the nodes and add them manually to the index
-                    #    hierarchical_nodes = transformations[0].get_nodes_from_documents(
-                    #        documents, 
-                    #        show_progress=True
-                    #    )
-                    #    
-                    #    # Set the transformations for the ingestion pipeline
-                    #    ingestion_pipeline.transformations = [self.cached_embed_model] # Only keep the embedding as the nodes are parsed with the HierarchicalNodeParser
-                    #    
-                    #    # Run the ingestion pipeline on the resulting nodes to add the nodes to the docstore and vector store
-                    #    nodes = await ingestion_pipeline.arun(
-                    #        nodes=hierarchical_nodes,
-                    #        show_progress=True,
-                    #        #num_workers=None # We process in this thread as it is a child thread managed by the generate service and spawning other threads here causes issue with the uvicorn dev reload mechanism
-                    #    )
-                    #    # No need to insert nodes into index as we use a vector store
-
-
-                    #else:
-                    # This will add the documents to the vector store and docstore in the expected llama index way
-                    # Add the embed model to the transformations stack as we always want to embed the results of the processing stacks for search
-                    #transformations.append(embed_model)
-                    # Set the transformations for the ingestion pipeline
-                    ingestion_pipeline.transformations = transformations
-                    ingestion_pipeline.run(
-                        documents=documents,
-                        show_progress=True,
-                        #num_workers=None # We process in this thread as it is a child thread managed by the generate service and spawning other threads here causes issue with the uvicorn dev reload mechanism
-                    )
-                    
-                # Save the cache to storage #TODO : Add cache management to delete when too big with cache.clear()
-                #ingestion_pipeline.persist(f"/data/.idapt/output/pipeline_storage_{datasource_identifier}")
-
-                # Needed for now as SimpleDocumentStore is not persistent
-                docstore_file = Path(get_llama_index_datasource_folder_path(datasource.identifier, user_uuid)) / "docstores" / f"docstore.json"
-                doc_store.persist(persist_path=str(docstore_file))
-
-                # Get the processed stacks from json
-                processed_stacks = json.loads(file.processed_stacks) if file.processed_stacks else []
-                # Add the stack to the processed stacks
-                processed_stacks.append(stack_identifier)
-                file.processed_stacks = json.dumps(processed_stacks)
-                # Remove the stack from the stacks to process
-                stacks_to_process = json.loads(file.stacks_to_process) if file.stacks_to_process else []
-                if stack_identifier in stacks_to_process:
-                    stacks_to_process = [stack for stack in stacks_to_process if stack != stack_identifier]
-                    file.stacks_to_process = json.dumps(stacks_to_process)
-
-                file_manager_db_session.commit()
-
-            except Exception as e:
-                file_manager_db_session.rollback()
-                # try to delete the processing stack from llama index as it failed to try to avoid partially processed states
+        except Exception as e:
+            # Embed the remaining nodes file by file so that only the files with the failing nodes fail
+            logger.error(f"Failed to embed the nodes of {len(files_ingestions)} files together, embedding them file by file: {str(e)}")
+            for file_id, file_ingestion in files_ingestions.items():
                 try:
-                    delete_file_processing_stack_from_llama_index(file_manager_session=file_manager_db_session, user_uuid=user_uuid, fs_path=file.path, processing_stack_identifier=stack_identifier)
+                    with files_traces[file_id].stage(PROCESSING_STAGE_EMBED, stack_identifier, nodes=len(file_ingestion.new_nodes)):
+                        await aembed_nodes_in_batches(embed_model, file_ingestion.new_nodes, cache_store=ingestion_cache_store)
                 except Exception as e:
-                    logger.error(f"Failed to delete erroring file stack {file.path} from stores: {str(e)}")
-                # Add the stack to the stacks_to_process list as it failed to process and if we retry to process the file we want it there
-                stacks_to_process = json.loads(file.stacks_to_process) if file.stacks_to_process else []
-                if stack_identifier not in stacks_to_process:
-                    stacks_to_process.append(stack_identifier)
-                    file.stacks_to_process = json.dumps(stacks_to_process)
-                file.error_message = str(e)
-                file_manager_db_session.commit()
-                logger.error(f"Failed to process stack {stack_identifier} for file {file.path}, marking file status as error and letting the stack in stacks_to_process: {str(e)}")
-                raise
-        
-        # All stacks are processed, update status to completed
-        file.status = FileStatus.COMPLETED
-        file.processing_started_at = datetime.now()
-        file_manager_db_session.commit()
-
-        logger.info(f"Processed file '{file.path}' for user '{user_uuid}'")
+                    failed_files[file_id] = e
 
+    # Upsert the nodes of each file, holding the stores lock so that the documents of a file are not deleted by another thread while upserted
+    try:
+        with stores.lock:
+            for file in files_to_process:
+                if file.id in failed_files:
+                    continue
+                try:
+                    with files_traces[file.id].stage(PROCESSING_STAGE_UPSERT, stack_identifier, nodes=len(files_ingestions[file.id].new_nodes)):
+                        _upsert_file_stack_ingestion(file_manager_db_session, stores.doc_store, stores.vector_store, file, files_ingestions[file.id])
+                except Exception as e:
+                    failed_files[file.id] = e
+    except Exception as e:
+        for file in files_to_process:
+            failed_files.setdefault(file.id, e)
+
+class FileStackIngestion:
+    """
+    Changes to apply to the stores for a stack of a file, the nodes of a changed document are diffed by their content ids against its nodes in the vector store
+    """
+    def __init__(self, documents: List[Document], changed_documents: List[Document], new_nodes: List[BaseNode], obsolete_node_ids: List[str], removed_ref_doc_ids: List[str], transformations: List[TransformComponent]):
+        self.documents = documents
+        # Documents whose hash changed since their last ingestion, only their nodes were split
+        self.changed_documents = changed_documents
+        # Nodes of the changed documents not in the vector store yet, the only ones to embed
+        self.new_nodes = new_nodes
+        # Nodes of the previous versions of the changed documents that are not in the new versions
+        self.obsolete_node_ids = obsolete_node_ids
+        # Documents of the stack from a previous version of the file that are not in the new version
+        self.removed_ref_doc_ids = removed_ref_doc_ids
+        self.transformations = transformations
+
+async def _parse_file_for_stack(
+        file_manager_db_session: Session,
+        processing_stacks_db_session: Session,
+        datasource: Datasource,
+        embedding_settings_response: SettingResponse,
+        doc_store: BaseDocumentStore,
+        vector_store: ChromaVectorStore,
+        ingestion_cache_store: SqliteLRUCacheKVStore,
+        stack_identifier: str,
+        file: File,
+        file_response: FileInfoResponse,
+        trace: ProcessingTrace,
+        user_uuid: str
+    ) -> FileStackIngestion:
+    """
+    Load and split a file in the parsing process pool, diff its nodes against the ingested ones then run the stack transformations before the embedding on the new nodes
+    """
+    logger.info(f"Processing stack {stack_identifier} for file {file.path}")
+
+    # Get the transformations stack, compiled once per stack version and shared by the files of the batch
+    transformations = get_transformations_for_stack(processing_stacks_db_session, stack_identifier, datasource, embedding_settings_response)
+
+    # The hashes of the documents ingested for the file let the parsing process skip splitting the unchanged documents
+    file_ref_doc_ids = json.loads(file.ref_doc_ids) if file.ref_doc_ids else []
+    known_documents_hashes = {doc_id: doc_hash for doc_id in file_ref_doc_ids if (doc_hash := doc_store.get_document_hash(doc_id)) is not None}
+
+    # The first step of a stack is always the node parser, it is run with the loading in the parsing process pool
+    # The nodes ids are derived from their content so that the unchanged chunks of a changed document keep their ids
+    content = file_response.content.encode('utf-8')
+    parse_start_time = time.perf_counter()
+    try:
+        documents, nodes, parse_stats = await aparse_file(
+            user_uuid=user_uuid,
+            file_name=file.name,
+            content=content,
+            file_created_at=file.file_created_at.isoformat(),
+            file_modified_at=file.file_modified_at.isoformat(),
+            stack_identifier=stack_identifier,
+            node_parser=transformations[0] if len(transformations) > 1 else None,
+            known_documents_hashes=known_documents_hashes
+        )
     except Exception as e:
-        logger.error(f"Failed to process file {file.path}: {str(e)}")
+        # The parsing pool does not report which of its stages failed, the error is recorded on the loading
+        trace.record_stage(PROCESSING_STAGE_LOAD, time.perf_counter() - parse_start_time, stack_identifier, error=e, bytes=len(content))
+        raise
+    # The time out of the load and split stages is spent waiting for a worker of the parsing pool and sending the file to it
+    parse_seconds = time.perf_counter() - parse_start_time
+    trace.record_stage(PROCESSING_STAGE_PARSE_QUEUE, max(parse_seconds - parse_stats["load_seconds"] - parse_stats["split_seconds"], 0.0), stack_identifier)
+    trace.record_stage(PROCESSING_STAGE_LOAD, parse_stats["load_seconds"], stack_identifier, bytes=len(content), documents=parse_stats["documents"])
+    trace.record_stage(PROCESSING_STAGE_SPLIT, parse_stats["split_seconds"], stack_identifier, nodes=parse_stats["nodes"], tokens=parse_stats["tokens"])
+
+    # Update the file in the database with the ref_doc_ids
+    # Do this before the ingestion so that if it crashes we can try to delete the file from the vector store and docstore with its ref_doc_ids and reprocess
+    documents_ids = [document.doc_id for document in documents]
+    removed_ref_doc_ids = [ref_doc_id for ref_doc_id in file_ref_doc_ids if ref_doc_id.endswith(f"_{stack_identifier}") and ref_doc_id not in documents_ids]
+    file.ref_doc_ids = json.dumps(list(dict.fromkeys(file_ref_doc_ids + documents_ids)))
+    file_manager_db_session.commit()
+
+    # Diff the nodes of the changed documents against the nodes of their previous versions
+    changed_documents = [document for document in documents if known_documents_hashes.get(document.doc_id) != document.hash]
+    new_nodes: List[BaseNode] = []
+    obsolete_node_ids: List[str] = []
+    with trace.stage(PROCESSING_STAGE_DIFF, stack_identifier, documents=len(changed_documents)) as diff_counts:
+        for document in changed_documents:
+            previous_node_ids = get_vector_store_ref_doc_node_ids(vector_store, document.doc_id)
+            document_nodes = [node for node in nodes if node.ref_doc_id == document.doc_id]
+            document_node_ids = {node.node_id for node in document_nodes}
+            new_nodes.extend(node for node in document_nodes if node.node_id not in previous_node_ids)
+            obsolete_node_ids.extend(node_id for node_id in previous_node_ids if node_id not in document_node_ids)
+        diff_counts["nodes"] = len(new_nodes)
+        diff_counts["obsolete_nodes"] = len(obsolete_node_ids)
+    if changed_documents:
+        logger.info(f"File {file.path} has {len(new_nodes)} new and {len(obsolete_node_ids)} obsolete nodes in {len(changed_documents)} changed documents for stack {stack_identifier}")
+
+    # The other steps before the embedding are extractors calling the llm, they stay in this thread
+    # Their outputs are cached by the hash of their input nodes and of their config so that a retry does not call the llm again
+    # The last step of a stack is always the embedding, it is run for all the files together
+    if new_nodes and len(transformations) > 2:
+        with trace.stage(PROCESSING_STAGE_EXTRACT, stack_identifier) as extract_counts:
+            new_nodes = await IngestionPipeline(
+                transformations=transformations[1:-1],
+                cache=IngestionCache(cache=ingestion_cache_store, collection=PROCESSING_TRANSFORMATIONS_CACHE_COLLECTION)
+            ).arun(nodes=new_nodes)
+            extract_counts["nodes"] = len(new_nodes)
+    return FileStackIngestion(documents, changed_documents, new_nodes, obsolete_node_ids, removed_ref_doc_ids, transformations)
+
+def _upsert_file_stack_ingestion(file_manager_db_session: Session, doc_store: BaseDocumentStore, vector_store: ChromaVectorStore, file: File, file_ingestion: FileStackIngestion):
+    """
+    Apply the changes of a stack of a file to the stores, the unchanged nodes of the changed documents keep their embeddings in the vector store
+    The caller must hold the lock of the stores
+    """
+    for ref_doc_id in file_ingestion.removed_ref_doc_ids:
+        vector_store.delete(ref_doc_id)
+        doc_store.delete_document(ref_doc_id, raise_error=False)
+    if file_ingestion.obsolete_node_ids:
+        vector_store.delete_nodes(node_ids=file_ingestion.obsolete_node_ids)
+    if file_ingestion.new_nodes:
+        vector_store.add(file_ingestion.new_nodes)
+    if file_ingestion.changed_documents:
+        # Store the documents with their hashes so that they are skipped until they change again
+        doc_store.add_documents(file_ingestion.changed_documents)
+        doc_store.set_document_hashes({document.doc_id: document.hash for document in file_ingestion.changed_documents})
+
+    if file_ingestion.removed_ref_doc_ids:
+        file_ref_doc_ids = json.loads(file.ref_doc_ids) if file.ref_doc_ids else []
+        file.ref_doc_ids = json.dumps([ref_doc_id for ref_doc_id in file_ref_doc_ids if ref_doc_id not in file_ingestion.removed_ref_doc_ids])
+        file_manager_db_session.commit()
+
+def _handle_files_stack_failures(file_manager_db_session: Session, files: List[File], failed_files: Dict[int, Exception], stack_identifier: str, user_uuid: str):
+    """Clean the failed stack of the failed files so that they can be processed again"""
+    for file in files:
+        if file.id not in failed_files:
+            continue
+        error = failed_files[file.id]
+        file_manager_db_session.rollback()
+        # try to delete the processing stack from llama index as it failed to try to avoid partially processed states
         try:
-            file.status = FileStatus.ERROR
-            file.error_message = str(e)
-            file_manager_db_session.commit()
+            delete_file_processing_stack_from_llama_index(file_manager_session=file_manager_db_session, user_uuid=user_uuid, fs_path=file.path, processing_stack_identifier=stack_identifier)
         except Exception as e:
-            file_manager_db_session.rollback()
-            logger.error(f"Failed to update file status for {file.path}: {str(e)}")
-        raise
+            logger.error(f"Failed to delete erroring file stack {file.path} from stores: {str(e)}")
+        # Add the stack to the stacks_to_process list as it failed to process and if we retry to process the file we want it there
+        stacks_to_process = json.loads(file.stacks_to_process) if file.stacks_to_process else []
+        if stack_identifier not in stacks_to_process:
+            stacks_to_process.append(stack_identifier)
+            file.stacks_to_process = json.dumps(stacks_to_process)
+        file.error_message = str(error)
+        file_manager_db_session.commit()
+        logger.error(f"Failed to process stack {stack_identifier} for file {file.path}, marking file status as error and letting the stack in stacks_to_process: {str(error)}")
 
 def get_queue_status(user_uuid: str) -> ProcessingStatusResponse:
     """Get the current status of the generation queue"""
@@ -616,39 +709,21 @@ def get_queue_status(user_uuid: str) -> ProcessingStatusResponse:
         logger.error(f"Failed to get queue status: {str(e)}")
         raise
 
-def should_start_processing(user_uuid: str) -> bool:
-    """Check if the processing should start"""
-    
+def get_ingestion_cache_stats(datasources_db_session: Session, user_uuid: str) -> List[ProcessingCacheStatsResponse]:
+    """Get the stats of the ingestion cache of each datasource of a user"""
     try:
-        for file_manager_db_session in users_file_manager_db_sessions.get(user_uuid, {}).values():
-            # Try to get the oldest file that has been processing for the longest time
-            oldest_processing_file = file_manager_db_session.query(File).filter(
-                File.status == FileStatus.PROCESSING
-            ).order_by(
-                File.processing_started_at.asc()
-            ).first()
-
-            # If the file has been processing for more than 10 minutes, start start the processing because it is probably stuck/ the app has restarted and processing background task has not been restarted
-            if oldest_processing_file and oldest_processing_file.processing_started_at < datetime.now() - timedelta(seconds=60 * 15):
-                # A processing is probably still running
-                # TODO Make this better
-                # See if there are any files that are queued
-                queued_files = file_manager_db_session.query(File).filter(
-                    File.status == FileStatus.QUEUED
-                ).first()
-                if queued_files:
-                    return True
-            else:
-                # No file currently processing, see if there are any files that are queued
-                queued_files = file_manager_db_session.query(File).filter(
-                    File.status == FileStatus.QUEUED
-                ).first()
-                if queued_files:
-                    return True
-        
-        return False
-    
+        caches_stats = []
+        for datasource in datasources_db_session.query(Datasource).all():
+            ingestion_cache_db_path = get_ingestion_cache_db_path(datasource.identifier, user_uuid)
+            if not ingestion_cache_db_path.exists():
+                continue
+            # Open the database only for the stats instead of opening all the datasource stores
+            ingestion_cache_store = SqliteLRUCacheKVStore(str(ingestion_cache_db_path))
+            try:
+                caches_stats.append(ProcessingCacheStatsResponse(datasource_identifier=datasource.identifier, **ingestion_cache_store.get_stats()))
+            finally:
+                ingestion_cache_store.close()
+        return caches_stats
     except Exception as e:
-        logger.error(f"Failed to check if processing should start: {str(e)}")
-        return False
-
+        logger.error(f"Failed to get the ingestion cache stats for user {user_uuid}: {str(e)}")
+        raise
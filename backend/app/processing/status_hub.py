@@ -0,0 +1,329 @@
+from app.datasources.file_manager.database.models import FileStatus
+
+from typing import Any, Dict, Iterable, List, Set, Tuple
+import os
+import json
+import fcntl
+import asyncio
+import threading
+
+import logging
+logger = logging.getLogger("uvicorn")
+
+# Snapshot of the processing status of a user shared by the workers, the changes published by a worker are seen by the others through it
+PROCESSING_STATUS_SNAPSHOT_PATH = "/data/{user_uuid}/processing/status.json"
+PROCESSING_STATUS_SNAPSHOT_LOCK_PATH = "/data/{user_uuid}/processing/status.json.lock"
+# The deltas published by a worker are written to the snapshot at most at this interval, the local subscribers are notified right away
+PROCESSING_STATUS_SNAPSHOT_FLUSH_INTERVAL_SECONDS = float(os.environ.get("PROCESSING_STATUS_SNAPSHOT_FLUSH_INTERVAL_SECONDS", 0.5))
+# Interval at which the subscribers check the snapshot for the changes published by the other workers, it is a stat and not a database query
+PROCESSING_STATUS_SNAPSHOT_WATCH_INTERVAL_SECONDS = float(os.environ.get("PROCESSING_STATUS_SNAPSHOT_WATCH_INTERVAL_SECONDS", 0.25))
+
+# Statuses of the files listed in the processing status
+PROCESSING_STATUS_LISTED_FILE_STATUSES = (FileStatus.QUEUED.value, FileStatus.PROCESSING.value)
+
+class UserProcessingStatus:
+    """
+    Processing status of a user in this process, the items are keyed by the original path of their file
+    """
+    def __init__(self, user_uuid: str):
+        self.user_uuid = user_uuid
+        self.items: Dict[str, dict] = {}
+        self.loaded = False
+        # Deltas published by this process and not written to the snapshot yet, None removes the item
+        self.pending_deltas: Dict[str, dict | None] = {}
+        # Version, inode and modification time of the snapshot the items were read from or written to, a rewritten snapshot has a new inode
+        self.snapshot_version = 0
+        self.snapshot_stat: Tuple[int, int] | None = None
+        # Incremented on every change seen by this process so that the subscribers know when to send the status
+        self.revision = 0
+        self.flush_timer: threading.Timer | None = None
+        # Serializes the snapshot writes of this process for the user so that they are written in the order their deltas were taken
+        self.snapshot_write_lock = threading.Lock()
+        self.subscribers: Set[Tuple[asyncio.AbstractEventLoop, asyncio.Event]] = set()
+
+users_processing_status: Dict[str, UserProcessingStatus] = {}
+# Guards the in memory processing status of all the users, the publishers are the processing threads and the request handlers
+# The snapshot files are read and written without it so that the cross process file lock and the file I/O never block the other users
+users_processing_status_lock = threading.RLock()
+
+def _get_user_processing_status(user_uuid: str) -> UserProcessingStatus:
+    """Get the processing status of a user, the caller must hold the lock"""
+    user_processing_status = users_processing_status.get(user_uuid)
+    if user_processing_status is None:
+        user_processing_status = UserProcessingStatus(user_uuid)
+        users_processing_status[user_uuid] = user_processing_status
+    return user_processing_status
+
+def get_file_processing_status_item(file: Any) -> dict | None:
+    """Get the status item of a file or a file response, None if the file is not queued or processing"""
+    status = file.status.value if isinstance(file.status, FileStatus) else file.status
+    if status not in PROCESSING_STATUS_LISTED_FILE_STATUSES:
+        return None
+    stacks_to_process = json.loads(file.stacks_to_process) if file.stacks_to_process else []
+    return {
+        "original_path": file.original_path,
+        "name": file.name,
+        "queued_stacks": list(dict.fromkeys(stacks_to_process)),
+        "status": status
+    }
+
+
+def _read_snapshot(user_uuid: str) -> Tuple[int, Dict[str, dict], Tuple[int, int] | None]:
+    """Read the snapshot of a user, returns its version, its items and its inode and modification time"""
+    snapshot_path = PROCESSING_STATUS_SNAPSHOT_PATH.format(user_uuid=user_uuid)
+    try:
+        with open(snapshot_path, "r") as f:
+            snapshot_stat = os.fstat(f.fileno())
+            snapshot = json.load(f)
+    except FileNotFoundError:
+        return 0, {}, None
+    return snapshot["version"], {item["original_path"]: item for item in snapshot["items"]}, (snapshot_stat.st_ino, snapshot_stat.st_mtime_ns)
+
+def _write_snapshot(user_uuid: str, version: int, items: Dict[str, dict]) -> Tuple[int, int]:
+    """Write the snapshot of a user to a temporary file renamed over it so that the readers never read a partial one, returns its inode and modification time"""
+    snapshot_path = PROCESSING_STATUS_SNAPSHOT_PATH.format(user_uuid=user_uuid)
+    tmp_snapshot_path = f"{snapshot_path}.{os.getpid()}.tmp"
+    with open(tmp_snapshot_path, "w") as f:
+        json.dump({"version": version, "items": list(items.values())}, f)
+    os.replace(tmp_snapshot_path, snapshot_path)
+    snapshot_stat = os.stat(snapshot_path)
+    return (snapshot_stat.st_ino, snapshot_stat.st_mtime_ns)
+
+def _update_snapshot(user_processing_status: UserProcessingStatus, full_items: Dict[str, dict] | None = None) -> None:
+    """
+    Write the pending deltas or the full items of this process to the snapshot under the snapshot file lock
+    The deltas are applied over the snapshot as it was written by the other workers, the caller must not hold the lock
+    """
+    user_uuid = user_processing_status.user_uuid
+    lock_path = PROCESSING_STATUS_SNAPSHOT_LOCK_PATH.format(user_uuid=user_uuid)
+    with user_processing_status.snapshot_write_lock:
+        with users_processing_status_lock:
+            deltas = user_processing_status.pending_deltas
+            user_processing_status.pending_deltas = {}
+            known_snapshot_version = user_processing_status.snapshot_version
+        try:
+            os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+            with open(lock_path, "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    snapshot_version, items, _ = _read_snapshot(user_uuid)
+                    if full_items is not None:
+                        items = dict(full_items)
+                    _apply_deltas(items, deltas)
+                    version = max(snapshot_version, known_snapshot_version) + 1
+                    snapshot_stat = _write_snapshot(user_uuid, version, items)
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+        except Exception:
+            with users_processing_status_lock:
+                # Keep the deltas pending under the ones published since they were taken
+                user_processing_status.pending_deltas = {**deltas, **user_processing_status.pending_deltas}
+            raise
+
+        with users_processing_status_lock:
+            # The deltas published while the snapshot was written are still pending
+            _apply_deltas(items, user_processing_status.pending_deltas)
+            if items != user_processing_status.items:
+                # The snapshot had changes of the other workers
+                user_processing_status.items = items
+                user_processing_status.revision += 1
+                _notify_subscribers(user_processing_status)
+            user_processing_status.snapshot_version = version
+            user_processing_status.snapshot_stat = snapshot_stat
+            user_processing_status.loaded = True
+
+def _apply_deltas(items: Dict[str, dict], deltas: Dict[str, dict | None]) -> None:
+    for original_path, item in deltas.items():
+        if item is None:
+            items.pop(original_path, None)
+        else:
+            items[original_path] = item
+
+def _reload_snapshot_if_changed(user_processing_status: UserProcessingStatus) -> bool:
+    """Read the snapshot again if another worker wrote it, the caller must not hold the lock, returns whether the items changed"""
+    with users_processing_status_lock:
+        known_snapshot_stat = user_processing_status.snapshot_stat if user_processing_status.loaded else None
+    snapshot_path = PROCESSING_STATUS_SNAPSHOT_PATH.format(user_uuid=user_processing_status.user_uuid)
+    try:
+        snapshot_stat = os.stat(snapshot_path)
+    except OSError:
+        # Not written yet or the user data directory is unmounted, keep the last known status
+        return False
+    if known_snapshot_stat is not None and (snapshot_stat.st_ino, snapshot_stat.st_mtime_ns) == known_snapshot_stat:
+        return False
+    snapshot_version, items, snapshot_stat = _read_snapshot(user_processing_status.user_uuid)
+    with users_processing_status_lock:
+        if user_processing_status.loaded and user_processing_status.snapshot_version > snapshot_version:
+            # A newer snapshot was written or read in the meantime
+            return False
+        # Keep the deltas of this process that are not written yet
+        _apply_deltas(items, user_processing_status.pending_deltas)
+        user_processing_status.snapshot_version = snapshot_version
+        user_processing_status.snapshot_stat = snapshot_stat
+        user_processing_status.loaded = True
+        if items == user_processing_status.items:
+            return False
+        user_processing_status.items = items
+        user_processing_status.revision += 1
+        return True
+
+def _flush_pending_deltas(user_uuid: str) -> None:
+    """Write the pending deltas of a user to the snapshot, run by the flush timer"""
+    with users_processing_status_lock:
+        user_processing_status = _get_user_processing_status(user_uuid)
+        user_processing_status.flush_timer = None
+        if not user_processing_status.pending_deltas:
+            return
+    try:
+        _update_snapshot(user_processing_status)
+    except Exception as e:
+        # The deltas stay pending and are written with the next ones
+        logger.error(f"Failed to write the processing status snapshot of user {user_uuid}: {str(e)}")
+
+def _notify_subscribers(user_processing_status: UserProcessingStatus) -> None:
+    """Wake up the subscribers of a user, they can wait in the event loop of another thread, the caller must hold the lock"""
+    for loop, event in list(user_processing_status.subscribers):
+        try:
+            loop.call_soon_threadsafe(event.set)
+        except RuntimeError:
+            # The event loop of the subscriber is closed
+            user_processing_status.subscribers.discard((loop, event))
+
+
+def publish_processing_status(user_uuid: str, processing_status: dict) -> None:
+    """
+    Publish the full processing status of a user computed from the databases, it replaces the snapshot
+    """
+    try:
+        items = {item["original_path"]: item for item in processing_status["queued_items"] + processing_status["processing_items"]}
+        with users_processing_status_lock:
+            user_processing_status = _get_user_processing_status(user_uuid)
+            if user_processing_status.items != items:
+                user_processing_status.items = dict(items)
+                user_processing_status.revision += 1
+                _notify_subscribers(user_processing_status)
+            # The full status already contains the pending deltas committed to the databases
+            user_processing_status.pending_deltas = {}
+        _update_snapshot(user_processing_status, full_items=items)
+    except Exception as e:
+        logger.error(f"Failed to publish the processing status of user {user_uuid}: {str(e)}")
+
+def publish_files_processing_status(user_uuid: str, files: Iterable[Any]) -> None:
+    """
+    Publish the status of files after a change of their status or of their stacks to process
+    The local subscribers are notified right away and the snapshot is written by a timer so that a burst of changes is written once
+    """
+    try:
+        deltas = {file.original_path: get_file_processing_status_item(file) for file in files}
+        if not deltas:
+            return
+        with users_processing_status_lock:
+            user_processing_status = _get_user_processing_status(user_uuid)
+            is_loaded = user_processing_status.loaded
+        if not is_loaded:
+            _reload_snapshot_if_changed(user_processing_status)
+        with users_processing_status_lock:
+            items = dict(user_processing_status.items)
+            _apply_deltas(items, deltas)
+            user_processing_status.pending_deltas.update(deltas)
+            if items != user_processing_status.items:
+                user_processing_status.items = items
+                user_processing_status.revision += 1
+                _notify_subscribers(user_processing_status)
+            if user_processing_status.flush_timer is None:
+                user_processing_status.flush_timer = threading.Timer(PROCESSING_STATUS_SNAPSHOT_FLUSH_INTERVAL_SECONDS, _flush_pending_deltas, args=(user_uuid,))
+                user_processing_status.flush_timer.daemon = True
+                user_processing_status.flush_timer.start()
+    except Exception as e:
+        logger.error(f"Failed to publish the processing status of files of user {user_uuid}: {str(e)}")
+
+class RemovedFile:
+    """File removed from the processing status"""
+    def __init__(self, original_path: str):
+        self.original_path = original_path
+        self.name = os.path.basename(original_path)
+        self.status = None
+        self.stacks_to_process = None
+
+def publish_removed_items_processing_status(user_uuid: str, original_path: str) -> None:
+    """Publish the removal of a deleted file or of the files of a deleted folder from the processing status"""
+    try:
+        with users_processing_status_lock:
+            user_processing_status = _get_user_processing_status(user_uuid)
+            is_loaded = user_processing_status.loaded
+        if not is_loaded:
+            _reload_snapshot_if_changed(user_processing_status)
+        with users_processing_status_lock:
+            removed_original_paths = [
+                item_original_path for item_original_path in user_processing_status.items
+                if item_original_path == original_path or item_original_path.startswith(f"{original_path}/")
+            ]
+        if removed_original_paths:
+            publish_files_processing_status(user_uuid, [RemovedFile(removed_original_path) for removed_original_path in removed_original_paths])
+    except Exception as e:
+        logger.error(f"Failed to publish the removal of {original_path} from the processing status of user {user_uuid}: {str(e)}")
+
+def has_processing_status(user_uuid: str) -> bool:
+    """Whether the processing status of a user was published by a worker since its user data directory was created"""
+    with users_processing_status_lock:
+        user_processing_status = _get_user_processing_status(user_uuid)
+    _reload_snapshot_if_changed(user_processing_status)
+    with users_processing_status_lock:
+        return user_processing_status.loaded
+
+def get_processing_status(user_uuid: str) -> Tuple[int, dict]:
+    """Get the revision and the processing status of a user without querying the databases"""
+    with users_processing_status_lock:
+        user_processing_status = _get_user_processing_status(user_uuid)
+    _reload_snapshot_if_changed(user_processing_status)
+    with users_processing_status_lock:
+        items: List[dict] = list(user_processing_status.items.values())
+        revision = user_processing_status.revision
+    queued_items = [item for item in items if item["status"] == FileStatus.QUEUED.value]
+    processing_items = [item for item in items if item["status"] == FileStatus.PROCESSING.value]
+    return revision, {
+        "queued_count": len(queued_items),
+        "queued_items": queued_items,
+        "processing_count": len(processing_items),
+        "processing_items": processing_items,
+        "newly_queued_count": 0
+    }
+
+
+class ProcessingStatusSubscription:
+    """
+    Subscription of a status websocket to the processing status of a user
+    It waits for the changes published in this process and checks the snapshot for the changes published by the other workers
+    """
+    def __init__(self, user_uuid: str):
+        self.user_uuid = user_uuid
+        # Revision of the last status returned
+        self.revision: int | None = None
+
+    async def get_status(self) -> dict:
+        # The snapshot can be reloaded from the user data directory, read it in a thread like the changes
+        self.revision, processing_status = await asyncio.to_thread(get_processing_status, self.user_uuid)
+        return processing_status
+
+    async def wait_for_change(self) -> None:
+        """Wait until the processing status changes after the last returned one"""
+        event = asyncio.Event()
+        subscriber = (asyncio.get_running_loop(), event)
+        with users_processing_status_lock:
+            user_processing_status = _get_user_processing_status(self.user_uuid)
+            user_processing_status.subscribers.add(subscriber)
+        try:
+            while True:
+                # The snapshot is checked in a thread so that a slow user data directory does not block the event loop
+                await asyncio.to_thread(_reload_snapshot_if_changed, user_processing_status)
+                with users_processing_status_lock:
+                    if user_processing_status.revision != self.revision:
+                        return
+                    event.clear()
+                try:
+                    await asyncio.wait_for(event.wait(), timeout=PROCESSING_STATUS_SNAPSHOT_WATCH_INTERVAL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            with users_processing_status_lock:
+                user_processing_status.subscribers.discard(subscriber)
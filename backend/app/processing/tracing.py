@@ -0,0 +1,108 @@
+from app.api.metrics import get_counter, get_histogram
+
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Generator, List
+import time
+
+import logging
+logger = logging.getLogger("uvicorn")
+
+# Stages of the processing of a file, in the order they run
+PROCESSING_STAGE_DECRYPT = "decrypt"
+PROCESSING_STAGE_PARSE_QUEUE = "parse_queue"
+PROCESSING_STAGE_LOAD = "load"
+PROCESSING_STAGE_SPLIT = "split"
+PROCESSING_STAGE_DIFF = "diff"
+PROCESSING_STAGE_EXTRACT = "extract"
+PROCESSING_STAGE_EMBED = "embed"
+PROCESSING_STAGE_UPSERT = "upsert"
+
+PROCESSING_STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+processing_stage_seconds_histogram = get_histogram(
+    "idapt_processing_stage_seconds",
+    "Duration of the processing stages of the files",
+    ("stage", "stack"),
+    PROCESSING_STAGE_BUCKETS
+)
+processing_stage_errors_counter = get_counter(
+    "idapt_processing_stage_errors_total",
+    "Number of files failing in a processing stage",
+    ("stage", "stack")
+)
+processing_stage_bytes_counter = get_counter(
+    "idapt_processing_stage_bytes_total",
+    "Bytes of the file contents going through a processing stage",
+    ("stage", "stack")
+)
+processing_stage_nodes_counter = get_counter(
+    "idapt_processing_stage_nodes_total",
+    "Number of nodes output by a processing stage",
+    ("stage", "stack")
+)
+processing_stage_tokens_counter = get_counter(
+    "idapt_processing_stage_tokens_total",
+    "Number of tokens of the nodes output by a processing stage",
+    ("stage", "stack")
+)
+processing_file_seconds_histogram = get_histogram(
+    "idapt_processing_file_seconds",
+    "Duration of the processing of the files from their start to their completion or error",
+    ("status",),
+    PROCESSING_STAGE_BUCKETS
+)
+
+class ProcessingTrace:
+    """
+    Stages of the processing of a file, recorded in the processing metrics and saved on the file for the slow files forensics
+    The metrics are not labelled by datasource as the datasources of all the users would make their number of series unbounded
+    """
+    def __init__(self):
+        self.started_at = datetime.now()
+        self._start_time = time.perf_counter()
+        self.stages: List[dict] = []
+
+    def record_stage(self, stage: str, seconds: float, stack_identifier: str = "", error: Exception | None = None, **counts: int) -> None:
+        """Record a stage that already ran, the counts can be bytes, nodes and tokens"""
+        labels = {"stage": stage, "stack": stack_identifier}
+        processing_stage_seconds_histogram.observe(seconds, **labels)
+        if error is not None:
+            processing_stage_errors_counter.inc(**labels)
+        if counts.get("bytes"):
+            processing_stage_bytes_counter.inc(counts["bytes"], **labels)
+        if counts.get("nodes"):
+            processing_stage_nodes_counter.inc(counts["nodes"], **labels)
+        if counts.get("tokens"):
+            processing_stage_tokens_counter.inc(counts["tokens"], **labels)
+
+        stage_trace = {"stage": stage, "stack": stack_identifier, "seconds": round(seconds, 6), **counts}
+        if error is not None:
+            stage_trace["error"] = str(error)
+        self.stages.append(stage_trace)
+
+    @contextmanager
+    def stage(self, stage: str, stack_identifier: str = "", **counts: int) -> Generator[Dict[str, int], None, None]:
+        """
+        Time a stage, the counts known after the stage can be set in the yielded dict
+        A failing stage is recorded with its error and the error is raised again
+        """
+        stage_counts: Dict[str, int] = dict(counts)
+        start_time = time.perf_counter()
+        try:
+            yield stage_counts
+        except Exception as e:
+            self.record_stage(stage, time.perf_counter() - start_time, stack_identifier, error=e, **stage_counts)
+            raise
+        self.record_stage(stage, time.perf_counter() - start_time, stack_identifier, **stage_counts)
+
+    def finish(self, status: str) -> dict:
+        """Record the total duration of the processing of the file and get the trace to save on it"""
+        total_seconds = time.perf_counter() - self._start_time
+        processing_file_seconds_histogram.observe(total_seconds, status=status)
+        return {
+            "started_at": self.started_at.isoformat(),
+            "status": status,
+            "total_seconds": round(total_seconds, 6),
+            "stages": self.stages
+        }
@@ -0,0 +1,31 @@
+"""
+Standalone processing worker, it processes the pending jobs of the per-user processing databases without serving the api.
+
+Start the api with PROCESSING_MODE=api so that it only enqueues the jobs, then start as many workers as needed on the hosts sharing the data folder:
+    PROCESSING_MODE=worker python -m app.processing.worker
+The job leases make sure that each job is processed by a single worker.
+"""
+# flake8: noqa: E402
+import os
+import logging
+from app.api.logging import configure_app_logging
+configure_app_logging()
+
+logger = logging.getLogger("uvicorn")
+
+from app.api.mount_user_data_dir import setup_user_data_dir_lifecycle_manager
+from app.processing.scheduler import processing_scheduler_loop
+
+
+def run_processing_worker():
+    """Run the processing scheduler of this worker in the main thread"""
+    logger.info(f"Starting processing worker {os.getpid()} with environment: {os.getenv('ENVIRONMENT')}")
+
+    # The worker mounts the user data directories of the jobs it processes, unmount them once idle
+    setup_user_data_dir_lifecycle_manager()
+
+    processing_scheduler_loop(logger, elect_owner=False)
+
+
+if __name__ == "__main__":
+    run_processing_worker()
@@ -23,6 +23,8 @@ class ProcessingStack(Base):
     description = Column(String, nullable=True)
     is_enabled = Column(Boolean, default=True)
     supported_extensions = Column(JSON, nullable=True)
+    # Bumped on every change of the stack or of its steps so that the compiled transformations of the previous version are not reused
+    version = Column(Integer, nullable=False, default=1, server_default="1")
     created_at = Column(DateTime, server_default=func.now())
     updated_at = Column(DateTime, onupdate=func.now())
 
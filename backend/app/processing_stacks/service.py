@@ -3,15 +3,18 @@ import re
 import json
 from fastapi import HTTPException
 from sqlalchemy.orm import Session
-from typing import List
+from typing import Dict, List, Set, Tuple
+from collections import OrderedDict
 import os
+import hashlib
+import asyncio
+import threading
 
 from app.settings.model_initialization import init_embedding_model
 from app.settings.schemas import SettingResponse
 from app.constants.file_extensions import TEXT_FILE_EXTENSIONS, CODE_FILE_EXTENSIONS
 from app.processing_stacks.database.models import ProcessingStack, ProcessingStep, ProcessingStackStep
 from app.datasources.database.models import Datasource
-from app.datasources.file_manager.schemas import FileInfoResponse
 from app.processing_stacks.schemas import (
     ProcessingStackCreate, 
     ProcessingStackResponse, 
@@ -36,6 +39,18 @@ from llama_index.core.node_parser.text.token import TokenTextSplitter
 #from app.processing_stacks.utils import get_language_from_extension
 logger = logging.getLogger("uvicorn")
 
+# Number of compiled transformations stacks kept per process, the least recently used are dropped above it
+PROCESSING_STACKS_COMPILED_CACHE_MAX_ENTRIES = int(os.environ.get("PROCESSING_STACKS_COMPILED_CACHE_MAX_ENTRIES", 64))
+
+# Transformations compiled from the stacks, keyed by the stacks database, the stack version, the datasource and the embedding setting
+# The splitters, tokenizers and embedding clients are built once and shared by all the files processed with the same stack version
+compiled_transformations_cache: OrderedDict[Tuple[str, str, str, int, str, str], list] = OrderedDict()
+compiled_transformations_cache_lock = threading.Lock()
+
+# Routing indexes of the stacks databases, rebuilt when the stacks of a database change
+processing_stacks_routing_indexes: Dict[str, "ProcessingStacksRoutingIndex"] = {}
+processing_stacks_routing_indexes_lock = threading.Lock()
+
 def create_default_processing_stacks_if_needed(processing_stacks_db_session: Session):
     """Create default processing stacks in the database"""
     try:
@@ -269,6 +284,7 @@ def update_processing_stack(processing_stacks_db_session: Session, stack_identif
             
         # Update supported extensions
         db_stack.supported_extensions = json.dumps(stack_update.supported_extensions)
+        db_stack.version = db_stack.version + 1
         
         # Delete existing steps
         processing_stacks_db_session.query(ProcessingStackStep).filter_by(stack_identifier=stack_identifier).delete()
@@ -364,6 +380,13 @@ def get_default_parameters(parameters_schema: dict) -> dict:
                 default_params[prop_name] = prop_schema['default']
     return default_params
 
+def bump_processing_stack_version(processing_stacks_db_session: Session, stack_identifier: str):
+    """Increment the version of a processing stack so that its compiled transformations are built again, the caller commits"""
+    processing_stacks_db_session.query(ProcessingStack).filter_by(identifier=stack_identifier).update(
+        {ProcessingStack.version: ProcessingStack.version + 1},
+        synchronize_session=False
+    )
+
 def add_processing_stack_step(processing_stacks_db_session: Session, stack_identifier: str, step_identifier: str, order: int, parameters: dict | None = None):
     """Add a processing stack step to a processing stack in the database"""
     try:
@@ -384,6 +407,7 @@ def add_processing_stack_step(processing_stacks_db_session: Session, stack_ident
             order=order, 
             parameters=final_parameters
         ))
+        bump_processing_stack_version(processing_stacks_db_session, stack_identifier)
         processing_stacks_db_session.commit()
     except Exception as e:
         processing_stacks_db_session.rollback()
@@ -394,6 +418,7 @@ def delete_processing_stack_step(processing_stacks_db_session: Session, stack_id
     """Delete a processing stack step from the database"""
     try:
         processing_stacks_db_session.query(ProcessingStackStep).filter_by(stack_identifier=stack_identifier, step_identifier=step_identifier).delete()
+        bump_processing_stack_version(processing_stacks_db_session, stack_identifier)
         processing_stacks_db_session.commit()
     except Exception as e:
         processing_stacks_db_session.rollback()
@@ -439,6 +464,7 @@ def change_processing_stack_step_order(processing_stacks_db_session: Session, st
                     
         # Set new order for the moved step
         step_to_move.order = new_order
+        bump_processing_stack_version(processing_stacks_db_session, stack_identifier)
         
         processing_stacks_db_session.commit()
     except Exception as e:
@@ -446,7 +472,7 @@ def change_processing_stack_step_order(processing_stacks_db_session: Session, st
         logger.error(f"Error changing processing stack step order: {e}")
         raise e
 
-def get_transformer_for_step(step: ProcessingStep, parameters: dict, datasource: Datasource, file_response: FileInfoResponse, embedding_settings_response: SettingResponse):
+def get_transformer_for_step(step: ProcessingStep, parameters: dict, datasource: Datasource, embedding_settings_response: SettingResponse):
     """Convert a ProcessingStep and parameters into a LlamaIndex transformer"""
     try:
         match step.identifier:
@@ -503,13 +529,34 @@ def get_transformer_for_step(step: ProcessingStep, parameters: dict, datasource:
         logger.error(f"Error getting transformer for step: {e}")
         raise e
 
-def get_transformations_for_stack(processing_stacks_db_session: Session, stack_identifier: str, datasource: Datasource, file_response: FileInfoResponse, embedding_settings_response: SettingResponse):
-    """Get all transformations for a processing stack"""
+def get_transformations_for_stack(processing_stacks_db_session: Session, stack_identifier: str, datasource: Datasource, embedding_settings_response: SettingResponse):
+    """
+    Get all transformations for a processing stack
+    They are compiled once per stack version, datasource, embedding setting and event loop and shared by the files, so a step must not depend on the file
+    The embedding model and the llm of the extractors hold http clients bound to the event loop they were first used in,
+    so each processing worker thread running its own loop gets its own transformations
+    """
     try:
-        stack = processing_stacks_db_session.query(ProcessingStack).filter_by(identifier=stack_identifier).first()
+        stack = processing_stacks_db_session.query(ProcessingStack.version, ProcessingStack.created_at).filter_by(identifier=stack_identifier).first()
         if not stack:
             raise ValueError(f"Stack not found: {stack_identifier}")
-          
+
+        # The creation time tells apart a stack deleted and created again with the same identifier, its version starts over
+        cache_key = (
+            str(processing_stacks_db_session.get_bind().url.database),
+            stack_identifier,
+            str(stack.created_at),
+            stack.version,
+            datasource.identifier,
+            get_embedding_setting_fingerprint(embedding_settings_response),
+            _get_running_loop_id()
+        )
+        with compiled_transformations_cache_lock:
+            transformations = compiled_transformations_cache.get(cache_key)
+            if transformations is not None:
+                compiled_transformations_cache.move_to_end(cache_key)
+                return transformations
+
         transformations = []
         stack_steps = (processing_stacks_db_session.query(ProcessingStackStep)
                       .filter_by(stack_identifier=stack_identifier)
@@ -517,14 +564,101 @@ def get_transformations_for_stack(processing_stacks_db_session: Session, stack_i
                       .all())
                       
         for stack_step in stack_steps:
-            transformer = get_transformer_for_step(stack_step.step, stack_step.parameters or {}, datasource, file_response, embedding_settings_response)
+            transformer = get_transformer_for_step(stack_step.step, stack_step.parameters or {}, datasource, embedding_settings_response)
             transformations.append(transformer)
-            
+
+        with compiled_transformations_cache_lock:
+            # Keep the transformations compiled by another thread meanwhile so that all the files share the same instances
+            transformations = compiled_transformations_cache.setdefault(cache_key, transformations)
+            compiled_transformations_cache.move_to_end(cache_key)
+            while len(compiled_transformations_cache) > PROCESSING_STACKS_COMPILED_CACHE_MAX_ENTRIES:
+                compiled_transformations_cache.popitem(last=False)
+        logger.info(f"Compiled transformations of stack {stack_identifier} version {stack.version} for datasource {datasource.identifier}")
         return transformations
     except Exception as e:
         logger.error(f"Error getting transformations for stack: {e}")
         raise e
 
+def _get_running_loop_id() -> int | None:
+    """Id of the event loop of the caller, the processing worker threads keep their loop for their whole life"""
+    try:
+        return id(asyncio.get_running_loop())
+    except RuntimeError:
+        return None
+
+def get_embedding_setting_fingerprint(embedding_settings_response: SettingResponse) -> str:
+    """Hash of the embedding setting values, the settings have no version so a change of their values is a new version"""
+    embedding_setting = json.dumps(
+        [embedding_settings_response.schema_identifier, embedding_settings_response.value_json],
+        sort_keys=True,
+        default=str
+    )
+    return hashlib.sha256(embedding_setting.encode()).hexdigest()
+
+class ProcessingStacksRoutingIndex:
+    """
+    Enabled processing stacks of each file extension, so that the stacks of many files can be validated without querying the stacks
+    """
+    def __init__(self, signature: Tuple, stacks_by_extension: Dict[str, Set[str]]):
+        # Identifiers, versions, creation times and enabled flags of the stacks the index was built from
+        self.signature = signature
+        self.stacks_by_extension = stacks_by_extension
+
+    def get_stacks_for_extension(self, file_extension: str, stacks_identifiers: List[str]) -> List[str]:
+        """Get the stacks among the requested ones that support a file extension, in the requested order"""
+        supported_stacks = self.stacks_by_extension.get(file_extension.lower(), set())
+        return [stack_identifier for stack_identifier in dict.fromkeys(stacks_identifiers) if stack_identifier in supported_stacks]
+
+    def get_extensions_by_stacks(self, stacks_identifiers: List[str]) -> Dict[Tuple[str, ...], List[str]]:
+        """
+        Group the extensions by the stacks among the requested ones that support them, so that the files of a group can be queued together
+        Only the extensions a file can have are kept, an extension starts with a dot and has no other dot
+        """
+        extensions_by_stacks: Dict[Tuple[str, ...], List[str]] = {}
+        for file_extension in self.stacks_by_extension:
+            if not file_extension.startswith(".") or "." in file_extension[1:] or "/" in file_extension:
+                continue
+            stacks = tuple(self.get_stacks_for_extension(file_extension, stacks_identifiers))
+            if stacks:
+                extensions_by_stacks.setdefault(stacks, []).append(file_extension)
+        return extensions_by_stacks
+
+def get_processing_stacks_routing_index(processing_stacks_db_session: Session) -> ProcessingStacksRoutingIndex:
+    """
+    Get the routing index of the stacks database of the session
+    The versions of the stacks are checked with a single query, the index is only rebuilt when a stack was created, updated or deleted
+    """
+    try:
+        stacks = processing_stacks_db_session.query(
+            ProcessingStack.identifier,
+            ProcessingStack.version,
+            ProcessingStack.created_at,
+            ProcessingStack.is_enabled
+        ).order_by(ProcessingStack.identifier).all()
+        signature = tuple((stack.identifier, stack.version, str(stack.created_at), stack.is_enabled) for stack in stacks)
+        db_path = str(processing_stacks_db_session.get_bind().url.database)
+
+        with processing_stacks_routing_indexes_lock:
+            routing_index = processing_stacks_routing_indexes.get(db_path)
+            if routing_index is not None and routing_index.signature == signature:
+                return routing_index
+
+        stacks_by_extension: Dict[str, Set[str]] = {}
+        for stack in processing_stacks_db_session.query(ProcessingStack).filter(ProcessingStack.is_enabled == True).all():
+            # The supported extensions are stored as a json encoded list
+            supported_extensions = json.loads(stack.supported_extensions) if stack.supported_extensions else []
+            for extension in supported_extensions:
+                stacks_by_extension.setdefault(extension.lower(), set()).add(stack.identifier)
+
+        routing_index = ProcessingStacksRoutingIndex(signature, stacks_by_extension)
+        with processing_stacks_routing_indexes_lock:
+            processing_stacks_routing_indexes[db_path] = routing_index
+        logger.info(f"Built the processing stacks routing index for {len(stacks)} stacks and {len(stacks_by_extension)} extensions")
+        return routing_index
+    except Exception as e:
+        logger.error(f"Error getting processing stacks routing index: {e}")
+        raise e
+
 def generate_stack_identifier(name: str) -> str:
     """Generate a safe identifier from a stack name"""
     try:
@@ -1,18 +1,18 @@
 import os
 from app.settings.schemas import *
 
-
 def init_ollama_embedding(ollama_embed_settings: OllamaEmbedSettings):
     try:
-        from llama_index.embeddings.ollama import OllamaEmbedding
+        from app.settings.ollama_embedding import OllamaKeepAliveEmbedding
     except ImportError:
         raise ImportError(
             "Ollama support is not installed. Please install it with `poetry add llama-index-llms-ollama` and `poetry add llama-index-embeddings-ollama`"
         )
-    return OllamaEmbedding(
+    return OllamaKeepAliveEmbedding(
         base_url=ollama_embed_settings.host,
         model_name=ollama_embed_settings.model,
-        embed_batch_size=2048
+        embed_batch_size=2048,
+        keep_alive=ollama_embed_settings.keep_alive
     )
 
 def init_ollama_llm(ollama_llm_settings: OllamaLLMSettings, temperature: float, system_prompt: str):
@@ -27,7 +27,8 @@ def init_ollama_llm(ollama_llm_settings: OllamaLLMSettings, temperature: float,
         model=ollama_llm_settings.model,
         request_timeout=ollama_llm_settings.request_timeout,
         temperature=temperature,
-        system_prompt=system_prompt
+        system_prompt=system_prompt,
+        keep_alive=ollama_llm_settings.keep_alive
     )
 
 def init_openai_embedding(openai_embed_settings: OpenAIEmbedSettings):
@@ -0,0 +1,25 @@
+from llama_index.core.bridge.pydantic import Field
+from llama_index.embeddings.ollama import OllamaEmbedding
+
+from typing import List, Optional, Union
+
+class OllamaKeepAliveEmbedding(OllamaEmbedding):
+    """
+    Ollama embedding model sending the keep alive with each embedding request
+    The ollama server unloads a model 5 minutes after its last request without keep alive, even if it was loaded with a longer one
+    """
+    keep_alive: Optional[Union[float, str]] = Field(
+        default=None, description="How long the model stays loaded after a request, the server default if None"
+    )
+
+    def get_general_text_embedding(self, texts: str) -> List[float]:
+        result = self._client.embeddings(
+            model=self.model_name, prompt=texts, options=self.ollama_additional_kwargs, keep_alive=self.keep_alive
+        )
+        return result["embedding"]
+
+    async def aget_general_text_embedding(self, prompt: str) -> List[float]:
+        result = await self._async_client.embeddings(
+            model=self.model_name, prompt=prompt, options=self.ollama_additional_kwargs, keep_alive=self.keep_alive
+        )
+        return result["embedding"]
@@ -37,6 +37,8 @@ class OllamaLLMSettings(SettingBase):
     model: str = "deepseek-r1:8b" #Literal["llama3.1:8b", "mistral:7b", "mixtral:8x7b", "phi:latest", "custom"] = "llama3.1:8b"
     host: str = "http://host.docker.internal:11434"
     request_timeout: float = 300
+    # How long ollama keeps the model loaded after a request, a duration like 30m, a negative duration keeps it loaded
+    keep_alive: str = "30m"
 
 class OpenAILLMSettings(SettingBase):
     model: Literal["gpt-4-turbo-preview", "gpt-4", "gpt-3.5-turbo", "custom"] = "gpt-3.5-turbo"
@@ -81,6 +83,8 @@ class OllamaEmbedSettings(SettingBase):
     model: str = "bge-m3" #Literal["Losspost/stella_en_1.5b_v5", "bge-m3", "nomic-embed-text", "custom"] = "bge-m3"
     host: str = "http://host.docker.internal:11434"
     request_timeout: float = 300
+    # How long ollama keeps the model loaded after a request, a duration like 30m, a negative duration keeps it loaded
+    keep_alive: str = "30m"
 
 class OpenAIEmbedSettings(SettingBase):
     model: Literal["text-embedding-3-large", "text-embedding-3-small", "custom"] = "text-embedding-3-small"
@@ -0,0 +1,105 @@
+"""
+Benchmark of the processing embedding throughput against a local stub embedding server.
+
+The stub server answers the Ollama embedding endpoints with random vectors after a simulated latency.
+It processes a limited number of texts at the same time, the extra requests wait like on a saturated GPU, and it can fail a share of the requests.
+The Ollama embedding model sends one request per text, so the batches are single texts and only the concurrency adapts.
+It compares one request at a time to the concurrent requests with adaptive concurrency:
+    python -m benchmarks.embedding_throughput --nodes 2000 --capacity 4 --error-rate 0.02
+"""
+import argparse
+import asyncio
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from llama_index.core.schema import TextNode
+from llama_index.embeddings.ollama import OllamaEmbedding
+
+# Import the routers first like main.py does, the processing modules are imported through them
+import app.api  # noqa: F401
+from app.processing.embedding_batches import EmbeddingEndpointLimiter, aembed_nodes_in_batches, PROCESSING_EMBEDDING_MAX_TEXT_CONCURRENCY
+
+
+def create_stub_embedding_server(request_latency: float, text_latency: float, capacity: int, error_rate: float, dimensions: int) -> ThreadingHTTPServer:
+    """Create an http server answering the Ollama embedding endpoints"""
+    # Texts being embedded at the same time, the others wait for a slot
+    embedding_slots = threading.BoundedSemaphore(capacity)
+
+    class StubEmbeddingHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            if self.path == "/api/embed":
+                texts = request.get("input", [])
+                texts = [texts] if isinstance(texts, str) else texts
+            elif self.path == "/api/embeddings":
+                texts = [request.get("prompt", "")]
+            else:
+                self.send_response(404)
+                self.end_headers()
+                return
+
+            if random.random() < error_rate:
+                self._send_json(500, {"error": "stub embedding server overloaded"})
+                return
+            with embedding_slots:
+                time.sleep(request_latency + text_latency * len(texts))
+            embeddings = [[random.random() for _ in range(dimensions)] for _ in texts]
+            if self.path == "/api/embed":
+                self._send_json(200, {"model": request.get("model"), "embeddings": embeddings})
+            else:
+                self._send_json(200, {"embedding": embeddings[0]})
+
+        def _send_json(self, status: int, content: dict):
+            body = json.dumps(content).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return ThreadingHTTPServer(("127.0.0.1", 0), StubEmbeddingHandler)
+
+
+async def measure_throughput(base_url: str, nodes_count: int, limiter: EmbeddingEndpointLimiter) -> float:
+    """Embed synthetic nodes and return the throughput in nodes/s"""
+    nodes = [TextNode(text=f"Synthetic node {i} " + "lorem ipsum " * 50) for i in range(nodes_count)]
+    embed_model = OllamaEmbedding(base_url=base_url, model_name="stub")
+    start = time.perf_counter()
+    await aembed_nodes_in_batches(embed_model, nodes, limiter=limiter)
+    return nodes_count / (time.perf_counter() - start)
+
+
+async def run_benchmark(args: argparse.Namespace) -> None:
+    server = create_stub_embedding_server(args.request_latency, args.text_latency, args.capacity, args.error_rate, args.dimensions)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    try:
+        modes = {
+            "sequential": EmbeddingEndpointLimiter("stub-sequential", max_concurrency=1, min_batch_size=1, max_batch_size=1, adaptive=False),
+            "adaptive": EmbeddingEndpointLimiter("stub-adaptive", max_concurrency=args.max_concurrency, min_batch_size=1, max_batch_size=1),
+        }
+        print(f"{'mode':>12} {'nodes/s':>10} {'concurrency':>12}")
+        for mode, limiter in modes.items():
+            throughput = await measure_throughput(base_url, args.nodes, limiter)
+            print(f"{mode:>12} {throughput:>10.1f} {limiter.concurrency:>12}")
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the processing embedding throughput against a stub embedding server")
+    parser.add_argument("--nodes", type=int, default=2000)
+    parser.add_argument("--request-latency", type=float, default=0.02, help="Fixed latency of a request in seconds")
+    parser.add_argument("--text-latency", type=float, default=0.002, help="Latency per embedded text in seconds")
+    parser.add_argument("--capacity", type=int, default=4, help="Requests processed at the same time by the stub server")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of the requests failing")
+    parser.add_argument("--dimensions", type=int, default=384)
+    parser.add_argument("--max-concurrency", type=int, default=PROCESSING_EMBEDDING_MAX_TEXT_CONCURRENCY)
+    args = parser.parse_args()
+    asyncio.run(run_benchmark(args))
@@ -0,0 +1,57 @@
+"""
+Benchmark of the login latency against the number of live sessions of a user.
+
+Each login rotates the kek_p and re-wraps every live session, this measures how the login latency grows with them.
+It creates a throwaway user in the data folder and deletes it at the end, run it in the backend container:
+    python -m benchmarks.login_latency --session-counts 1 10 50 100 200
+"""
+import os
+import argparse
+import asyncio
+import hashlib
+import statistics
+import time
+import uuid
+
+# Allow the throwaway user to be registered on hosts with a user limit
+os.environ.setdefault("MAX_PUBLIC_USERS_FOR_THIS_HOST", "1000000")
+
+from app.auth.service import register_new_user, aget_new_access_sk_token_with_password, delete_user
+
+
+async def measure_login_latency(user_uuid: str, hashed_password: str, repeats: int) -> list[float]:
+    """Measure the latency of repeated logins, each login adds one live session"""
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        await aget_new_access_sk_token_with_password(user_uuid, hashed_password)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+async def run_benchmark(session_counts: list[int], repeats: int) -> None:
+    user_uuid = hashlib.sha256(f"login-latency-benchmark-{uuid.uuid4()}".encode()).hexdigest()
+    hashed_password = hashlib.sha256(b"login-latency-benchmark").hexdigest()
+    register_new_user(user_uuid, hashed_password)
+    live_sessions = 1
+    try:
+        print(f"{'sessions':>10} {'mean ms':>10} {'p50 ms':>10} {'max ms':>10}")
+        for session_count in sorted(session_counts):
+            # Create sessions until the target count is reached, logins add one session each
+            while live_sessions < session_count:
+                await aget_new_access_sk_token_with_password(user_uuid, hashed_password)
+                live_sessions += 1
+            latencies = await measure_login_latency(user_uuid, hashed_password, repeats)
+            live_sessions += repeats
+            latencies_ms = [latency * 1000 for latency in latencies]
+            print(f"{session_count:>10} {statistics.mean(latencies_ms):>10.1f} {statistics.median(latencies_ms):>10.1f} {max(latencies_ms):>10.1f}")
+    finally:
+        delete_user(user_uuid)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the login latency against the number of live sessions")
+    parser.add_argument("--session-counts", type=int, nargs="+", default=[1, 10, 50, 100, 200])
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+    asyncio.run(run_benchmark(args.session_counts, args.repeats))
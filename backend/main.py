@@ -15,9 +15,21 @@ async def lifespan(app: FastAPI):
     """Lifespan context manager for FastAPI application"""
     logger.info("Starting application with environment: %s", os.getenv("ENVIRONMENT"))
 
-    # Setup the unmounted user data directory cleanup loop
-    from app.api.mount_user_data_dir import setup_mounted_user_data_dir_cleanup_loop
-    setup_mounted_user_data_dir_cleanup_loop()
+    # Setup the user data directories lifecycle manager that unmounts the idle ones
+    from app.api.mount_user_data_dir import setup_user_data_dir_lifecycle_manager
+    setup_user_data_dir_lifecycle_manager()
+
+    # Setup the expired sessions pruning loop
+    from app.auth.session_keys import setup_expired_sessions_pruning_loop
+    setup_expired_sessions_pruning_loop()
+
+    # Setup the loop writing the metrics of this worker so that the metrics endpoint of any worker renders the metrics of all of them
+    from app.api.metrics import setup_metrics_flush_loop
+    setup_metrics_flush_loop()
+
+    # Setup the processing scheduler shared by all the users of the host
+    from app.processing.scheduler import setup_processing_scheduler
+    setup_processing_scheduler()
 
     yield
     
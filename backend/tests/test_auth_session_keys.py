@@ -0,0 +1,64 @@
+import os
+import json
+
+import pytest
+from cryptography.fernet import Fernet
+
+# Import the routers first like main.py does, the auth service is imported through them
+import app.api  # noqa: F401
+from app.auth import service as auth_service
+from app.auth import session_keys
+from app.auth import keyring_cache
+
+
+@pytest.fixture
+def data_folder_path(tmp_path, monkeypatch):
+    """Move the user data and the keyring cache of the auth modules to a temporary directory"""
+    for module in (auth_service, session_keys):
+        for name, value in list(vars(module).items()):
+            if name.endswith("_PATH") and isinstance(value, str) and value.startswith("/data"):
+                monkeypatch.setattr(module, name, str(tmp_path / "data") + value[len("/data"):])
+    keyring_cache_dir_path = str(tmp_path / "keyring_cache")
+    monkeypatch.setattr(keyring_cache, "KEYRING_CACHE_DIR_PATH", keyring_cache_dir_path)
+    monkeypatch.setattr(keyring_cache, "KEYRING_CACHE_USER_DIR_PATH", keyring_cache_dir_path + "/{user_uuid}")
+    monkeypatch.setattr(keyring_cache, "KEYRING_CACHE_ENTRY_PATH", keyring_cache_dir_path + "/{user_uuid}/{entry_id}")
+    monkeypatch.setenv("MAX_PUBLIC_USERS_FOR_THIS_HOST", "10")
+    os.makedirs(tmp_path / "data")
+    return tmp_path / "data"
+
+
+def _move_session_index_to_legacy_session_key_files(user_uuid: str) -> None:
+    """Write the sessions of the session index in the legacy layout with three files per session"""
+    session_index_path = session_keys.SESSION_INDEX_PATH.format(user_uuid=user_uuid)
+    with open(session_index_path, "r") as f:
+        sessions = json.load(f)["sessions"]
+    legacy_sk_dir_path = session_keys.LEGACY_SK_DIR_PATH.format(user_uuid=user_uuid)
+    os.makedirs(legacy_sk_dir_path)
+    for sk_uuid, session_entry in sessions.items():
+        for file_prefix, key in (("sk_kek_p", "sk_kek_p"), ("kek_s", "kek_s_sk"), ("kek_p_kek_s", "kek_p_kek_s")):
+            with open(os.path.join(legacy_sk_dir_path, f"{file_prefix}_{sk_uuid}.txt"), "wb") as f:
+                f.write(session_entry[key].encode())
+    os.remove(session_index_path)
+
+
+def test_login_of_user_with_legacy_session_key_files(data_folder_path):
+    user_uuid = "legacy-user"
+    mk = Fernet.generate_key()
+    legacy_token_data = auth_service.register_new_user(user_uuid, "hashed_password", mk=mk)
+    _move_session_index_to_legacy_session_key_files(user_uuid)
+
+    token_data = auth_service.get_new_access_sk_token_with_mk(user_uuid, mk)
+
+    # The legacy sessions are migrated into the session index and re-wrapped with the new kek_p
+    assert not os.path.exists(session_keys.LEGACY_SK_DIR_PATH.format(user_uuid=user_uuid))
+    assert set(session_keys.load_session_index(user_uuid)) == {legacy_token_data.sk_uuid, token_data.sk_uuid}
+    kek_p = auth_service.get_kek_p_with_sk(user_uuid, token_data.sk_uuid, token_data.sk_str.encode())
+    assert auth_service.get_kek_p_with_sk(user_uuid, legacy_token_data.sk_uuid, legacy_token_data.sk_str.encode()) == kek_p
+
+    # The key chain is still usable, the kek_p_mk was not restored from its backup
+    auth_service.test_kek_p_with_user_uuid_test_file(user_uuid, kek_p)
+    auth_service.get_keyring_with_kek_p(user_uuid, kek_p)
+    assert not os.path.exists(auth_service.KEK_P_MK_PATH.format(user_uuid=user_uuid) + ".backup")
+
+    # The user can log in again
+    auth_service.get_new_access_sk_token_with_mk(user_uuid, mk)
@@ -0,0 +1,105 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+# Import the routers first like main.py does, the processing modules are imported through them
+import app.api  # noqa: F401
+from app.datasources.file_manager.database.models import Base as FileManagerBase, File, FileStatus
+from app.processing.database.models import Base as ProcessingBase, ProcessingJob, ProcessingJobStatus, ProcessingJobPriority
+from app.processing.jobs import enqueue_processing_jobs_for_queued_files, get_next_leasable_processing_job, lease_processing_job, postpone_processing_jobs, PROCESSING_JOB_MAX_ATTEMPTS, PROCESSING_JOB_PRIORITY_AGING_SECONDS
+
+DATASOURCE_NAME = "files"
+
+
+@pytest.fixture
+def file_manager_db_session(tmp_path):
+    # The jobs reference the file manager database by its path
+    engine = create_engine(f"sqlite:///{tmp_path / 'file_manager.db'}")
+    FileManagerBase.metadata.create_all(engine)
+    with Session(bind=engine) as session:
+        yield session
+
+
+@pytest.fixture
+def processing_db_session():
+    engine = create_engine("sqlite://")
+    ProcessingBase.metadata.create_all(engine)
+    with Session(bind=engine) as session:
+        yield session
+
+
+def _add_queued_file(file_manager_db_session: Session, name: str) -> int:
+    now = datetime.now()
+    file = File(name=name, path=f"{DATASOURCE_NAME}/{name}", original_path=f"{DATASOURCE_NAME}/{name}", dek="dek", size=10, status=FileStatus.QUEUED, file_created_at=now, file_modified_at=now)
+    file_manager_db_session.add(file)
+    file_manager_db_session.commit()
+    return file.id
+
+
+def _add_job(processing_db_session: Session, file_id: int, status: ProcessingJobStatus, attempts: int, available_at: datetime) -> ProcessingJob:
+    job = ProcessingJob(datasource_name=DATASOURCE_NAME, file_manager_db_path="files.db", file_id=file_id, file_size=10, priority=ProcessingJobPriority.BULK, status=status, attempts=attempts, max_attempts=PROCESSING_JOB_MAX_ATTEMPTS, last_error="error", available_at=available_at)
+    processing_db_session.add(job)
+    processing_db_session.commit()
+    return job
+
+
+def test_enqueue_keeps_the_backoff_of_waiting_jobs(file_manager_db_session, processing_db_session):
+    file_id = _add_queued_file(file_manager_db_session, "retrying.txt")
+    available_at = datetime.now() + timedelta(minutes=5)
+    job = _add_job(processing_db_session, file_id, ProcessingJobStatus.QUEUED, 2, available_at)
+
+    enqueued_jobs_count = enqueue_processing_jobs_for_queued_files(processing_db_session, {DATASOURCE_NAME: file_manager_db_session}, {DATASOURCE_NAME: [file_id]}, ProcessingJobPriority.INTERACTIVE)
+
+    processing_db_session.refresh(job)
+    assert enqueued_jobs_count == 0
+    assert (job.attempts, job.available_at, job.last_error, job.priority) == (2, available_at, "error", ProcessingJobPriority.BULK)
+
+
+def test_enqueue_retries_failed_jobs_with_a_fresh_attempts_budget(file_manager_db_session, processing_db_session):
+    file_id = _add_queued_file(file_manager_db_session, "failed.txt")
+    job = _add_job(processing_db_session, file_id, ProcessingJobStatus.FAILED, PROCESSING_JOB_MAX_ATTEMPTS, datetime.now() - timedelta(minutes=5))
+
+    enqueued_jobs_count = enqueue_processing_jobs_for_queued_files(processing_db_session, {DATASOURCE_NAME: file_manager_db_session}, {DATASOURCE_NAME: [file_id]}, ProcessingJobPriority.INTERACTIVE)
+
+    processing_db_session.refresh(job)
+    assert enqueued_jobs_count == 1
+    assert (job.status, job.attempts, job.last_error, job.priority) == (ProcessingJobStatus.QUEUED, 0, None, ProcessingJobPriority.INTERACTIVE)
+    assert job.available_at <= datetime.now()
+
+
+def test_enqueue_only_creates_the_jobs_of_the_given_files(file_manager_db_session, processing_db_session):
+    queued_file_id = _add_queued_file(file_manager_db_session, "queued.txt")
+    # Queued by another request, its job is not created by this one
+    _add_queued_file(file_manager_db_session, "other.txt")
+
+    enqueued_jobs_count = enqueue_processing_jobs_for_queued_files(processing_db_session, {DATASOURCE_NAME: file_manager_db_session}, {DATASOURCE_NAME: [queued_file_id]})
+
+    assert enqueued_jobs_count == 1
+    assert [job.file_id for job in processing_db_session.query(ProcessingJob).all()] == [queued_file_id]
+
+
+def test_priority_aging_survives_the_retries_backoff(processing_db_session):
+    now = datetime.now()
+    # Queued long enough ago to age two lanes, its last retry backoff just ended
+    bulk_job = _add_job(processing_db_session, 1, ProcessingJobStatus.QUEUED, 1, now - timedelta(seconds=1))
+    bulk_job.enqueued_at = now - timedelta(seconds=2 * PROCESSING_JOB_PRIORITY_AGING_SECONDS + 60)
+    normal_job = _add_job(processing_db_session, 2, ProcessingJobStatus.QUEUED, 0, now - timedelta(seconds=1))
+    normal_job.priority = ProcessingJobPriority.NORMAL
+    processing_db_session.commit()
+
+    assert get_next_leasable_processing_job(processing_db_session, []).id == bulk_job.id
+
+
+def test_postponed_jobs_do_not_lose_an_attempt(processing_db_session):
+    job = _add_job(processing_db_session, 1, ProcessingJobStatus.QUEUED, 1, datetime.now() - timedelta(seconds=1))
+    assert lease_processing_job(processing_db_session, job.id, "owner")
+    processing_db_session.refresh(job)
+
+    postpone_processing_jobs(processing_db_session, [job], 30)
+
+    processing_db_session.refresh(job)
+    assert (job.status, job.attempts, job.lease_owner) == (ProcessingJobStatus.QUEUED, 1, None)
+    assert job.available_at > datetime.now()
+    assert get_next_leasable_processing_job(processing_db_session, []) is None